@@ -1,35 +1,63 @@
-from flask import Flask, render_template, request, send_file, abort, jsonify
+from flask import Flask, Response, render_template, request, send_file, abort, jsonify, url_for, g, has_request_context
+from flask import before_render_template, template_rendered, stream_template
 import os
 import mimetypes
 from pathlib import Path
 import urllib.parse
-import markdown
 import re
 import logging
-from werkzeug.utils import secure_filename
-from functools import lru_cache
+from werkzeug.utils import secure_filename, send_file as werkzeug_send_file
+from werkzeug.exceptions import HTTPException, RequestedRangeNotSatisfiable
+from werkzeug.datastructures import ContentRange
+from werkzeug.wsgi import wrap_file
+from functools import lru_cache, wraps
 import time
 import tempfile
 import shutil
 import zipfile # Added for CBZ
 import io      # Added for serving image data
+import threading
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from urllib.parse import quote, unquote # For encoding/decoding file paths in URLs
-import xml.etree.ElementTree as ET # Added for FB2
 import base64 # Added for FB2
+import hashlib
+import json
+import pickle
+import secrets
+import sqlite3
+import cProfile
+import zlib
+import importlib.util
+import struct
+import mmap
+import unicodedata
+import codecs
+from html import escape
+
+# 各格式的重量级依赖（ebooklib、markdown、Pillow）在首次使用时才导入，
+# 这里只检查是否已安装，不导入模块本身
+EPUB_SUPPORT = importlib.util.find_spec('ebooklib') is not None
 
 try:
-    import ebooklib
-    from ebooklib import epub
-    EPUB_SUPPORT = True
-    print(f"EPUB support loaded successfully. ebooklib available.")
-except ImportError as e:
-    EPUB_SUPPORT = False
-    print(f"EPUB support failed to load: {e}")
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+PIL_SUPPORT = importlib.util.find_spec('PIL') is not None
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+if not EPUB_SUPPORT:
+    logger.warning("EPUB support unavailable: ebooklib is not installed")
+
 app = Flask(__name__)
 
 # 配置Flask
@@ -43,6 +71,10 @@ ROOT_DIR = os.path.join(os.getcwd(), 'filesystem')
 TEMP_DIR = os.path.join(os.getcwd(), 'temp_uploads')
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# 配置派生内容的磁盘缓存目录（墨水屏图片等）
+CACHE_DIR = os.path.join(os.getcwd(), 'cache')
+EINK_CACHE_DIR = os.path.join(CACHE_DIR, 'eink')
+
 def safe_path_join(base_path, *paths):
     """安全的路径拼接，防止目录遍历攻击"""
     try:
@@ -86,6 +118,317 @@ def validate_filename(filename):
 
     return True
 
+def resolve_read_path(file_path):
+    """将/read使用的相对路径（含__temp__/前缀）转换为绝对路径"""
+    if file_path.startswith('__temp__/'):
+        return safe_path_join(TEMP_DIR, file_path[9:]) # 移除 '__temp__/' 前缀
+    return safe_path_join(ROOT_DIR, file_path)
+
+# 按内容哈希存储的上传文件：TEMP_DIR/<sha256>/<文件名>
+_SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def find_stored_upload(digest):
+    """返回已存储的上传文件相对TEMP_DIR的路径，不存在时返回None"""
+    if not _SHA256_RE.match(digest or ''):
+        return None
+    try:
+        names = sorted(name for name in os.listdir(os.path.join(TEMP_DIR, digest)) if not name.startswith('.'))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if not names:
+        return None
+    # 刷新目录时间供清理任务判断；不修改文件本身，以免派生缓存失效
+    os.utime(os.path.join(TEMP_DIR, digest))
+    return f"{digest}/{names[0]}"
+
+def store_upload(src_path, digest, filename):
+    """
+    将上传完成的文件移动到内容寻址目录。
+    相同内容已存在时丢弃新文件并返回已有文件，这样解析结果、漫画清单等
+    以路径和修改时间为键的派生缓存在重复上传时可以直接命中。
+    """
+    existing = find_stored_upload(digest)
+    if existing:
+        os.remove(src_path)
+        return existing
+    store_dir = os.path.join(TEMP_DIR, digest)
+    os.makedirs(store_dir, exist_ok=True)
+    os.replace(src_path, os.path.join(store_dir, filename))
+    return f"{digest}/{filename}"
+
+def make_temp_read_url(stored_path):
+    """生成阅读URL（使用特殊前缀标识临时文件）"""
+    return f"/read?path=__temp__/{quote(stored_path)}"
+
+# 运行指标：计数器和直方图保存在进程内，/metrics按Prometheus文本格式输出
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics_lock = threading.Lock()
+_metric_counters = {}    # (名称, 标签元组) -> 数值
+_metric_histograms = {}  # (名称, 标签元组) -> [各桶计数..., +Inf计数, 总和]
+
+def inc_counter(name, labels=(), amount=1):
+    """累加计数器；labels为((标签名, 值), ...)元组"""
+    key = (name, labels)
+    with _metrics_lock:
+        _metric_counters[key] = _metric_counters.get(key, 0) + amount
+
+def observe_histogram(name, labels, value):
+    """记录一次耗时（秒）"""
+    bucket = bisect_left(METRICS_BUCKETS, value)
+    key = (name, labels)
+    with _metrics_lock:
+        histogram = _metric_histograms.get(key)
+        if histogram is None:
+            histogram = _metric_histograms[key] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        histogram[bucket] += 1
+        histogram[-1] += value
+
+def record_cache_lookup(cache, tier, hit):
+    inc_counter('xiningread_cache_requests_total',
+                (('cache', cache), ('tier', tier), ('result', 'hit' if hit else 'miss')))
+
+@contextmanager
+def record_parse_duration(file_format):
+    """统计实际执行的解析/渲染耗时（缓存命中不计入）"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_histogram('xiningread_parse_duration_seconds', (('format', file_format),),
+                          time.perf_counter() - start)
+
+# Server-Timing：记录当前请求各阶段耗时，在响应头中输出，可在浏览器开发者工具中查看
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', '1') == '1'
+
+def add_server_timing(name, seconds, desc=None):
+    """追加一个耗时段；不在请求上下文中（后台线程、解析进程）时忽略"""
+    if not SERVER_TIMING_ENABLED or not has_request_context():
+        return
+    spans = g.setdefault('server_timings', [])
+    spans.append((name, seconds, desc))
+
+@contextmanager
+def timing_span(name, desc=None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_server_timing(name, time.perf_counter() - start, desc)
+
+# 请求合并（single-flight）：同一派生结果同时只计算一次，其余调用方等待并复用
+SINGLE_FLIGHT_LOCK_DIR = os.path.join(CACHE_DIR, 'locks')
+SINGLE_FLIGHT_LOCK_MAX_AGE = 24 * 3600  # 锁文件释放时即删除；进程崩溃遗留的超过该时间后由后台任务删除
+
+_flight_locks = {}  # key -> [threading.Lock, 等待/持有的线程数]
+_flight_locks_guard = threading.Lock()
+
+@contextmanager
+def single_flight(key, cross_process=True):
+    """
+    对同一key串行化：进程内用线程锁，跨工作进程用锁文件(flock)。
+    调用方在进入后应先检查结果是否已由前一个持有者生成。
+    """
+    with _flight_locks_guard:
+        entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            if not cross_process or fcntl is None:
+                yield
+            else:
+                digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+                lock_path = os.path.join(SINGLE_FLIGHT_LOCK_DIR, f"{digest}.lock")
+                os.makedirs(SINGLE_FLIGHT_LOCK_DIR, exist_ok=True)
+                while True:
+                    lock_file = open(lock_path, 'a')
+                    fcntl.flock(lock_file, fcntl.LOCK_EX) # Released automatically if the holder dies
+                    try:
+                        # 等待期间前一个持有者可能已删除该文件，锁住的是旧文件时重新打开
+                        if os.fstat(lock_file.fileno()).st_ino == os.stat(lock_path).st_ino:
+                            break
+                    except FileNotFoundError:
+                        pass
+                    lock_file.close()
+                try:
+                    yield
+                finally:
+                    # 持有锁时删除锁文件，键再多也不会在cache/locks下堆积
+                    try:
+                        os.remove(lock_path)
+                    except OSError:
+                        pass
+                    lock_file.close()
+    finally:
+        with _flight_locks_guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _flight_locks[key]
+
+# 磁盘缓存：解析结果和文件目录信息写入CACHE_DIR，供多个工作进程共享
+DISK_CACHE_DIR = os.path.join(CACHE_DIR, 'objects')
+DISK_CACHE_VERSION = 2  # 解析逻辑变化时递增，使旧缓存失效
+
+def _disk_cache_path(namespace, key):
+    digest = hashlib.sha1(repr((DISK_CACHE_VERSION, key)).encode('utf-8')).hexdigest()
+    return os.path.join(DISK_CACHE_DIR, namespace, digest[:2], f"{digest}.pickle")
+
+def disk_cached(namespace):
+    """
+    在进程内lru_cache之下增加一层磁盘缓存。
+    参数需包含文件修改时间等版本信息，保证文件变化后不会命中旧结果。
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args):
+            cache_path = _disk_cache_path(namespace, args)
+            found, result = _load_disk_cache_entry(cache_path)
+            record_cache_lookup(namespace, 'disk', found)
+            if found:
+                return result
+
+            # 同一文件的并发冷启动请求只解析一次，其余等待后直接读取磁盘结果
+            with single_flight(('disk_cache', cache_path)):
+                found, result = _load_disk_cache_entry(cache_path)
+                if found:
+                    return result
+                result = func(*args)
+                try:
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp_path, cache_path) # Other workers never see a partial entry
+                except Exception as e:
+                    logger.warning(f"Could not write disk cache entry {cache_path}: {e}")
+                return result
+        return wrapper
+    return decorator
+
+def _load_disk_cache_entry(cache_path):
+    """返回(是否命中, 缓存值)"""
+    try:
+        with open(cache_path, 'rb') as f:
+            return True, pickle.load(f)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable disk cache entry {cache_path}: {e}")
+    return False, None
+
+# 文档解析进程池：EPUB/FB2解析和Markdown渲染是纯Python的CPU密集任务，
+# 放到独立进程中执行，避免在GIL下阻塞同一进程的其他请求
+# 每个服务进程各有一个进程池，默认把CPU数平分给所有服务进程（gunicorn.conf.py会设置WEB_CONCURRENCY），避免超额订阅
+_SERVER_PROCESSES = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS',
+                                   str(max(1, (os.cpu_count() or 2) // _SERVER_PROCESSES))))  # 0表示在请求线程内解析
+PARSE_TIMEOUT = int(os.environ.get('PARSE_TIMEOUT', '60'))  # 单个解析任务的超时（秒）
+PARSE_INLINE_MAX_BYTES = 256 * 1024  # 小文件直接在请求线程内解析，省去进程间传输
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def _get_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # forkserver避免从多线程进程fork，子进程按需导入本模块
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context(method))
+        return _parse_pool
+
+def _discard_parse_pool(pool):
+    """终止卡住或损坏的进程池，下次提交任务时重新创建"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is pool:
+            _parse_pool = None
+    # ProcessPoolExecutor没有公开的终止接口，只能直接结束其工作进程
+    for process in list((getattr(pool, '_processes', None) or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def run_document_job(func, file_path, *args, timeout=PARSE_TIMEOUT):
+    """
+    在解析进程池中执行func(file_path, *args)并返回其结果（结果必须可pickle）。
+    超时时取消任务并抛出TimeoutError；调用方不应缓存超时结果。
+    """
+    try:
+        small_file = os.path.getsize(file_path) <= PARSE_INLINE_MAX_BYTES
+    except OSError:
+        small_file = True
+    # 被分析的请求在本线程内解析，这样cProfile能看到解析器内部
+    if PARSE_WORKERS <= 0 or small_file or (has_request_context() and g.get('profiler') is not None):
+        return func(file_path, *args)
+
+    pool = _get_parse_pool()
+    try:
+        future = pool.submit(func, file_path, *args)
+    except (BrokenProcessPool, RuntimeError):
+        _discard_parse_pool(pool)
+        pool = _get_parse_pool()
+        future = pool.submit(func, file_path, *args)
+
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        if not future.cancel():
+            logger.error(f"Parse job {func.__name__} for {file_path} exceeded {timeout}s, restarting parse pool")
+            _discard_parse_pool(pool)
+        raise
+    except BrokenProcessPool:
+        # 子进程异常退出（如内存不足被杀）时，退回到请求线程内解析
+        logger.error(f"Parse pool crashed while running {func.__name__} for {file_path}, parsing inline")
+        _discard_parse_pool(pool)
+        return func(file_path, *args)
+
+# HTTP缓存相关
+CACHE_IMMUTABLE_MAX_AGE = 31536000  # 带版本号的URL缓存1年
+
+def get_file_version(stat_result):
+    """根据(inode, 大小, 修改时间)生成文件版本号，用于内容寻址的URL"""
+    raw = f"{stat_result.st_ino}-{stat_result.st_size}-{stat_result.st_mtime_ns}"
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:16]
+
+def get_resource_etag(stat_result, *parts):
+    """为文件或文件内的资源（如压缩包成员、派生图）生成强ETag"""
+    raw = '\0'.join([get_file_version(stat_result)] + [str(part) for part in parts])
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+def apply_cache_validators(response, etag, stat_result):
+    """设置ETag/Last-Modified；URL中的版本号与当前文件一致时标记为immutable"""
+    response.set_etag(etag)
+    response.last_modified = stat_result.st_mtime
+    if request.args.get('v') == get_file_version(stat_result):
+        response.headers['Cache-Control'] = f'public, max-age={CACHE_IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def make_not_modified_response(etag, stat_result):
+    """客户端缓存仍然有效时返回304响应，否则返回None"""
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(etag)
+    elif request.if_modified_since:
+        matched = int(stat_result.st_mtime) <= request.if_modified_since.timestamp()
+    else:
+        matched = False
+    if not matched:
+        return None
+    return apply_cache_validators(Response(status=304), etag, stat_result)
+
+def range_request_applies(etag, stat_result):
+    """判断Range请求是否生效（处理If-Range）"""
+    if not request.range:
+        return False
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == etag
+    if if_range.date:
+        return int(stat_result.st_mtime) == int(if_range.date.timestamp())
+    return True
+
 @lru_cache(maxsize=1000)
 def get_file_info_cached(filepath, mtime):
     """获取文件信息（带缓存）"""
@@ -104,33 +447,31 @@ def _get_file_info_internal(filepath):
     else:
         size_str = f"{size / (1024 * 1024):.1f} MB"
     
-    # 获取文件类型标签
-    file_type_label = get_file_type_label(filepath)
-    
-    is_text_type = is_text_file(filepath)
-    is_pdf_type = is_pdf_file(filepath)
-    is_epub_type = is_epub_file(filepath)
-    is_html_type = is_html_file(filepath)
-    is_cbz_type = file_type_label == 'CBZ'
-    is_fb2_type = file_type_label == 'FB2'
-
-    # Determine if the file is directly readable/viewable within the app
-    is_readable_in_app = is_text_type or is_pdf_type or is_epub_type or is_html_type or is_cbz_type or is_fb2_type
-    
-    # The 'is_text' key might be used by index.html to show 'Read' button.
-    # For now, let's make 'is_readable_in_app' the primary flag for this.
-    # We might need to adjust index.html if it strictly uses 'is_text'.
-    # As per subtask: use is_readable_in_app and type_label == 'CBZ' for routing.
-    # The original 'is_text' for general text files can remain for specific text styling if needed.
+    # 文件类型标签和阅读方式来自格式注册表
+    handler = get_format_handler(filepath)
+    reader_name = get_reader_name(handler, filepath)
 
-    return {
+    file_info = {
         'name': os.path.basename(filepath),
         'size': size_str,
-        'is_text': is_text_type, # Keep original meaning for text-specific handling
-        'is_readable_in_app': is_readable_in_app, # New flag for general viewability
-        'type_label': file_type_label
+        'is_text': reader_name == 'text', # Handled by the generic text reader
+        'is_readable_in_app': reader_name is not None, # Any in-app reader (PDF, EPUB, CBZ, text...)
+        'type_label': handler.label
     }
 
+    # PDF：页数、标题、作者等目录信息随文件信息一起缓存
+    if reader_name == 'pdf':
+        pdf_metadata = get_pdf_metadata_cached(filepath, stat.st_mtime)
+        file_info.update({
+            'title': pdf_metadata['title'],
+            'author': pdf_metadata['author'],
+            'page_count': pdf_metadata['page_count'],
+            'linearized': pdf_metadata['linearized'],
+            'slow_to_open': size > PDF_LARGE_FILE_SIZE and not pdf_metadata['linearized']
+        })
+
+    return file_info
+
 def get_file_info(filepath):
     """获取文件信息（使用缓存）"""
     try:
@@ -148,16 +489,10 @@ def get_file_info(filepath):
         }
 
 def is_text_file(filepath):
-    """判断是否为文本文件"""
-    text_extensions = {
-        '.txt', '.md', '.py', '.js', '.css', '.json', '.xml', '.csv', '.log',
-        '.java', '.cpp', '.c', '.h', '.php', '.rb', '.go', '.rs', '.swift',
-        '.kt', '.scala', '.sh', '.bat', '.ps1', '.sql', '.yaml', '.yml',
-        '.ini', '.cfg', '.conf', '.toml'
-    }
-    ext = os.path.splitext(filepath)[1].lower()
+    """判断是否为文本文件（已注册的文本格式直接返回，其余读取开头1KB判断）"""
+    handler = FORMAT_HANDLERS.get(os.path.splitext(filepath)[1].lower())
 
-    if ext in text_extensions:
+    if handler is not None and handler.reader == 'text':
         return True
     else:
         try:
@@ -186,131 +521,90 @@ def is_text_file(filepath):
         except Exception: # Catch other errors like file not found, permission denied
             return False
 
-def is_pdf_file(filepath):
-    """判断是否为PDF文件"""
-    return os.path.splitext(filepath)[1].lower() == '.pdf'
-
-def is_epub_file(filepath):
-    """判断是否为EPUB文件"""
-    return os.path.splitext(filepath)[1].lower() == '.epub'
-
-def is_html_file(filepath):
-    """判断是否为HTML文件"""
-    return os.path.splitext(filepath)[1].lower() in {'.html', '.htm'}
-
-def is_code_file(filepath):
-    """判断是否为代码文件"""
-    code_extensions = {
-        '.py', '.js', '.css', '.java', '.cpp', '.c', '.h', '.php', '.rb',
-        '.go', '.rs', '.swift', '.kt', '.scala', '.sh', '.bat', '.ps1', '.sql'
-    }
-    return os.path.splitext(filepath)[1].lower() in code_extensions
-
-def get_language_from_extension(filepath):
-    """根据文件扩展名获取语言类型"""
-    ext = os.path.splitext(filepath)[1].lower()
-    language_map = {
-        '.py': 'python',
-        '.js': 'javascript',
-        '.css': 'css',
-        '.java': 'java',
-        '.cpp': 'cpp',
-        '.c': 'c',
-        '.h': 'c',
-        '.php': 'php',
-        '.rb': 'ruby',
-        '.go': 'go',
-        '.rs': 'rust',
-        '.swift': 'swift',
-        '.kt': 'kotlin',
-        '.scala': 'scala',
-        '.sh': 'bash',
-        '.bat': 'batch',
-        '.ps1': 'powershell',
-        '.sql': 'sql',
-        '.yaml': 'yaml',
-        '.yml': 'yaml',
-        '.json': 'json',
-        '.xml': 'xml'
-    }
-    return language_map.get(ext, 'text')
-
-def get_file_type_label(filepath):
-    """获取文件类型标签"""
+# 文件格式注册表：扩展名 -> FormatHandler，格式判断只需一次字典查找
+class FormatHandler:
+    """
+    一种文件格式的处理方式。
+    label: 文件列表中显示的类型标签
+    reader: 阅读器名称（见FORMAT_READERS）；None表示未知格式，需要按内容判断是否为文本
+    text_type: 通用文本阅读器的显示方式（txt/markdown/code/text）
+    language: 代码高亮使用的语言
+    """
+    __slots__ = ('label', 'reader', 'text_type', 'language')
+
+    def __init__(self, label, reader=None, text_type=None, language=None):
+        self.label = label
+        self.reader = reader
+        self.text_type = text_type
+        self.language = language
+
+FORMAT_HANDLERS = {}
+FORMAT_READERS = {}  # 阅读器名称 -> 函数(full_path, file_path, handler)
+
+def register_format(extensions, label, reader=None, text_type=None, language=None):
+    handler = FormatHandler(label, reader, text_type, language)
+    for ext in extensions:
+        FORMAT_HANDLERS[ext] = handler
+
+def format_reader(name):
+    """注册阅读器的装饰器"""
+    def decorator(func):
+        FORMAT_READERS[name] = func
+        return func
+    return decorator
+
+# 文档格式
+register_format(['.pdf'], 'PDF', 'pdf')
+register_format(['.epub'], 'EPUB', 'epub')
+register_format(['.cbz'], 'CBZ', 'cbz')
+register_format(['.fb2'], 'FB2', 'fb2')
+register_format(['.html', '.htm'], 'HTML', 'html')
+register_format(['.md'], 'MD', 'text', 'markdown')
+register_format(['.txt'], 'TXT', 'text', 'txt')
+register_format(['.json'], 'JSON', 'text', 'text')
+register_format(['.xml'], 'XML', 'text', 'text')
+register_format(['.csv'], 'CSV', 'text', 'text')
+register_format(['.log'], 'LOG', 'text', 'text')
+register_format(['.yaml', '.yml'], 'YAML', 'text', 'text')
+for _ext in ('.ini', '.cfg', '.conf', '.toml'):
+    register_format([_ext], _ext[1:].upper(), 'text', 'text')
+
+# 编程语言（代码高亮）
+register_format(['.py'], 'PY', 'text', 'code', 'python')
+register_format(['.js'], 'JS', 'text', 'code', 'javascript')
+register_format(['.css'], 'CSS', 'text', 'code', 'css')
+register_format(['.java'], 'JAVA', 'text', 'code', 'java')
+register_format(['.cpp'], 'C++', 'text', 'code', 'cpp')
+register_format(['.c'], 'C', 'text', 'code', 'c')
+register_format(['.h'], 'H', 'text', 'code', 'c')
+register_format(['.php'], 'PHP', 'text', 'code', 'php')
+register_format(['.rb'], 'RUBY', 'text', 'code', 'ruby')
+register_format(['.go'], 'GO', 'text', 'code', 'go')
+register_format(['.rs'], 'RUST', 'text', 'code', 'rust')
+register_format(['.swift'], 'SWIFT', 'text', 'code', 'swift')
+register_format(['.kt'], 'KOTLIN', 'text', 'code', 'kotlin')
+register_format(['.scala'], 'SCALA', 'text', 'code', 'scala')
+register_format(['.sh'], 'BASH', 'text', 'code', 'bash')
+register_format(['.bat'], 'BAT', 'text', 'code', 'batch')
+register_format(['.ps1'], 'PS1', 'text', 'code', 'powershell')
+register_format(['.sql'], 'SQL', 'text', 'code', 'sql')
+# 有标签但不在已知文本列表中的扩展名，是否可读按内容判断
+register_format(['.cc', '.cxx'], 'C++')
+register_format(['.hpp'], 'H')
+
+def get_format_handler(filepath):
+    """返回文件对应的FormatHandler；未注册的扩展名返回以扩展名为标签的默认处理"""
     ext = os.path.splitext(filepath)[1].lower()
+    handler = FORMAT_HANDLERS.get(ext)
+    if handler is None:
+        handler = FormatHandler(ext.upper().replace('.', '') if ext else 'FILE')
+    return handler
 
-    # 特殊文件类型
-    if ext == '.pdf':
-        return 'PDF'
-    elif ext == '.epub':
-        return 'EPUB'
-    elif ext == '.cbz':
-        return 'CBZ'
-    elif ext == '.fb2':
-        return 'FB2'
-    elif ext == '.md':
-        return 'MD'
-    elif ext in {'.html', '.htm'}:
-        return 'HTML'
-    elif ext == '.txt':
-        return 'TXT'
-    elif ext == '.json':
-        return 'JSON'
-    elif ext == '.xml':
-        return 'XML'
-    elif ext == '.csv':
-        return 'CSV'
-    elif ext == '.log':
-        return 'LOG'
-
-    # 编程语言
-    elif ext == '.py':
-        return 'PY'
-    elif ext == '.js':
-        return 'JS'
-    elif ext == '.css':
-        return 'CSS'
-    elif ext == '.java':
-        return 'JAVA'
-    elif ext in {'.cpp', '.cc', '.cxx'}:
-        return 'C++'
-    elif ext == '.c':
-        return 'C'
-    elif ext in {'.h', '.hpp'}:
-        return 'H'
-    elif ext == '.php':
-        return 'PHP'
-    elif ext == '.rb':
-        return 'RUBY'
-    elif ext == '.go':
-        return 'GO'
-    elif ext == '.rs':
-        return 'RUST'
-    elif ext == '.swift':
-        return 'SWIFT'
-    elif ext == '.kt':
-        return 'KOTLIN'
-    elif ext == '.scala':
-        return 'SCALA'
-    elif ext == '.sh':
-        return 'BASH'
-    elif ext == '.bat':
-        return 'BAT'
-    elif ext == '.ps1':
-        return 'PS1'
-    elif ext == '.sql':
-        return 'SQL'
-    elif ext in {'.yaml', '.yml'}:
-        return 'YAML'
-
-    # 其他
-    else:
-        return ext.upper().replace('.', '') if ext else 'FILE'
-
-def is_markdown_file(filepath):
-    """判断是否为Markdown文件"""
-    ext = os.path.splitext(filepath)[1].lower()
-    return ext == '.md'
+def get_reader_name(handler, filepath):
+    """确定使用的阅读器；未知格式按内容判断是否为文本，不是文本则返回None（只能下载）"""
+    if handler.reader is not None:
+        return handler.reader
+    return 'text' if is_text_file(filepath) else None
 
 def process_chinese_text(text):
     """处理中文文本，添加段落缩进"""
@@ -328,12 +622,16 @@ def process_chinese_text(text):
 
     return '\n\n'.join(processed_paragraphs)
 
+EPUB_PARSE_CACHE_SIZE = 16
+
 def parse_epub(file_path):
     """解析EPUB文件 - 改进版本，支持更好的排版和内容处理"""
     if not EPUB_SUPPORT:
         return None, "EPUB支持库未安装"
 
     try:
+        import ebooklib
+        from ebooklib import epub
         book = epub.read_epub(file_path)
 
         # Helper function to safely extract metadata
@@ -430,6 +728,13 @@ def parse_epub(file_path):
     except Exception as e:
         return None, f"解析EPUB文件失败: {str(e)}"
 
+@lru_cache(maxsize=EPUB_PARSE_CACHE_SIZE)
+@disk_cached('epub')
+def parse_epub_cached(file_path, mtime):
+    """解析EPUB文件（按路径和修改时间缓存，在解析进程池中执行）"""
+    with record_parse_duration('epub'):
+        return run_document_job(parse_epub, file_path)
+
 def clean_epub_html(html_content):
     """清理和改进EPUB HTML内容"""
     import re
@@ -455,6 +760,370 @@ def clean_epub_html(html_content):
 
     return html_content
 
+# PDF metadata functions
+PDF_TAIL_SIZE = 4096  # 在文件末尾查找startxref的范围
+PDF_HEAD_SIZE = 1024  # 线性化字典必须位于文件开头1KB内
+PDF_READ_CHUNK = 64 * 1024
+PDF_LARGE_FILE_SIZE = 20 * 1024 * 1024  # 超过该大小且未线性化的PDF在列表中提示
+_PDF_WHITESPACE = b' \t\r\n\x0c\x00'
+_PDF_DELIMITERS = b'()<>[]{}/%'
+_PDF_INT_RE = re.compile(rb'[+-]?\d+$')
+_PDF_OBJ_HEADER_RE = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+
+class PDFRef(tuple):
+    """Indirect object reference (object number, generation)."""
+
+def _pdf_skip_whitespace(data, pos):
+    while pos < len(data):
+        if data[pos] in _PDF_WHITESPACE:
+            pos += 1
+        elif data[pos] == 0x25: # '%' comment runs to end of line
+            while pos < len(data) and data[pos] not in b'\r\n':
+                pos += 1
+        else:
+            break
+    return pos
+
+def _pdf_read_token(data, pos):
+    start = pos
+    while pos < len(data) and data[pos] not in _PDF_WHITESPACE and data[pos] not in _PDF_DELIMITERS:
+        pos += 1
+    return data[start:pos], pos
+
+def _pdf_parse_literal_string(data, pos):
+    """Parses a (literal) string starting after the opening parenthesis."""
+    out = bytearray()
+    depth = 1
+    escapes = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f'}
+    while pos < len(data):
+        c = data[pos]
+        pos += 1
+        if c == 0x5c: # backslash
+            c = data[pos]
+            pos += 1
+            if c in escapes:
+                out += escapes[c]
+            elif 0x30 <= c <= 0x37: # Octal escape, up to three digits
+                digits = bytes([c])
+                while len(digits) < 3 and 0x30 <= data[pos] <= 0x37:
+                    digits += bytes([data[pos]])
+                    pos += 1
+                out.append(int(digits, 8) & 0xff)
+            elif c == 0x0d: # Line continuation
+                if data[pos:pos + 1] == b'\n':
+                    pos += 1
+            elif c != 0x0a:
+                out.append(c)
+        elif c == 0x28:
+            depth += 1
+            out.append(c)
+        elif c == 0x29:
+            depth -= 1
+            if depth == 0:
+                return bytes(out), pos
+            out.append(c)
+        else:
+            out.append(c)
+    raise IndexError("Unterminated PDF string")
+
+def _pdf_parse_object(data, pos):
+    """
+    Parses one PDF object at `pos` and returns (value, new_pos).
+    Dictionaries become dicts keyed by name, names become str, strings
+    become bytes and indirect references become PDFRef.
+    """
+    pos = _pdf_skip_whitespace(data, pos)
+    if pos >= len(data):
+        raise IndexError("Unexpected end of PDF data")
+    if data.startswith(b'<<', pos):
+        result = {}
+        pos += 2
+        while True:
+            pos = _pdf_skip_whitespace(data, pos)
+            if data.startswith(b'>>', pos):
+                return result, pos + 2
+            key, pos = _pdf_parse_object(data, pos)
+            result[key], pos = _pdf_parse_object(data, pos)
+    c = data[pos]
+    if c == 0x3c: # <hex string>
+        end = data.find(b'>', pos)
+        if end < 0:
+            raise IndexError("Unterminated PDF hex string")
+        hex_digits = re.sub(rb'\s', b'', data[pos + 1:end])
+        if len(hex_digits) % 2:
+            hex_digits += b'0'
+        return bytes.fromhex(hex_digits.decode('ascii')), end + 1
+    if c == 0x5b: # [array]
+        result = []
+        pos += 1
+        while True:
+            pos = _pdf_skip_whitespace(data, pos)
+            if data[pos] == 0x5d:
+                return result, pos + 1
+            value, pos = _pdf_parse_object(data, pos)
+            result.append(value)
+    if c == 0x28:
+        return _pdf_parse_literal_string(data, pos + 1)
+    if c == 0x2f: # /Name with #xx escapes
+        token, pos = _pdf_read_token(data, pos + 1)
+        name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), token)
+        return name.decode('latin-1'), pos
+
+    token, new_pos = _pdf_read_token(data, pos)
+    if not token:
+        raise ValueError(f"Unexpected PDF delimiter at {pos}")
+    if _PDF_INT_RE.match(token):
+        # An integer may start an indirect reference: "12 0 R"
+        gen_pos = _pdf_skip_whitespace(data, new_pos)
+        gen_token, after_gen = _pdf_read_token(data, gen_pos)
+        if gen_token.isdigit():
+            r_pos = _pdf_skip_whitespace(data, after_gen)
+            r_token, after_r = _pdf_read_token(data, r_pos)
+            if r_token == b'R':
+                return PDFRef((int(token), int(gen_token))), after_r
+        return int(token), new_pos
+    if token == b'true':
+        return True, new_pos
+    if token == b'false':
+        return False, new_pos
+    if token == b'null':
+        return None, new_pos
+    try:
+        return float(token), new_pos
+    except ValueError:
+        return token.decode('latin-1'), new_pos # Keyword such as 'obj' or 'stream'
+
+def _pdf_png_unpredict(data, columns):
+    """Reverses PNG row predictors (used by xref and object streams)."""
+    row_size = columns + 1
+    previous = bytearray(columns)
+    out = bytearray()
+    for row_start in range(0, len(data) - row_size + 1, row_size):
+        filter_type = data[row_start]
+        row = bytearray(data[row_start + 1:row_start + row_size])
+        for i in range(columns):
+            left = row[i - 1] if i else 0
+            up = previous[i]
+            if filter_type == 1:
+                row[i] = (row[i] + left) & 0xff
+            elif filter_type == 2:
+                row[i] = (row[i] + up) & 0xff
+            elif filter_type == 3:
+                row[i] = (row[i] + ((left + up) >> 1)) & 0xff
+            elif filter_type == 4:
+                upper_left = previous[i - 1] if i else 0
+                p = left + up - upper_left
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upper_left)
+                predictor = left if pa <= pb and pa <= pc else (up if pb <= pc else upper_left)
+                row[i] = (row[i] + predictor) & 0xff
+        out += row
+        previous = row
+    return bytes(out)
+
+class PDFMetadataReader:
+    """
+    Reads the trailer, document info and page count of a PDF while touching
+    only the cross-reference data and the few objects that are needed.
+    Supports classic xref tables, xref streams and object streams.
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.xref = {} # object number -> ('offset', offset) or ('objstm', stream number, index)
+        self.trailer = {}
+        self._object_streams = {}
+
+    def read_at(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def resolve(self, value):
+        return self.get_object(value)[0] if isinstance(value, PDFRef) else value
+
+    def load_xref(self):
+        tail = self.read_at(max(0, self.size - PDF_TAIL_SIZE), PDF_TAIL_SIZE)
+        marker = tail.rfind(b'startxref')
+        if marker < 0:
+            raise ValueError("startxref not found")
+        offset, _ = _pdf_parse_object(tail, marker + len(b'startxref'))
+        seen = set()
+        while isinstance(offset, int) and offset not in seen:
+            seen.add(offset)
+            trailer = self._load_xref_section(offset)
+            for key, value in trailer.items(): # Newer trailers take precedence
+                self.trailer.setdefault(key, value)
+            if isinstance(trailer.get('XRefStm'), int): # Hybrid-reference file
+                self._load_xref_section(trailer['XRefStm'])
+            offset = trailer.get('Prev')
+
+    def _add_xref_entry(self, number, entry):
+        self.xref.setdefault(number, entry)
+
+    def _load_xref_section(self, offset):
+        head = self.read_at(offset, 16)
+        if not head.lstrip(_PDF_WHITESPACE).startswith(b'xref'):
+            trailer, stream = self.get_object_at(offset)
+            self._load_xref_stream(trailer, stream)
+            return trailer
+
+        # Classic table: read until the trailer dictionary is complete
+        data = self.read_at(offset, PDF_READ_CHUNK)
+        while True:
+            trailer_pos = data.find(b'trailer')
+            if trailer_pos >= 0:
+                try:
+                    trailer, _ = _pdf_parse_object(data, trailer_pos + len(b'trailer'))
+                    break
+                except IndexError:
+                    pass
+            more = self.read_at(offset + len(data), PDF_READ_CHUNK)
+            if not more:
+                raise ValueError("Incomplete PDF xref table")
+            data += more
+
+        tokens = data[:trailer_pos].split()[1:] # Skip the 'xref' keyword
+        i = 0
+        while i + 1 < len(tokens):
+            start, count = int(tokens[i]), int(tokens[i + 1])
+            i += 2
+            for number in range(start, start + count):
+                entry_offset, _, entry_type = tokens[i:i + 3]
+                i += 3
+                if entry_type == b'n':
+                    self._add_xref_entry(number, ('offset', int(entry_offset)))
+                else:
+                    self._add_xref_entry(number, ('free',))
+        return trailer
+
+    def _load_xref_stream(self, stream_dict, stream):
+        widths = stream_dict['W']
+        index = stream_dict.get('Index', [0, stream_dict['Size']])
+        row_size = sum(widths)
+        pos = 0
+        for start, count in zip(index[0::2], index[1::2]):
+            for number in range(start, start + count):
+                row = stream[pos:pos + row_size]
+                pos += row_size
+                fields = []
+                field_pos = 0
+                for width in widths:
+                    fields.append(int.from_bytes(row[field_pos:field_pos + width], 'big') if width else None)
+                    field_pos += width
+                entry_type = 1 if fields[0] is None else fields[0] # Type defaults to 1 when its width is 0
+                if entry_type == 1:
+                    self._add_xref_entry(number, ('offset', fields[1]))
+                elif entry_type == 2:
+                    self._add_xref_entry(number, ('objstm', fields[1], fields[2]))
+                else:
+                    self._add_xref_entry(number, ('free',))
+
+    def decode_stream(self, stream_dict, raw):
+        filters = stream_dict.get('Filter', [])
+        params = stream_dict.get('DecodeParms') or {}
+        if not isinstance(filters, list):
+            filters = [filters]
+        if isinstance(params, list):
+            params = params[0] if params else {}
+        for name in filters:
+            if name != 'FlateDecode':
+                raise ValueError(f"Unsupported PDF stream filter: {name}")
+            raw = zlib.decompress(raw)
+        predictor = self.resolve(params.get('Predictor', 1)) if params else 1
+        if predictor >= 10:
+            raw = _pdf_png_unpredict(raw, self.resolve(params.get('Columns', 1)))
+        return raw
+
+    def get_object_at(self, offset):
+        """Parses the indirect object at a file offset; returns (value, decoded stream or None)."""
+        data = self.read_at(offset, PDF_READ_CHUNK)
+        header = _PDF_OBJ_HEADER_RE.match(data)
+        if not header:
+            raise ValueError(f"No PDF object at offset {offset}")
+        while True:
+            try:
+                value, pos = _pdf_parse_object(data, header.end())
+                break
+            except IndexError: # Object spans more than what we have read so far
+                more = self.read_at(offset + len(data), PDF_READ_CHUNK)
+                if not more:
+                    raise
+                data += more
+        pos = _pdf_skip_whitespace(data, pos)
+        if not (isinstance(value, dict) and data.startswith(b'stream', pos)):
+            return value, None
+        pos += len(b'stream')
+        pos += 2 if data.startswith(b'\r\n', pos) else 1
+        length = self.resolve(value.get('Length', 0))
+        raw = self.read_at(offset + pos, length)
+        return value, self.decode_stream(value, raw)
+
+    def get_object(self, ref):
+        entry = self.xref.get(ref[0])
+        if entry is None or entry[0] == 'free':
+            return None, None
+        if entry[0] == 'offset':
+            return self.get_object_at(entry[1])
+        stream_number, index = entry[1], entry[2]
+        if stream_number not in self._object_streams:
+            stream_dict, stream = self.get_object(PDFRef((stream_number, 0)))
+            first = stream_dict['First']
+            header = stream[:first].split()
+            offsets = [first + int(header[i]) for i in range(1, len(header), 2)]
+            self._object_streams[stream_number] = (stream, offsets)
+        stream, offsets = self._object_streams[stream_number]
+        return _pdf_parse_object(stream, offsets[index])[0], None
+
+def _decode_pdf_text(value):
+    """Decodes a PDF text string (UTF-16BE with BOM, UTF-8 with BOM, or PDFDocEncoding)."""
+    if not isinstance(value, bytes):
+        return None
+    if value.startswith(b'\xfe\xff'):
+        text = value[2:].decode('utf-16-be', 'ignore')
+    elif value.startswith(b'\xef\xbb\xbf'):
+        text = value[3:].decode('utf-8', 'ignore')
+    else:
+        text = value.decode('latin-1')
+    return text.strip('\x00 ').strip() or None
+
+def get_pdf_metadata(filepath):
+    """读取PDF的标题、作者、页数以及是否线性化（只读取文件头尾和所需对象）"""
+    metadata = {'title': None, 'author': None, 'page_count': None, 'linearized': False}
+    try:
+        size = os.path.getsize(filepath)
+        with open(filepath, 'rb') as f:
+            reader = PDFMetadataReader(f, size)
+
+            # The linearization dictionary must be the first object in the file
+            head = reader.read_at(0, PDF_HEAD_SIZE)
+            first_obj = _PDF_OBJ_HEADER_RE.search(head)
+            if first_obj:
+                try:
+                    lin_dict, _ = _pdf_parse_object(head, first_obj.end())
+                    metadata['linearized'] = (isinstance(lin_dict, dict) and 'Linearized' in lin_dict
+                                              and lin_dict.get('L') == size)
+                except (IndexError, ValueError):
+                    pass
+
+            reader.load_xref()
+            root = reader.resolve(reader.trailer.get('Root'))
+            pages = reader.resolve(root.get('Pages')) if isinstance(root, dict) else None
+            if isinstance(pages, dict):
+                metadata['page_count'] = reader.resolve(pages.get('Count'))
+
+            info = reader.resolve(reader.trailer.get('Info'))
+            if isinstance(info, dict) and 'Encrypt' not in reader.trailer:
+                metadata['title'] = _decode_pdf_text(reader.resolve(info.get('Title')))
+                metadata['author'] = _decode_pdf_text(reader.resolve(info.get('Author')))
+    except Exception as e:
+        logger.warning(f"Error reading PDF metadata for {filepath}: {e}")
+    return metadata
+
+# 文件大小、类型等只需一次stat，直接计算比读写磁盘缓存更快；只有PDF元数据需要解析文件，才在工作进程间共享
+@disk_cached('pdf_metadata')
+def get_pdf_metadata_cached(filepath, mtime):
+    return get_pdf_metadata(filepath)
+
 @app.route('/')
 def index():
     """文件列表页面"""
@@ -556,28 +1225,247 @@ def upload_local_file():
         if not filename:
             return jsonify({'success': False, 'error': '无效的文件名'})
 
-        # 生成唯一的文件名（添加时间戳避免冲突）
-        timestamp = str(int(time.time()))
-        name, ext = os.path.splitext(filename)
-        unique_filename = f"{name}_{timestamp}{ext}"
+        # 临时目录空间不足时先按最近阅读时间淘汰旧文件
+        if enforce_temp_quota(request.content_length or 0) + (request.content_length or 0) > TEMP_QUOTA_BYTES:
+            return jsonify({'success': False, 'error': '服务器临时空间不足，请稍后再试'})
 
-        # 保存文件到临时目录
-        file_path = os.path.join(TEMP_DIR, unique_filename)
-        file.save(file_path)
-
-        # 生成阅读URL（使用特殊前缀标识临时文件）
-        read_url = f"/read?path=__temp__/{unique_filename}"
+        # 保存到临时文件，同时计算内容哈希
+        sha256 = hashlib.sha256()
+        fd, file_path = tempfile.mkstemp(prefix='.upload_', suffix='.part', dir=TEMP_DIR)
+        with os.fdopen(fd, 'wb') as f:
+            for block in iter(lambda: file.stream.read(UPLOAD_STREAM_BUFFER), b''):
+                sha256.update(block)
+                f.write(block)
+        digest = sha256.hexdigest()
+        stored_path = store_upload(file_path, digest, filename)
 
         return jsonify({
             'success': True,
-            'read_url': read_url,
-            'filename': filename
+            'read_url': make_temp_read_url(stored_path),
+            'filename': os.path.basename(stored_path),  # 重复上传时为已有文件的名称
+            'sha256': digest
         })
 
     except Exception as e:
         logger.error(f"Error uploading local file: {e}")
         return jsonify({'success': False, 'error': '文件上传失败'})
 
+# 分块上传（支持断点续传）
+UPLOAD_CHUNK_SIZE = 2 * 1024 * 1024  # 建议客户端使用的分块大小
+UPLOAD_STREAM_BUFFER = 64 * 1024
+_UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def _chunked_upload_paths(upload_id):
+    """返回分块上传的数据文件和状态文件路径"""
+    return (os.path.join(TEMP_DIR, f".upload_{upload_id}.part"),
+            os.path.join(TEMP_DIR, f".upload_{upload_id}.json"))
+
+def _load_chunked_upload(upload_id):
+    if not _UPLOAD_ID_RE.match(upload_id or ''):
+        return None
+    _, state_path = _chunked_upload_paths(upload_id)
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _save_chunked_upload(upload_id, state):
+    _, state_path = _chunked_upload_paths(upload_id)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+def _merge_byte_range(ranges, start, end):
+    """将[start, end)合并进已接收的区间列表"""
+    merged = []
+    for range_start, range_end in sorted(ranges + [[start, end]]):
+        if merged and range_start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], range_end)
+        else:
+            merged.append([range_start, range_end])
+    return merged
+
+def _chunked_upload_status(upload_id, state):
+    received = state['received']
+    next_offset = received[0][1] if received and received[0][0] == 0 else 0
+    return {
+        'success': True,
+        'upload_id': upload_id,
+        'size': state['size'],
+        'chunk_size': UPLOAD_CHUNK_SIZE,
+        'received': received,
+        'next_offset': next_offset,
+        'complete': next_offset >= state['size']
+    }
+
+@app.route('/upload_local_file/exists')
+def upload_exists():
+    """上传前检查：服务器是否已有该SHA-256对应的文件"""
+    digest = (request.args.get('sha256') or '').lower()
+    stored_path = find_stored_upload(digest)
+    if stored_path is None:
+        return jsonify({'success': True, 'exists': False})
+    return jsonify({'success': True, 'exists': True, 'read_url': make_temp_read_url(stored_path),
+                    'filename': os.path.basename(stored_path), 'sha256': digest})
+
+@app.route('/upload_local_file/init', methods=['POST'])
+def upload_chunked_init():
+    """开始分块上传：预先创建目标文件并返回上传ID"""
+    data = request.get_json(silent=True) or {}
+    original_filename = data.get('filename', '')
+    size = data.get('size')
+
+    if not original_filename or not validate_filename(original_filename):
+        return jsonify({'success': False, 'error': '文件名包含不安全字符'})
+    filename = secure_filename(original_filename)
+    if not filename:
+        return jsonify({'success': False, 'error': '无效的文件名'})
+    if not isinstance(size, int) or size < 0 or size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'success': False, 'error': '文件大小无效或超过限制'})
+
+    # 已有相同内容的文件时无需再传输
+    digest = (data.get('sha256') or '').lower()
+    stored_path = find_stored_upload(digest)
+    if stored_path:
+        return jsonify({'success': True, 'exists': True, 'read_url': make_temp_read_url(stored_path),
+                        'filename': os.path.basename(stored_path), 'sha256': digest})
+
+    # 临时目录空间不足时先按最近阅读时间淘汰旧文件
+    if enforce_temp_quota(size) + size > TEMP_QUOTA_BYTES:
+        return jsonify({'success': False, 'error': '服务器临时空间不足，请稍后再试'})
+
+    upload_id = secrets.token_hex(16)
+    part_path, _ = _chunked_upload_paths(upload_id)
+    with open(part_path, 'wb') as f:
+        f.truncate(size)
+    state = {
+        'filename': filename,
+        'size': size,
+        'sha256': digest or None,
+        'received': [],
+        'created': time.time()
+    }
+    _save_chunked_upload(upload_id, state)
+    return jsonify(_chunked_upload_status(upload_id, state))
+
+@app.route('/upload_local_file/<upload_id>/chunk', methods=['PUT', 'POST'])
+def upload_chunked_append(upload_id):
+    """接收一个分块，直接写入目标文件的对应偏移位置"""
+    state = _load_chunked_upload(upload_id)
+    if state is None:
+        return jsonify({'success': False, 'error': '上传任务不存在或已过期'}), 404
+    offset = request.args.get('offset', type=int)
+    if offset is None or offset < 0 or offset > state['size']:
+        return jsonify({'success': False, 'error': '无效的偏移量'}), 400
+
+    part_path, _ = _chunked_upload_paths(upload_id)
+    written = 0
+    try:
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            while True:
+                buffer = request.stream.read(UPLOAD_STREAM_BUFFER)
+                if not buffer:
+                    break
+                if offset + written + len(buffer) > state['size']:
+                    return jsonify({'success': False, 'error': '分块超出文件大小'}), 400
+                f.write(buffer)
+                written += len(buffer)
+    except OSError as e:
+        logger.error(f"Error writing upload chunk {upload_id}@{offset}: {e}")
+        return jsonify({'success': False, 'error': '分块写入失败'}), 500
+
+    # 同一上传的分块可能由不同工作进程接收，状态文件的读改写需跨进程串行
+    with single_flight(('chunked_upload', upload_id)):
+        state = _load_chunked_upload(upload_id)
+        if state is None:
+            return jsonify({'success': False, 'error': '上传任务不存在或已过期'}), 404
+        if written:
+            state['received'] = _merge_byte_range(state['received'], offset, offset + written)
+            _save_chunked_upload(upload_id, state)
+    return jsonify(_chunked_upload_status(upload_id, state))
+
+@app.route('/upload_local_file/<upload_id>/status')
+def upload_chunked_status(upload_id):
+    """查询已接收的字节区间，用于断线后续传"""
+    state = _load_chunked_upload(upload_id)
+    if state is None:
+        return jsonify({'success': False, 'error': '上传任务不存在或已过期'}), 404
+    return jsonify(_chunked_upload_status(upload_id, state))
+
+@app.route('/upload_local_file/<upload_id>/finalize', methods=['POST'])
+def upload_chunked_finalize(upload_id):
+    """完成分块上传：校验完整性和SHA-256后生成阅读链接"""
+    with single_flight(('chunked_upload', upload_id)):
+        state = _load_chunked_upload(upload_id)
+        if state is None:
+            return jsonify({'success': False, 'error': '上传任务不存在或已过期'}), 404
+        status = _chunked_upload_status(upload_id, state)
+        if not status['complete']:
+            return jsonify(dict(status, success=False, error='文件尚未上传完整')), 409
+
+        part_path, state_path = _chunked_upload_paths(upload_id)
+        sha256 = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(UPLOAD_STREAM_BUFFER), b''):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        data = request.get_json(silent=True) or {}
+        expected = (data.get('sha256') or state.get('sha256') or '').lower()
+        if expected and expected != digest:
+            # 数据损坏：丢弃已接收的内容，客户端需要重新上传
+            state['received'] = []
+            _save_chunked_upload(upload_id, state)
+            return jsonify({'success': False, 'error': '文件校验失败，请重新上传', 'sha256': digest}), 422
+
+        stored_path = store_upload(part_path, digest, state['filename'])
+        os.remove(state_path)
+
+    return jsonify({
+        'success': True,
+        'read_url': make_temp_read_url(stored_path),
+        'filename': os.path.basename(stored_path),
+        'sha256': digest
+    })
+
+def render_markdown_file(file_path, encoding='utf-8'):
+    """读取Markdown文件并渲染为HTML（可在解析进程池中执行）"""
+    import markdown
+    with open(file_path, 'r', encoding=encoding) as f:
+        content = f.read()
+
+    # 处理中文段落缩进
+    processed_content = process_chinese_text(content)
+
+    # 配置Markdown扩展，启用代码高亮和表格
+    md = markdown.Markdown(extensions=[
+        'markdown.extensions.extra',
+        'markdown.extensions.codehilite',
+        'markdown.extensions.toc',
+        'markdown.extensions.tables',
+        'markdown.extensions.fenced_code',
+        'markdown.extensions.attr_list'
+    ], extension_configs={
+        'markdown.extensions.codehilite': {
+            'css_class': 'highlight',
+            'use_pygments': True
+        },
+        'markdown.extensions.tables': {
+            'use_align_attribute': True
+        }
+    })
+
+    return md.convert(processed_content)
+
+@lru_cache(maxsize=64)
+@disk_cached('markdown')
+def render_markdown_cached(file_path, mtime, encoding='utf-8'):
+    """渲染Markdown文件（按路径和修改时间缓存）"""
+    with record_parse_duration('markdown'):
+        return run_document_job(render_markdown_file, file_path, encoding)
+
 @app.route('/read')
 def read_file():
     """文件阅读页面"""
@@ -586,14 +1474,10 @@ def read_file():
         if not file_path:
             abort(400)
 
-        # 检查是否为临时文件
-        if file_path.startswith('__temp__/'):
-            # 处理临时文件
-            temp_filename = file_path[9:]  # 移除 '__temp__/' 前缀
-            full_path = os.path.join(TEMP_DIR, temp_filename)
-        else:
-            # 使用安全的路径拼接处理普通文件
-            full_path = safe_path_join(ROOT_DIR, file_path)
+        # 临时文件（__temp__/前缀）和普通文件都使用安全的路径拼接
+        full_path = resolve_read_path(file_path)
+        if file_path.startswith('__temp__/') and os.path.isfile(full_path):
+            record_temp_access(full_path)
 
         if not os.path.exists(full_path):
             logger.warning(f"File not found: {full_path}")
@@ -603,144 +1487,495 @@ def read_file():
             logger.warning(f"Path is not a file: {full_path}")
             abort(400)
 
-        # 检查文件类型并处理
-        if is_pdf_file(full_path):
-            return render_template('pdf_reader.html',
-                                 filename=os.path.basename(file_path),
-                                 file_path=file_path)
-
-        elif is_epub_file(full_path):
-            # 解析EPUB文件
-            epub_data, error = parse_epub(full_path)
-            if epub_data:
-                return render_template('epub_reader.html',
-                                     epub_data=epub_data,
-                                     filename=os.path.basename(file_path),
-                                     file_path=file_path)
-            else:
-                return render_template('epub_reader.html',
-                                     error=error,
-                                     filename=os.path.basename(file_path),
-                                     file_path=file_path)
-
-        elif is_html_file(full_path):
-            # HTML文件在浏览器中渲染
-            try:
-                with open(full_path, 'r', encoding='utf-8') as f:
-                    html_content = f.read()
-            except UnicodeDecodeError:
-                try:
-                    with open(full_path, 'r', encoding='gbk') as f:
-                        html_content = f.read()
-                except:
-                    html_content = "无法读取HTML文件内容"
-            return render_template('html_reader.html',
-                                 html_content=html_content,
-                                 filename=os.path.basename(file_path),
-                                 file_path=file_path)
-
-        # Check for CBZ files using the new structure from get_file_info
-        file_data_for_read_route = get_file_info(full_path) # Get full info
-        if file_data_for_read_route.get('type_label') == 'CBZ' and file_data_for_read_route.get('is_readable_in_app'):
-            image_list = get_cbz_image_list(full_path)
-            if image_list is None: # Error opening CBZ
-                abort(500, description="无法读取CBZ文件内容。")
-            encoded_comic_path = quote(file_path)
-            return render_template('comic_reader.html', 
-                                 filename=os.path.basename(file_path),
-                                 comic_file_path_encoded=encoded_comic_path, 
-                                 image_list=image_list,
-                                 total_pages=len(image_list),
-                                 file_path=file_path) # Pass original file_path for recent reads
-
-        # Fallback for general text files or if not specifically handled above
-        # The original is_text_file(full_path) check is based on extension or basic sniffing
-        if not file_data_for_read_route.get('is_readable_in_app'): # If not any known app-readable type
-             # This condition might now be too broad if is_readable_in_app covers all.
-             # If it's not text, PDF, EPUB, HTML, CBZ, then download.
+        # 按格式注册表分派到对应的阅读器；没有阅读器的文件直接下载
+        handler = get_format_handler(full_path)
+        reader_name = get_reader_name(handler, full_path)
+        if reader_name is None:
             return send_file(full_path, as_attachment=True)
-        
-        # Ensure it's a text file if it reached here and is_readable_in_app was true but not other types
-        if not is_text_file(full_path): 
-            # This case should ideally not be reached if logic is correct,
-            # means is_readable_in_app was true but it's not PDF, EPUB, HTML, CBZ, FB2 or text.
-            logger.warning(f"File {full_path} marked readable but not a known text type, forcing download.")
-            return send_file(full_path, as_attachment=True)
-        
-        if file_data_for_read_route.get('type_label') == 'FB2': # Already checked is_readable_in_app
-            fb2_data, error = parse_fb2(full_path)
-            if error:
-                logger.error(f"FB2 parsing error for {full_path}: {error}")
-                abort(500, description=f"FB2解析错误: {error}")
-            return render_template('fb2_reader.html',
-                                 filename=os.path.basename(file_path),
-                                 file_path=file_path,
-                                 fb2_data=fb2_data)
-
-        # 读取文本文件内容 (This part is now for .txt, .md, .py etc.)
-        content = ""
-        html_content = ""
-        encoding = 'utf-8'
-        file_type = 'text'
+        return render_reader_page(full_path, file_path, handler, reader_name)
 
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in read_file route: {e}")
+        abort(500)
+
+# 渲染结果缓存：阅读页的完整HTML按(模板版本, 文件版本, 阅读器)保存在磁盘上，
+# 再次打开时直接发送缓存文件，不再解析和渲染模板
+RENDER_CACHE_DIR = os.path.join(CACHE_DIR, 'rendered')
+# 阅读页以流的形式渲染：页头和控件随第一块正文立即发出，其余正文按块陆续发送
+STREAM_CHUNK_SIZE = 64 * 1024
+
+def compute_template_version():
+    """所有模板内容的摘要；修改任一模板后旧的渲染结果自动失效"""
+    template_dir = os.path.join(app.root_path, app.template_folder)
+    digest = hashlib.sha1(str(DISK_CACHE_VERSION).encode('utf-8'))
+    for name in sorted(os.listdir(template_dir)):
+        digest.update(name.encode('utf-8'))
+        with open(os.path.join(template_dir, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+TEMPLATE_VERSION = compute_template_version()
+
+def skip_render_cache():
+    """当前阅读页是错误或超时提示，不写入渲染缓存"""
+    g.render_cacheable = False
+
+@app.template_filter('chunks')
+def split_chunks(text, size=STREAM_CHUNK_SIZE):
+    """把长正文切成多段，模板逐段输出，流式响应不必等整段转义和编码"""
+    for start in range(0, len(text), size):
+        yield text[start:start + size]
+
+def stream_rendered_page(chunks, cache_path=None):
+    """
+    把模板流合并成不小于STREAM_CHUNK_SIZE的块发送；给出cache_path时同时写入临时文件，
+    模板完整渲染后才替换为正式缓存文件
+    """
+    tmp_file = None
+    if cache_path:
+        # 流的发送可能与同一线程上的其他请求交错，临时文件名带随机后缀
+        tmp_path = f"{cache_path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            tmp_file = open(tmp_path, 'w', encoding='utf-8')
+        except OSError as e:
+            logger.warning(f"Could not write rendered page cache {cache_path}: {e}")
+    buffer, buffered = [], 0
+    try:
+        for chunk in chunks:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= STREAM_CHUNK_SIZE:
+                data = ''.join(buffer)
+                buffer, buffered = [], 0
+                if tmp_file:
+                    tmp_file.write(data)
+                yield data
+        data = ''.join(buffer)
+        if tmp_file:
+            tmp_file.write(data)
+        if data:
+            yield data
+        if tmp_file:
+            tmp_file.close()
+            os.replace(tmp_path, cache_path)
+    finally:
+        # 客户端中途断开或渲染出错时丢弃临时文件
+        if tmp_file:
+            tmp_file.close()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+def render_reader_page(full_path, file_path, handler, reader_name):
+    """调用阅读器流式渲染页面；结果按文件版本缓存，带强ETag，客户端已有最新版本时返回304"""
+    stat_result = os.stat(full_path)
+    etag = get_resource_etag(stat_result, 'read', TEMPLATE_VERSION, request.script_root, file_path, reader_name)
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
+    cache_path = os.path.join(RENDER_CACHE_DIR, etag[:2], f"{etag}.html")
+    found = os.path.exists(cache_path)
+    record_cache_lookup('rendered_page', 'disk', found)
+    if found:
+        try:
+            response = send_file(cache_path, mimetype='text/html',
+                                 etag=etag, last_modified=stat_result.st_mtime)
+            return apply_cache_validators(response, etag, stat_result)
+        except FileNotFoundError: # 刚被缓存配额清理
+            pass
+
+    # 解析和出错检查在阅读器函数内完成，之后才开始发送；正文在模板渲染过程中按块生成
+    g.render_cacheable = True
+    chunks = FORMAT_READERS[reader_name](full_path, file_path, handler)
+    body = stream_rendered_page(chunks, cache_path if g.render_cacheable else None)
+    if g.get('profiler') is not None:
+        # 被分析的请求在返回前渲染完毕，cProfile结果和Server-Timing的render段才包含模板耗时
+        body = ''.join(body)
+    response = Response(body, mimetype='text/html')
+    return apply_cache_validators(response, etag, stat_result)
+
+@format_reader('pdf')
+def read_pdf(full_path, file_path, handler):
+    return stream_template('pdf_reader.html',
+                         filename=os.path.basename(file_path),
+                         file_path=file_path,
+                         file_version=get_file_version(os.stat(full_path)))
+
+@format_reader('epub')
+def read_epub(full_path, file_path, handler):
+    try:
+        with timing_span('parse', 'EPUB'):
+            epub_data, error = parse_epub_cached(full_path, os.path.getmtime(full_path))
+    except TimeoutError:
+        epub_data, error = None, "解析EPUB文件超时，请稍后重试"
+    if epub_data:
+        return stream_template('epub_reader.html',
+                             epub_data=epub_data,
+                             filename=os.path.basename(file_path),
+                             file_path=file_path)
+    skip_render_cache()
+    return stream_template('epub_reader.html',
+                         error=error,
+                         filename=os.path.basename(file_path),
+                         file_path=file_path)
+
+@format_reader('html')
+def read_html(full_path, file_path, handler):
+    # HTML文件在浏览器中渲染
+    with timing_span('read'):
         try:
             with open(full_path, 'r', encoding='utf-8') as f:
-                content = f.read()
+                html_content = f.read()
         except UnicodeDecodeError:
             try:
                 with open(full_path, 'r', encoding='gbk') as f:
-                    content = f.read()
-                encoding = 'gbk'
+                    html_content = f.read()
             except:
-                content = "无法读取文件内容"
-
-        # 根据文件类型进行不同的处理
-        if content != "无法读取文件内容":
-            if is_markdown_file(full_path):
-                file_type = 'markdown'
-                # 处理中文段落缩进
-                processed_content = process_chinese_text(content)
-
-                # 配置Markdown扩展，启用代码高亮和表格
-                md = markdown.Markdown(extensions=[
-                    'markdown.extensions.extra',
-                    'markdown.extensions.codehilite',
-                    'markdown.extensions.toc',
-                    'markdown.extensions.tables',
-                    'markdown.extensions.fenced_code',
-                    'markdown.extensions.attr_list'
-                ], extension_configs={
-                    'markdown.extensions.codehilite': {
-                        'css_class': 'highlight',
-                        'use_pygments': True
-                    },
-                    'markdown.extensions.tables': {
-                        'use_align_attribute': True
-                    }
-                })
+                html_content = "无法读取HTML文件内容"
+                skip_render_cache()
+    return stream_template('html_reader.html',
+                         html_content=html_content,
+                         filename=os.path.basename(file_path),
+                         file_path=file_path)
+
+@format_reader('cbz')
+def read_cbz(full_path, file_path, handler):
+    with timing_span('index', 'CBZ'):
+        image_list = get_cbz_image_list(full_path)
+    if image_list is None: # Error opening CBZ
+        abort(500, description="无法读取CBZ文件内容。")
+    return stream_template('comic_reader.html',
+                         filename=os.path.basename(file_path),
+                         comic_file_path_encoded=quote(file_path),
+                         image_list=image_list,
+                         total_pages=len(image_list),
+                         comic_version=get_file_version(os.stat(full_path)),
+                         file_path=file_path) # Pass original file_path for recent reads
+
+@format_reader('fb2')
+def read_fb2(full_path, file_path, handler):
+    fb2_stat = os.stat(full_path)
+    try:
+        with timing_span('parse', 'FB2'):
+            fb2_data, error = parse_fb2_cached(full_path, fb2_stat.st_mtime,
+                                               url_for('fb2_image', path=file_path, v=get_file_version(fb2_stat)) + '&id=')
+    except TimeoutError:
+        fb2_data, error = None, "解析超时，请稍后重试"
+    if error:
+        logger.error(f"FB2 parsing error for {full_path}: {error}")
+        abort(500, description=f"FB2解析错误: {error}")
+    return stream_template('fb2_reader.html',
+                         filename=os.path.basename(file_path),
+                         file_path=file_path,
+                         fb2_data=fb2_data)
+
+@format_reader('text')
+def read_text(full_path, file_path, handler):
+    """TXT、Markdown、代码等文本文件；正文在模板渲染时逐块读取"""
+    html_content = ""
+    file_type = handler.text_type or 'text'
+
+    with timing_span('read'):
+        encoding = detect_text_encoding(full_path, os.path.getmtime(full_path))
+
+    if encoding is None:
+        content_chunks = ["无法读取文件内容"]
+        file_type = 'text'
+        skip_render_cache()
+    else:
+        content_chunks = iter_text_file(full_path, encoding)
+    if file_type == 'markdown':
+        try:
+            with timing_span('parse', 'Markdown'):
+                html_content = render_markdown_cached(full_path, os.path.getmtime(full_path), encoding)
+        except TimeoutError:
+            html_content = "<p>Markdown渲染超时，请稍后重试</p>"
+            skip_render_cache()
+    # txt内容不在服务器端修改，保持原始内容用于书签功能；段落缩进在前端JavaScript中处理
+
+    return stream_template('reader.html',
+                         content_chunks=content_chunks,
+                         html_content=html_content,
+                         file_type=file_type,
+                         language=handler.language,
+                         filename=os.path.basename(file_path),
+                         file_path=file_path,
+                         pageable=file_type in PAGED_TEXT_TYPES)
+
+@lru_cache(maxsize=256)
+def detect_text_encoding(full_path, mtime):
+    """依次尝试UTF-8和GBK，逐块解码整个文件检查编码，不把内容留在内存中；都不行时返回None"""
+    for encoding in ('utf-8', 'gbk'):
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(full_path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    decoder.decode(block)
+            decoder.decode(b'', final=True)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    return None
+
+def iter_text_file(full_path, encoding):
+    """按块读取解码后的文本，供流式模板输出"""
+    with open(full_path, 'r', encoding=encoding) as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), ''):
+            yield chunk
+
+# 文本分页：按视口、字号、行高和字宽表在服务器端计算分页位置，
+# 墨水屏浏览器不必测量排版，直接取第N页的文本
+TEXT_PAGES_DIR = os.path.join(CACHE_DIR, 'pages')
+TEXT_PAGE_CACHE_SIZE = 64
+PAGED_TEXT_TYPES = ('txt', 'text')  # Markdown和代码有自己的排版，不参与分页
+PAGE_WIDTH_UNITS = 50  # 字宽表的精度：每个em分为50份
+PAGE_WIDTH_STEP = 10  # 视口宽度向下取整到10px，宁可少排也不溢出，并减少缓存条目
+PAGE_SIZE_RANGE = (200, 4000)  # 视口宽高的有效范围（px）
+PAGE_FONT_SIZE_RANGE = (8, 72)
+PAGE_LINE_HEIGHT_RANGE = (1.0, 3.0)
+PAGE_TAB_SPACES = 8
+# 不能出现在行首的标点，浏览器会把前一个字一起移到下一行
+PAGE_NO_LINE_START = set('，。、；：？！）》」』】〉”’…—,.;:?!)]}')
+
+# Times-Roman标准AFM中ASCII 32(空格)~126(~)的字宽，单位1/1000 em
+_TIMES_ASCII_WIDTHS = (
+    250, 333, 408, 500, 500, 833, 778, 333, 333, 333, 500, 564, 250, 333, 250, 278,
+    500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444,
+    921, 722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889, 722, 722,
+    556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611, 333, 278, 333, 469, 500,
+    333, 444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778, 500, 500,
+    500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444, 480, 200, 480, 541,
+)
+
+class GlyphWidthTable(dict):
+    """
+    字体宽度表，用作str.translate的映射：码位 -> 宽度（chr(单位数)）。
+    ASCII按给定宽度，其余字符按Unicode东亚宽度估算；歧义宽度（如中文引号）按全角计，
+    估宽只会让一行少排几个字，不会溢出。
+    """
 
-                html_content = md.convert(processed_content)
+    def __init__(self, ascii_widths, narrow):
+        super().__init__()
+        self.narrow = narrow
+        for codepoint, width in enumerate(ascii_widths, start=32):
+            self[codepoint] = chr(-(-width * PAGE_WIDTH_UNITS // 1000))  # 向上取整
+        self[ord('\t')] = chr(ord(self[32]) * PAGE_TAB_SPACES)
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        if unicodedata.category(char) in ('Cc', 'Cf', 'Mn', 'Me'):
+            units = 0
+        elif unicodedata.east_asian_width(char) in ('W', 'F', 'A'):
+            units = PAGE_WIDTH_UNITS
+        else:
+            units = self.narrow
+        self[codepoint] = chr(units)
+        return self[codepoint]
+
+# 字体度量方案：serif对应样式表中的Times New Roman + SimSun，
+# halfwidth对应西文也取自中文字体（半角0.5em），mono对应等宽字体
+FONT_METRICS_PROFILES = {
+    'serif': GlyphWidthTable(_TIMES_ASCII_WIDTHS, PAGE_WIDTH_UNITS // 2),
+    'halfwidth': GlyphWidthTable((500,) * len(_TIMES_ASCII_WIDTHS), PAGE_WIDTH_UNITS // 2),
+    'mono': GlyphWidthTable((600,) * len(_TIMES_ASCII_WIDTHS), PAGE_WIDTH_UNITS * 3 // 5),
+}
+
+def _is_word_char(char):
+    return char.isascii() and char.isalnum()
+
+def wrap_text_line(line, table, line_units):
+    """返回一个段落（不含换行符）折行后各行的起始字符位置，规则与 white-space: pre-wrap 一致"""
+    widths = line.translate(table).encode('latin-1')
+    if sum(widths) <= line_units:
+        return [0]
+    cumulative = list(accumulate(widths))
+    starts = [0]
+    start = 0
+    while True:
+        base = cumulative[start - 1] if start else 0
+        end = bisect_right(cumulative, base + line_units, lo=start)
+        if end >= len(line):
+            return starts
+        end = max(end, start + 1) # 每行至少一个字
+        if _is_word_char(line[end - 1]) and _is_word_char(line[end]):
+            # 英文单词不在中间断开，除非整行只有这一个单词
+            space = line.rfind(' ', start, end)
+            if space >= start:
+                end = space + 1
+        elif line[end] in PAGE_NO_LINE_START and end - 1 > start:
+            end -= 1
+        starts.append(end)
+        start = end
+
+def paginate_text(text_path, width, lines_per_page, font_size, profile):
+    """返回每页在文本文件（UTF-8）中的起始字节偏移，最后一项为文件长度"""
+    table = FONT_METRICS_PROFILES[profile]
+    line_units = int(width * PAGE_WIDTH_UNITS / font_size)
+    breaks = [0]
+    used_lines = 0
+    offset = 0
+    with open(text_path, 'rb') as f:
+        for raw_line in f:
+            line = raw_line.decode('utf-8').rstrip('\n')
+            for char_start in wrap_text_line(line, table, line_units):
+                if used_lines == lines_per_page:
+                    breaks.append(offset + len(line[:char_start].encode('utf-8')))
+                    used_lines = 0
+                used_lines += 1
+            offset += len(raw_line)
+    breaks.append(offset)
+    return breaks
+
+def get_paged_text_file(full_path, mtime, text_type):
+    """
+    把文本解码（UTF-8/GBK）并按阅读页相同的规则加段落缩进，存为UTF-8文件。
+    分页偏移基于这个文件，取某一页只需读取对应的字节区间。
+    """
+    digest = hashlib.sha1(repr((DISK_CACHE_VERSION, full_path, mtime, text_type)).encode('utf-8')).hexdigest()
+    text_path = os.path.join(TEXT_PAGES_DIR, digest[:2], f"{digest}.txt")
+    if os.path.exists(text_path):
+        return text_path
+    with single_flight(('paged_text', text_path)):
+        if os.path.exists(text_path):
+            return text_path
+        encoding = detect_text_encoding(full_path, mtime)
+        if encoding is None:
+            raise ValueError(f"Unrecognised text encoding: {full_path}")
+        with open(full_path, 'r', encoding=encoding) as f:
+            content = f.read()
+        if text_type == 'txt':
+            content = process_chinese_text(content)
+        os.makedirs(os.path.dirname(text_path), exist_ok=True)
+        tmp_path = f"{text_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8', newline='\n') as f:
+            f.write(content)
+        os.replace(tmp_path, text_path)
+    return text_path
+
+@lru_cache(maxsize=TEXT_PAGE_CACHE_SIZE)
+@disk_cached('text_pages')
+def get_text_page_breaks(full_path, mtime, text_type, layout):
+    """分页偏移（按文件、修改时间和排版参数缓存，在解析进程池中计算）"""
+    text_path = get_paged_text_file(full_path, mtime, text_type)
+    with record_parse_duration('pagination'):
+        return run_document_job(paginate_text, text_path, *layout)
+
+def parse_page_layout(args):
+    """从请求参数解析排版参数，无效时返回None"""
+    try:
+        width = int(float(args['width']))
+        height = int(float(args['height']))
+        font_size = int(float(args['font_size']))
+        line_height = round(float(args.get('line_height', '1.8')), 2)
+    except (KeyError, ValueError, OverflowError): # int(float('inf')) raises OverflowError
+        return None
+    profile = args.get('profile', 'serif')
+    if profile not in FONT_METRICS_PROFILES:
+        return None
+    if not (PAGE_SIZE_RANGE[0] <= width <= PAGE_SIZE_RANGE[1] and PAGE_SIZE_RANGE[0] <= height <= PAGE_SIZE_RANGE[1]):
+        return None
+    if not (PAGE_FONT_SIZE_RANGE[0] <= font_size <= PAGE_FONT_SIZE_RANGE[1]):
+        return None
+    if not (PAGE_LINE_HEIGHT_RANGE[0] <= line_height <= PAGE_LINE_HEIGHT_RANGE[1]):
+        return None
+    # 高度和行高只决定每页行数，换算成行数后作为缓存键，高度相差不足一行的视口共用分页结果
+    lines_per_page = max(int(height / (font_size * line_height)), 1)
+    return (width - width % PAGE_WIDTH_STEP, lines_per_page, font_size, profile)
 
-            elif is_code_file(full_path):
-                file_type = 'code'
-                language = get_language_from_extension(full_path)
+@app.route('/api/text_page')
+def text_page():
+    """
+    文本分页阅读：返回第page页（或包含字节偏移offset的那一页）的文本。
+    参数 width/height 为正文区域的像素尺寸，font_size 为字号(px)，line_height 为行高倍数，
+    profile 为字体度量方案（serif/halfwidth/mono）。
+    """
+    file_path = request.args.get('path', '')
+    if not file_path:
+        return jsonify({'success': False, 'error': '缺少文件路径'}), 400
 
-            elif full_path.endswith('.txt'):
-                file_type = 'txt'
-                # 不在服务器端修改txt内容，保持原始内容用于书签功能
-                # 段落缩进将在前端JavaScript中处理
+    full_path = resolve_read_path(file_path)
+    if not os.path.isfile(full_path):
+        return jsonify({'success': False, 'error': '文件不存在'}), 404
 
-            return render_template('reader.html',
-                                 content=content,
-                                 html_content=html_content,
-                                 file_type=file_type,
-                                 language=get_language_from_extension(full_path) if is_code_file(full_path) else None,
-                                 filename=os.path.basename(file_path),
-                                 file_path=file_path)
+    handler = get_format_handler(full_path)
+    text_type = handler.text_type or 'text'
+    if get_reader_name(handler, full_path) != 'text' or text_type not in PAGED_TEXT_TYPES:
+        return jsonify({'success': False, 'error': '该文件类型不支持分页'}), 400
 
-    except Exception as e:
-        logger.error(f"Error in read_file route: {e}")
-        abort(500)
+    layout = parse_page_layout(request.args)
+    if layout is None:
+        return jsonify({'success': False, 'error': '分页参数无效'}), 400
+
+    stat_result = os.stat(full_path)
+    try:
+        breaks = get_text_page_breaks(full_path, stat_result.st_mtime, text_type, layout)
+    except TimeoutError:
+        return jsonify({'success': False, 'error': '分页计算超时，请稍后重试'}), 503
+    except (ValueError, OSError) as e:
+        logger.error(f"Error paginating {full_path}: {e}")
+        return jsonify({'success': False, 'error': '无法读取文件内容'}), 500
+
+    page_count = max(len(breaks) - 1, 1)
+    try:
+        if 'offset' in request.args:
+            page = bisect_right(breaks, int(request.args['offset'])) - 1
+        else:
+            page = int(request.args.get('page', '0'))
+    except ValueError:
+        return jsonify({'success': False, 'error': '分页参数无效'}), 400
+    page = min(max(page, 0), page_count - 1)
+
+    etag = get_resource_etag(stat_result, 'text_page', layout, page)
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
+    start, end = breaks[page], breaks[min(page + 1, len(breaks) - 1)]
+    with timing_span('read'):
+        with open(get_paged_text_file(full_path, stat_result.st_mtime, text_type), 'rb') as f:
+            f.seek(start)
+            text = f.read(end - start).decode('utf-8')
+
+    response = jsonify({
+        'success': True,
+        'page': page,
+        'page_count': page_count,
+        'offset': start,
+        'text': text
+    })
+    return apply_cache_validators(response, etag, stat_result)
+
+# 由前端代理发送书库文件：校验路径后只返回响应头，代理负责读取文件、处理Range和慢速客户端，
+# 工作线程立即释放。x-accel 用于 nginx（X-Accel-Redirect 指向 SENDFILE_PREFIX 下的 internal location），
+# x-sendfile 用于 Apache mod_xsendfile、lighttpd 等（X-Sendfile 为文件的绝对路径）
+SENDFILE_MODE = os.environ.get('SENDFILE_MODE', '').lower()
+SENDFILE_PREFIX = '/' + os.environ.get('SENDFILE_PREFIX', '/_protected_files/').strip('/') + '/'
+if SENDFILE_MODE not in ('', 'x-accel', 'x-sendfile'):
+    logger.warning(f"Unknown SENDFILE_MODE {SENDFILE_MODE!r}, serving files from the worker")
+    SENDFILE_MODE = ''
+
+def send_library_file(full_path, stat_result, etag, as_attachment):
+    """发送书库中已校验过路径的文件；启用SENDFILE_MODE时交给前端代理发送"""
+    if not SENDFILE_MODE:
+        response = send_file(full_path, as_attachment=as_attachment, etag=etag, last_modified=stat_result.st_mtime)
+        return apply_cache_validators(response, etag, stat_result)
+
+    # 借用werkzeug生成Content-Type和Content-Disposition，正文留空
+    response = werkzeug_send_file(full_path, request.environ, as_attachment=as_attachment,
+                                  use_x_sendfile=True, conditional=False)
+    del response.headers['X-Sendfile']
+    response.content_length = 0
+    if SENDFILE_MODE == 'x-accel':
+        relative_path = os.path.relpath(full_path, ROOT_DIR).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = SENDFILE_PREFIX + quote(relative_path)
+    else:
+        # WSGI响应头只能是latin-1字符串，中文路径按UTF-8字节原样交给代理
+        response.headers['X-Sendfile'] = os.path.abspath(full_path).encode('utf-8').decode('latin-1')
+    inc_counter('xiningread_sendfile_offloads_total', (('endpoint', request.endpoint),))
+    return apply_cache_validators(response, etag, stat_result)
 
 @app.route('/download')
 def download_file():
@@ -755,10 +1990,16 @@ def download_file():
     if not os.path.abspath(full_path).startswith(os.path.abspath(ROOT_DIR)):
         abort(403)
 
-    if not os.path.exists(full_path):
+    if not os.path.isfile(full_path):
         abort(404)
 
-    return send_file(full_path, as_attachment=True)
+    stat_result = os.stat(full_path)
+    etag = get_resource_etag(stat_result, 'download')
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
+    return send_library_file(full_path, stat_result, etag, as_attachment=True)
 
 @app.route('/view')
 def view_file():
@@ -773,35 +2014,388 @@ def view_file():
     if not os.path.abspath(full_path).startswith(os.path.abspath(ROOT_DIR)):
         abort(403)
 
-    if not os.path.exists(full_path):
+    if not os.path.isfile(full_path):
         abort(404)
 
+    stat_result = os.stat(full_path)
+    etag = get_resource_etag(stat_result, 'view')
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
     # 直接返回文件内容，浏览器会根据MIME类型处理
-    return send_file(full_path, as_attachment=False)
+    return send_library_file(full_path, stat_result, etag, as_attachment=False)
 
 # CBZ related functions
-def get_cbz_image_list(cbz_file_path):
+CBZ_POOL_SIZE = 16  # 同时保持打开的CBZ文件数量
+COMIC_PREFETCH_PAGES = 3  # 每次翻页后在后台预解压的后续页数
+COMIC_PAGE_CACHE_BYTES = 64 * 1024 * 1024  # 已解压漫画页的内存缓存上限
+COMIC_STREAM_CHUNK_SIZE = 64 * 1024  # 流式发送漫画页时的块大小
+ZIP_LOCAL_HEADER_SIZE = 30
+JS_URI_COMPONENT_SAFE = "!'()*"  # Characters encodeURIComponent leaves unescaped beyond quote()'s defaults
+EINK_WIDTH_STEPS = (600, 758, 824, 1072, 1264, 1404, 1680, 1872, 2048)  # 墨水屏派生图宽度档位
+EINK_JPEG_QUALITY = 80
+EINK_BUILD_TIMEOUT = 30  # 秒
+CLIENT_HINT_WIDTH_HEADERS = ('Sec-CH-Width', 'Width', 'Sec-CH-Viewport-Width', 'Viewport-Width')
+CBZ_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+
+class CBZArchive:
+    """
+    An open CBZ archive kept in the handle pool.
+    Holds a name -> ZipInfo index and the sorted page manifest so page
+    requests never rescan the central directory.
+    """
+
+    def __init__(self, cbz_file_path, stat_result):
+        self.path = cbz_file_path
+        self.signature = (stat_result.st_mtime, stat_result.st_size)
+        self.zf = zipfile.ZipFile(cbz_file_path, 'r')
+        self.name_index = {info.filename: info for info in self.zf.infolist()}
+        self.image_list = get_cbz_image_names(self.name_index)
+        self.page_index = {name: i for i, name in enumerate(self.image_list)}
+        self.data_offsets = {} # Stored members: name -> offset of the raw data in the file
+        self.users = 0       # Requests currently reading from this archive
+        self.evicted = False # Removed from the pool; closed once the last user is done
+
+    def read(self, name):
+        """Reads a member by name; raises KeyError if it does not exist."""
+        return self.zf.read(self.name_index[name])
+
+    def is_stored(self, name):
+        return self.name_index[name].compress_type == zipfile.ZIP_STORED
+
+    def get_data_offset(self, name):
+        """
+        Returns the file offset where a member's raw data starts.
+        The local header is read once per member and the result is remembered.
+        """
+        offset = self.data_offsets.get(name)
+        if offset is None:
+            info = self.name_index[name]
+            with open(self.path, 'rb') as f:
+                f.seek(info.header_offset)
+                local_header = f.read(ZIP_LOCAL_HEADER_SIZE)
+            if len(local_header) != ZIP_LOCAL_HEADER_SIZE or not local_header.startswith(b'PK\x03\x04'):
+                raise zipfile.BadZipFile(f"Bad local file header for {name}")
+            name_length, extra_length = struct.unpack('<HH', local_header[26:30])
+            offset = info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+            self.data_offsets[name] = offset
+        return offset
+
+    def close(self):
+        self.zf.close()
+
+_cbz_pool = OrderedDict()  # path -> CBZArchive, least recently used first
+_cbz_pool_lock = threading.Lock()
+
+def _discard_cbz_archive(archive):
+    """Removes an archive from the pool (caller holds _cbz_pool_lock)."""
+    if _cbz_pool.get(archive.path) is archive:
+        del _cbz_pool[archive.path]
+    archive.evicted = True
+    if archive.users == 0:
+        archive.close()
+
+@contextmanager
+def open_cbz(cbz_file_path):
+    """
+    Yields a pooled CBZArchive for the given file, opening it if needed.
+    Archives are reopened when the file's mtime or size changes, and the
+    least recently used archive is closed when the pool is full.
+    """
+    stat_result = os.stat(cbz_file_path)
+    signature = (stat_result.st_mtime, stat_result.st_size)
+
+    with _cbz_pool_lock:
+        archive = _cbz_pool.get(cbz_file_path)
+        if archive is not None and archive.signature != signature:
+            _discard_cbz_archive(archive)
+            archive = None
+        if archive is not None:
+            _cbz_pool.move_to_end(cbz_file_path)
+            archive.users += 1
+    record_cache_lookup('cbz_archive', 'memory', archive is not None)
+
+    if archive is None:
+        # Parse the central directory outside the pool lock so other comics keep being
+        # served; concurrent first opens of the same comic wait for a single parse
+        with single_flight(('cbz', cbz_file_path, signature), cross_process=False):
+            with _cbz_pool_lock:
+                archive = _cbz_pool.get(cbz_file_path)
+                if archive is not None and archive.signature == signature:
+                    _cbz_pool.move_to_end(cbz_file_path)
+                    archive.users += 1
+                else:
+                    archive = None
+            if archive is None:
+                new_archive = CBZArchive(cbz_file_path, stat_result)
+                with _cbz_pool_lock:
+                    old_archive = _cbz_pool.get(cbz_file_path)
+                    if old_archive is not None:
+                        _discard_cbz_archive(old_archive)
+                    archive = new_archive
+                    _cbz_pool[cbz_file_path] = archive
+                    while len(_cbz_pool) > CBZ_POOL_SIZE:
+                        _discard_cbz_archive(next(iter(_cbz_pool.values())))
+                        inc_counter('xiningread_cache_evictions_total', (('cache', 'cbz_archive'),))
+                    archive.users += 1
+
+    try:
+        yield archive
+    finally:
+        with _cbz_pool_lock:
+            archive.users -= 1
+            if archive.evicted and archive.users == 0:
+                archive.close()
+
+_comic_page_cache = OrderedDict()  # (path, signature, name) -> image bytes
+_comic_page_cache_size = 0
+_comic_page_cache_lock = threading.Lock()
+_comic_prefetch_pending = set()  # (path, name) already queued for prefetch
+_comic_prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='comic-prefetch')
+
+def _comic_page_key(archive, name):
+    return (archive.path, archive.signature, name)
+
+def cache_comic_page(key, data):
+    """Stores a decompressed page, evicting least recently used pages beyond the byte budget."""
+    global _comic_page_cache_size
+    if len(data) > COMIC_PAGE_CACHE_BYTES:
+        return
+    with _comic_page_cache_lock:
+        if key in _comic_page_cache:
+            return
+        _comic_page_cache[key] = data
+        _comic_page_cache_size += len(data)
+        while _comic_page_cache_size > COMIC_PAGE_CACHE_BYTES:
+            _, evicted = _comic_page_cache.popitem(last=False)
+            _comic_page_cache_size -= len(evicted)
+            inc_counter('xiningread_cache_evictions_total', (('cache', 'comic_page'),))
+
+def get_cached_comic_page(key, record=True):
+    with _comic_page_cache_lock:
+        data = _comic_page_cache.get(key)
+        if data is not None:
+            _comic_page_cache.move_to_end(key)
+    if record:
+        record_cache_lookup('comic_page', 'memory', data is not None)
+    return data
+
+def read_comic_page(archive, name):
+    """Returns a page's bytes from the memory cache, decompressing it on a miss."""
+    key = _comic_page_key(archive, name)
+    data = get_cached_comic_page(key)
+    if data is None:
+        with single_flight(('comic_page', key), cross_process=False):
+            data = get_cached_comic_page(key, record=False) # Filled in while we waited for another reader
+            if data is None:
+                data = archive.read(name)
+                cache_comic_page(key, data)
+    return data
+
+def _prefetch_comic_pages(cbz_file_path, names):
+    try:
+        with open_cbz(cbz_file_path) as archive:
+            for name in names:
+                read_comic_page(archive, name)
+    except Exception as e:
+        logger.warning(f"Error prefetching pages from {cbz_file_path}: {e}")
+    finally:
+        with _comic_page_cache_lock:
+            _comic_prefetch_pending.difference_update((cbz_file_path, name) for name in names)
+
+def schedule_comic_prefetch(archive, name):
+    """Queues background decompression of the pages following `name`."""
+    index = archive.page_index.get(name)
+    if index is None or COMIC_PREFETCH_PAGES <= 0:
+        return
+    following = archive.image_list[index + 1:index + 1 + COMIC_PREFETCH_PAGES]
+    with _comic_page_cache_lock:
+        # Stored pages are streamed straight from the file, so only compressed ones are worth warming
+        names = [n for n in following
+                 if not archive.is_stored(n)
+                 and _comic_page_key(archive, n) not in _comic_page_cache
+                 and (archive.path, n) not in _comic_prefetch_pending]
+        _comic_prefetch_pending.update((archive.path, n) for n in names)
+    if names:
+        _comic_prefetch_executor.submit(_prefetch_comic_pages, archive.path, names)
+
+class FileRangeReader:
     """
-    Opens a CBZ file and returns a sorted list of image filenames within it.
+    Read-only view of a byte range of a file.
+    Exposes fileno() so WSGI servers with a sendfile-capable file_wrapper
+    can hand the range to the kernel without copying it through Python.
+    """
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def close(self):
+        self._file.close()
+
+def stream_cbz_member(cbz_file_path, name):
+    """Yields a compressed member in chunks as it is decompressed."""
+    with open_cbz(cbz_file_path) as archive:
+        with archive.zf.open(archive.name_index[name]) as member:
+            while True:
+                chunk = member.read(COMIC_STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+def make_stored_member_response(archive, name, mime_type, use_range):
+    """
+    Streams an uncompressed member directly from the archive file,
+    honouring single-range Range requests when use_range is set.
+    """
+    size = archive.name_index[name].file_size
+    start, stop = 0, size
+    if use_range:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            raise RequestedRangeNotSatisfiable(length=size)
+        start, stop = byte_range
+
+    reader = FileRangeReader(archive.path, archive.get_data_offset(name) + start, stop - start)
+    response = Response(wrap_file(request.environ, reader, COMIC_STREAM_CHUNK_SIZE),
+                        mimetype=mime_type, direct_passthrough=True)
+    response.content_length = stop - start
+    response.accept_ranges = 'bytes'
+    if use_range:
+        response.status_code = 206
+        response.content_range = ContentRange('bytes', start, stop, size)
+    return response
+
+# E-ink image derivatives
+_eink_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 2, thread_name_prefix='eink')
+_eink_pending = {}  # derivative path -> Future
+_eink_pending_lock = threading.Lock()
+
+def get_eink_variant():
+    """
+    Returns the (width, grayscale) derivative requested by the client, or None
+    for the original image. Width comes from the `w` query parameter or a
+    width client hint and is rounded up to one of EINK_WIDTH_STEPS.
+    """
+    if not PIL_SUPPORT:
+        return None
+    gray = request.args.get('gray') == '1'
+    width = request.args.get('w', type=int)
+    if width is None:
+        for header in CLIENT_HINT_WIDTH_HEADERS:
+            width = request.headers.get(header, type=int)
+            if width:
+                break
+    if width:
+        width = next((step for step in EINK_WIDTH_STEPS if step >= width), EINK_WIDTH_STEPS[-1])
+    if not width and not gray:
+        return None
+    return (width or None, gray)
+
+def get_eink_derivative_path(archive, name, variant):
+    """Location of a page derivative in the disk cache."""
+    width, gray = variant
+    digest = hashlib.sha1(repr((archive.path, archive.signature, name)).encode('utf-8')).hexdigest()
+    return os.path.join(EINK_CACHE_DIR, digest[:2], f"{digest}_{width or 0}{'_gray' if gray else ''}.jpg")
+
+def build_eink_derivative(image_data, width, gray):
+    """Converts an image to a size-limited (optionally grayscale) JPEG."""
+    from PIL import Image
+    with Image.open(io.BytesIO(image_data)) as img:
+        mode = 'L' if gray else 'RGB'
+        if width:
+            img.draft(mode, (width, width * 4)) # Let the JPEG decoder downscale while decoding
+        converted = img.convert(mode)
+    if width and converted.width > width:
+        converted.thumbnail((width, converted.height), Image.LANCZOS)
+    output = io.BytesIO()
+    converted.save(output, 'JPEG', quality=EINK_JPEG_QUALITY, optimize=True)
+    return output.getvalue()
+
+def _build_eink_derivative_file(cbz_file_path, name, variant, derivative_path):
+    # Other worker processes may be building the same page for another reader
+    with single_flight(('eink', derivative_path)):
+        if os.path.exists(derivative_path):
+            return derivative_path
+        with open_cbz(cbz_file_path) as archive:
+            image_data = read_comic_page(archive, name)
+        derivative = build_eink_derivative(image_data, *variant)
+        os.makedirs(os.path.dirname(derivative_path), exist_ok=True)
+        tmp_path = f"{derivative_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(derivative)
+        os.replace(tmp_path, derivative_path) # Readers never see a partially written file
+    return derivative_path
+
+def _submit_eink_derivative(archive, name, variant):
+    """Queues a derivative build unless it is cached on disk or already in progress."""
+    derivative_path = get_eink_derivative_path(archive, name, variant)
+    if os.path.exists(derivative_path):
+        return None, derivative_path
+    with _eink_pending_lock:
+        future = _eink_pending.get(derivative_path)
+        if future is None:
+            future = _eink_executor.submit(_build_eink_derivative_file, archive.path, name, variant, derivative_path)
+            _eink_pending[derivative_path] = future
+            future.add_done_callback(lambda _: _discard_eink_pending(derivative_path))
+    return future, derivative_path
+
+def _discard_eink_pending(derivative_path):
+    with _eink_pending_lock:
+        _eink_pending.pop(derivative_path, None)
+
+def get_eink_derivative(archive, name, variant):
+    """Returns the path of a page derivative, building it in the worker pool if needed."""
+    future, derivative_path = _submit_eink_derivative(archive, name, variant)
+    if future is not None:
+        future.result(timeout=EINK_BUILD_TIMEOUT)
+    return derivative_path
+
+def schedule_eink_derivatives(archive, name, variant):
+    """Builds derivatives for the pages following `name` in the background."""
+    index = archive.page_index.get(name)
+    if index is None:
+        return
+    for next_name in archive.image_list[index + 1:index + 1 + COMIC_PREFETCH_PAGES]:
+        _submit_eink_derivative(archive, next_name, variant)
+
+def get_cbz_image_names(names):
+    """
+    Returns a sorted list of image filenames from an iterable of archive member names.
     Filters out non-image files and common metadata directories.
     """
+    image_files = []
+    for name in names:
+        # Skip common metadata/directory-like entries from macOS or other tools
+        if name.startswith('__MACOSX/') or name.endswith('/'):
+            continue
+        if name.lower().endswith(CBZ_IMAGE_EXTENSIONS):
+            image_files.append(name)
+
+    # Simple alphanumeric sort, consider natsort for more complex cases if allowed
+    image_files.sort()
+    return image_files
+
+def get_cbz_image_list(cbz_file_path):
+    """
+    Returns the sorted list of image filenames within a CBZ file,
+    using the cached manifest of the pooled archive.
+    """
     try:
-        with zipfile.ZipFile(cbz_file_path, 'r') as zf:
-            name_list = zf.namelist()
-            
-            image_files = []
-            valid_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
-            
-            for name in name_list:
-                # Skip common metadata/directory-like entries from macOS or other tools
-                if name.startswith('__MACOSX/') or name.endswith('/'):
-                    continue
-                if name.lower().endswith(valid_extensions):
-                    image_files.append(name)
-            
-            # Simple alphanumeric sort, consider natsort for more complex cases if allowed
-            image_files.sort() 
-            return image_files
+        with open_cbz(cbz_file_path) as archive:
+            return list(archive.image_list)
     except zipfile.BadZipFile:
         logger.error(f"Bad CBZ file: {cbz_file_path}")
         return None
@@ -833,12 +2427,22 @@ def serve_comic_page(encoded_comic_file_path, image_filename):
             logger.warning(f"Invalid image filename requested: {image_filename_decoded}")
             abort(400)
 
-        with zipfile.ZipFile(full_comic_path, 'r') as zf:
+        # Revalidation is answered from the file's stat alone, without opening the archive
+        stat_result = os.stat(full_comic_path)
+        eink_variant = get_eink_variant()
+        etag = get_resource_etag(stat_result, image_filename_decoded, eink_variant)
+        not_modified = make_not_modified_response(etag, stat_result)
+        if not_modified:
+            if PIL_SUPPORT:
+                not_modified.vary.update(CLIENT_HINT_WIDTH_HEADERS)
+            return not_modified
+
+        with open_cbz(full_comic_path) as archive:
             # Check if the exact image_filename_decoded exists in the archive
-            if image_filename_decoded not in zf.namelist():
+            if image_filename_decoded not in archive.name_index:
                  # Fallback: check if original image_filename (potentially still encoded) exists
                  # This might happen if image_filename itself had characters that got URL encoded
-                 if image_filename in zf.namelist():
+                 if image_filename in archive.name_index:
                     image_filename_to_read = image_filename
                  else:
                     logger.error(f"Image {image_filename_decoded} (or {image_filename}) not found in CBZ {comic_file_rel_path}")
@@ -846,8 +2450,19 @@ def serve_comic_page(encoded_comic_file_path, image_filename):
             else:
                 image_filename_to_read = image_filename_decoded
 
-            image_data = zf.read(image_filename_to_read)
-            
+            derivative_path = None
+            if eink_variant:
+                try:
+                    with timing_span('derive', 'e-ink'):
+                        derivative_path = get_eink_derivative(archive, image_filename_to_read, eink_variant)
+                    schedule_eink_derivatives(archive, image_filename_to_read, eink_variant)
+                except Exception as e:
+                    logger.warning(f"E-ink derivative failed for {image_filename_to_read} in {comic_file_rel_path}: {e}")
+            # 派生图生成失败或超时时回退到原图：使用原图自己的ETag且不缓存，下次请求再尝试派生图
+            eink_fallback = bool(eink_variant) and not derivative_path
+            if eink_fallback:
+                etag = get_resource_etag(stat_result, image_filename_decoded, None)
+
             # Determine MIME type
             mime_type = 'image/jpeg' # Default
             if image_filename_to_read.lower().endswith('.png'):
@@ -856,9 +2471,39 @@ def serve_comic_page(encoded_comic_file_path, image_filename):
                 mime_type = 'image/gif'
             elif image_filename_to_read.lower().endswith('.webp'):
                 mime_type = 'image/webp'
-                
-            return send_file(io.BytesIO(image_data), mimetype=mime_type)
+
+            if derivative_path:
+                response = send_file(derivative_path, mimetype='image/jpeg')
+            else:
+                schedule_comic_prefetch(archive, image_filename_to_read)
+                image_data = get_cached_comic_page(_comic_page_key(archive, image_filename_to_read))
+                if image_data is not None:
+                    response = send_file(io.BytesIO(image_data), mimetype=mime_type)
+                elif archive.is_stored(image_filename_to_read):
+                    response = make_stored_member_response(archive, image_filename_to_read, mime_type,
+                                                           range_request_applies(etag, stat_result))
+                else:
+                    response = Response(stream_cbz_member(archive.path, image_filename_to_read), mimetype=mime_type)
+                    response.content_length = archive.name_index[image_filename_to_read].file_size
+
+            next_page = archive.page_index.get(image_filename_to_read, -1) + 1
+            next_page_name = archive.image_list[next_page] if 0 < next_page < len(archive.image_list) else None
+
+        apply_cache_validators(response, etag, stat_result)
+        if eink_fallback:
+            response.headers['Cache-Control'] = 'no-cache'
+        if PIL_SUPPORT:
+            response.vary.update(CLIENT_HINT_WIDTH_HEADERS)
+        if next_page_name:
+            # Same URL shape as comic_reader.js builds, so the browser can reuse the preloaded response
+            next_page_url = f"/comic_page_data/{quote(comic_file_rel_path)}/{quote(next_page_name, safe=JS_URI_COMPONENT_SAFE)}"
+            if request.query_string:
+                next_page_url += '?' + request.query_string.decode('latin-1')
+            response.headers['Link'] = f'<{next_page_url}>; rel=preload; as=image'
+        return response
             
+    except HTTPException:
+        raise
     except zipfile.BadZipFile:
         logger.error(f"Bad CBZ file encountered while serving page: {comic_file_rel_path}")
         abort(500)
@@ -871,6 +2516,17 @@ def serve_comic_page(encoded_comic_file_path, image_filename):
 
 # FB2 parsing functions
 FB2_NAMESPACE = {'fb': 'http://www.gribuser.ru/xml/fictionbook/2.0'}
+FB2_XLINK_HREF = '{http://www.w3.org/1999/xlink}href'
+FB2_PARSE_CACHE_SIZE = 32
+
+# Inline FB2 tags mapped to their HTML equivalents; anything else is rendered as a plain container.
+_FB2_INLINE_TAGS = {'p': 'p', 'em': 'em', 'strong': 'strong', 'emphasis': 'em',
+                    'strikethrough': 'del', 'sub': 'sub', 'sup': 'sup', 'code': 'code',
+                    'subtitle': 'h4', 'v': 'p', 'text-author': 'p'}
+
+def _fb2_local_name(tag):
+    """Strip the namespace from an ElementTree tag."""
+    return tag.rsplit('}', 1)[-1] if isinstance(tag, str) else ''
 
 def _get_fb2_text(element, path, default=''):
     """Helper to get text from an FB2 element, handling namespaces."""
@@ -879,134 +2535,173 @@ def _get_fb2_text(element, path, default=''):
     found = element.find(path, FB2_NAMESPACE)
     return found.text.strip() if found is not None and found.text else default
 
-def _convert_fb2_node_to_html(node, root_element, binary_cache):
+def _fb2_title_text(node):
+    """Plain-text title of a section, used for the table of contents."""
+    title_node = node.find('fb:title', FB2_NAMESPACE)
+    if title_node is None:
+        return ''
+    return ' '.join(''.join(title_node.itertext()).split())
+
+def _convert_fb2_node_to_html(node, image_base_url):
     """
-    Recursively converts an FB2 body node and its children to HTML.
-    Handles basic tags like p, em, strong, empty-line, and image.
+    Converts an FB2 body node and its children to HTML.
+    Uses an explicit stack instead of recursion so deeply nested sections
+    cannot hit the interpreter recursion limit.
     """
     html_parts = []
-    tag_name = node.tag.replace(f"{{{FB2_NAMESPACE['fb']}}}", "") # Remove namespace for easier handling
-
-    if tag_name == 'p':
-        html_parts.append('<p>')
-        if node.text:
-            html_parts.append(node.text)
-        for child in node:
-            html_parts.append(_convert_fb2_node_to_html(child, root_element, binary_cache))
-            if child.tail: # Text after a child element (within the parent <p>)
-                html_parts.append(child.tail)
-        html_parts.append('</p>')
-    elif tag_name == 'em':
-        html_parts.append('<em>')
-        if node.text: html_parts.append(node.text)
-        for child in node: # em can contain other inlines
-            html_parts.append(_convert_fb2_node_to_html(child, root_element, binary_cache))
-            if child.tail: html_parts.append(child.tail)
-        html_parts.append('</em>')
-    elif tag_name == 'strong':
-        html_parts.append('<strong>')
-        if node.text: html_parts.append(node.text)
-        for child in node:
-            html_parts.append(_convert_fb2_node_to_html(child, root_element, binary_cache))
-            if child.tail: html_parts.append(child.tail)
-        html_parts.append('</strong>')
-    elif tag_name == 'empty-line':
-        html_parts.append('<br>')
-    elif tag_name == 'section':
-        html_parts.append('<div>') # Represent section as a div
-        # Sections can have titles, handle them if needed (e.g., <h3>title</h3>)
-        title_node = node.find('fb:title', FB2_NAMESPACE)
+    stack = [node]
+
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str): # Closing tags and tail text queued earlier
+            html_parts.append(item)
+            continue
+
+        tag_name = _fb2_local_name(item.tag)
+        children = list(item)
+
+        if tag_name == 'empty-line':
+            html_parts.append('<br>')
+            continue
+
+        if tag_name == 'image':
+            href = item.get(FB2_XLINK_HREF, '')
+            if href.startswith('#'):
+                image_id = href[1:]
+                html_parts.append(f'<img src="{escape(image_base_url + quote(image_id))}" alt="Image {escape(image_id)}" '
+                                  f'loading="lazy" style="max-width:100%; height:auto;"/>')
+            continue
+
+        if tag_name == 'section':
+            open_tag, close_tag = '<div>', '</div>'
+            title_node = item.find('fb:title', FB2_NAMESPACE)
+            if title_node is not None:
+                children = [child for child in children if child is not title_node]
+        else:
+            html_tag = _FB2_INLINE_TAGS.get(tag_name)
+            open_tag, close_tag = (f'<{html_tag}>', f'</{html_tag}>') if html_tag else ('', '')
+            title_node = None
+
+        html_parts.append(open_tag)
+        if item.text and title_node is None:
+            html_parts.append(escape(item.text))
+
+        # Queue work in reverse so it pops off the stack in document order
+        stack.append(close_tag)
+        for child in reversed(children):
+            if child.tail:
+                stack.append(escape(child.tail))
+            stack.append(child)
         if title_node is not None:
-            html_parts.append('<h3>')
-            # Title can also have <p> inside, or just text
-            if title_node.find('fb:p', FB2_NAMESPACE) is not None:
-                 for p_node in title_node.findall('fb:p', FB2_NAMESPACE):
-                    html_parts.append(_convert_fb2_node_to_html(p_node, root_element, binary_cache))
+            # Title can have <p> inside, or just text
+            stack.append('</h3>')
+            title_paragraphs = title_node.findall('fb:p', FB2_NAMESPACE)
+            if title_paragraphs:
+                stack.extend(reversed(title_paragraphs))
             elif title_node.text:
-                 html_parts.append(title_node.text)
-            html_parts.append('</h3>')
-
-        for child in node:
-            if child.tag.replace(f"{{{FB2_NAMESPACE['fb']}}}", "") != 'title': # Avoid re-processing title
-                 html_parts.append(_convert_fb2_node_to_html(child, root_element, binary_cache))
-            if child.tail: html_parts.append(child.tail)
-        html_parts.append('</div>')
-    elif tag_name == 'image':
-        href = node.get('{http://www.w3.org/1999/xlink}href', '')
-        if href.startswith('#'):
-            image_id = href[1:]
-            if image_id in binary_cache: # Use cached image data if available
-                img_data_uri = binary_cache[image_id]
-                html_parts.append(f'<img src="{img_data_uri}" alt="Image {image_id}" style="max-width:100%; height:auto;"/>')
-            else: # Find, decode, cache, and use image data
-                binary_node = root_element.find(f".//fb:binary[@id='{image_id}']", FB2_NAMESPACE)
-                if binary_node is not None and binary_node.text:
-                    content_type = binary_node.get('content-type', 'image/jpeg')
-                    try:
-                        decoded_image = base64.b64decode(binary_node.text)
-                        img_data_uri = f"data:{content_type};base64,{base64.b64encode(decoded_image).decode('utf-8')}"
-                        binary_cache[image_id] = img_data_uri # Cache it
-                        html_parts.append(f'<img src="{img_data_uri}" alt="Image {image_id}" style="max-width:100%; height:auto;"/>')
-                    except Exception as e:
-                        logger.error(f"Error decoding base64 image {image_id}: {e}")
-                        html_parts.append(f'[Image {image_id} load error]')
-                else:
-                    html_parts.append(f'[Image {image_id} not found]')
-    elif node.text: # Handle plain text content of current node not covered by above
-        html_parts.append(node.text)
-    
-    # Process tail text for current node if it's not a block element like <p> or <section>
-    # For block elements, their own text content and children's tails are handled within their logic.
-    # if node.tail and tag_name not in ['p', 'section']:
-    #     html_parts.append(node.tail)
+                stack.append(escape(title_node.text))
+            stack.append('<h3>')
 
     return "".join(html_parts)
 
+def _fb2_metadata_from_description(description):
+    """Extract book metadata from the <description> element."""
+    title_info = description.find('fb:title-info', FB2_NAMESPACE) if description is not None else None
+    doc_info = description.find('fb:document-info', FB2_NAMESPACE) if description is not None else None
+
+    metadata = {
+        'genre': [_get_fb2_text(g, '.') for g in title_info.findall('fb:genre', FB2_NAMESPACE)] if title_info is not None else [],
+        'book_title': _get_fb2_text(title_info, 'fb:book-title', '未知标题'),
+        'lang': _get_fb2_text(title_info, 'fb:lang', '未知语言'),
+        'version': _get_fb2_text(doc_info, 'fb:version', ''),
+        'date': _get_fb2_text(doc_info, 'fb:date', '')
+    }
 
-def parse_fb2(fb2_file_path):
+    authors = []
+    if title_info is not None:
+        for author_node in title_info.findall('fb:author', FB2_NAMESPACE):
+            authors.append({
+                'first_name': _get_fb2_text(author_node, 'fb:first-name'),
+                'middle_name': _get_fb2_text(author_node, 'fb:middle-name'),
+                'last_name': _get_fb2_text(author_node, 'fb:last-name'),
+                'nickname': _get_fb2_text(author_node, 'fb:nickname')
+            })
+    metadata['authors'] = authors
+    return metadata
+
+def parse_fb2(fb2_file_path, image_base_url=''):
+    """
+    Streams an FB2 file with iterparse and returns its metadata plus a list of
+    top-level sections, each already converted to HTML.
+    Every element is detached from the tree once handled, so only the section
+    currently being parsed is held in memory. Embedded <binary> images are
+    skipped here and served separately by /fb2_image.
+    """
+    import xml.etree.ElementTree as ET
     try:
-        tree = ET.parse(fb2_file_path)
-        root = tree.getroot()
-        
-        # Register namespace for easier find operations
-        ET.register_namespace('fb', FB2_NAMESPACE['fb'])
-
-        description = root.find('fb:description', FB2_NAMESPACE)
-        title_info = description.find('fb:title-info', FB2_NAMESPACE) if description else None
-        doc_info = description.find('fb:document-info', FB2_NAMESPACE) if description else None
-
-        metadata = {
-            'genre': [_get_fb2_text(g, '.') for g in title_info.findall('fb:genre', FB2_NAMESPACE)] if title_info else [],
-            'book_title': _get_fb2_text(title_info, 'fb:book-title', '未知标题'),
-            'lang': _get_fb2_text(title_info, 'fb:lang', '未知语言'),
-            'version': _get_fb2_text(doc_info, 'fb:version', ''),
-            'date': _get_fb2_text(doc_info, 'fb:date', '')
-        }
-        
-        authors = []
-        if title_info:
-            for author_node in title_info.findall('fb:author', FB2_NAMESPACE):
-                authors.append({
-                    'first_name': _get_fb2_text(author_node, 'fb:first-name'),
-                    'middle_name': _get_fb2_text(author_node, 'fb:middle-name'),
-                    'last_name': _get_fb2_text(author_node, 'fb:last-name'),
-                    'nickname': _get_fb2_text(author_node, 'fb:nickname')
-                })
-        metadata['authors'] = authors
-
-        body_node = root.find('fb:body', FB2_NAMESPACE)
-        html_content_parts = []
-        binary_cache = {} # Cache for decoded images to avoid re-processing
-
-        if body_node is not None:
-            if body_node.text: # Text directly under <body> before first <section>
-                html_content_parts.append(f"<p>{body_node.text}</p>") # Wrap in <p> for consistent spacing
-            for child_node in body_node:
-                html_content_parts.append(_convert_fb2_node_to_html(child_node, root, binary_cache))
-                if child_node.tail: # Text after a section, wrap in <p>
-                    html_content_parts.append(f"<p>{child_node.tail.strip()}</p>")
-        
-        return {'metadata': metadata, 'html_content': "".join(html_content_parts)}, None
+        metadata = _fb2_metadata_from_description(None)
+        sections = []
+        pending_parts = [] # Body content that appears outside any top-level section
+        element_stack = [] # Open elements; whitespace between top-level sections is ignored
+        main_body = None
+        body_done = False
+        last_body_child = None # Its tail is only complete once the next sibling starts or <body> ends
+
+        def flush_body_text():
+            # Loose text directly under <body>: before the first child, or after the previous one
+            text = last_body_child.tail if last_body_child is not None else main_body.text
+            if text and text.strip():
+                pending_parts.append(f"<p>{escape(text.strip())}</p>")
+
+        for event, elem in ET.iterparse(fb2_file_path, events=('start', 'end')):
+            if event == 'start':
+                if main_body is not None and element_stack[-1] is main_body:
+                    flush_body_text()
+                element_stack.append(elem)
+                if main_body is None and not body_done and _fb2_local_name(elem.tag) == 'body':
+                    main_body = elem
+                continue
+
+            element_stack.pop()
+            if not element_stack: # End of the root element
+                continue
+            parent = element_stack[-1]
+            tag_name = _fb2_local_name(elem.tag)
+
+            if len(element_stack) == 1: # Top-level element: description, body or binary
+                if tag_name == 'description':
+                    metadata = _fb2_metadata_from_description(elem)
+                elif elem is main_body:
+                    flush_body_text()
+                    main_body = None
+                    body_done = True
+            elif parent is main_body:
+                last_body_child = elem
+                if tag_name == 'section':
+                    if pending_parts:
+                        sections.append({'id': f"fb2-section-{len(sections)}", 'title': '', 'html': "".join(pending_parts)})
+                        pending_parts = []
+                    sections.append({
+                        'id': f"fb2-section-{len(sections)}",
+                        'title': _fb2_title_text(elem),
+                        'html': _convert_fb2_node_to_html(elem, image_base_url)
+                    })
+                else: # Body-level title, epigraph or image
+                    pending_parts.append(_convert_fb2_node_to_html(elem, image_base_url))
+            elif not (len(element_stack) == 2 and _fb2_local_name(parent.tag) == 'body'):
+                continue # Inside a section still being parsed; it is converted as a whole
+
+            # Detach the finished element so the tree never grows beyond the current section
+            tail = elem.tail # May already be parsed; flush_body_text still needs it
+            elem.clear()
+            elem.tail = tail
+            parent.remove(elem)
+
+        if pending_parts:
+            sections.append({'id': f"fb2-section-{len(sections)}", 'title': '', 'html': "".join(pending_parts)})
+
+        toc = [{'id': section['id'], 'title': section['title']} for section in sections if section['title']]
+        return {'metadata': metadata, 'sections': sections, 'toc': toc}, None
     except ET.ParseError as e:
         logger.error(f"FB2 XML ParseError for {fb2_file_path}: {e}")
         return None, f"XML解析错误: {e}"
@@ -1014,12 +2709,316 @@ def parse_fb2(fb2_file_path):
         logger.error(f"Error parsing FB2 file {fb2_file_path}: {e}")
         return None, f"FB2文件处理失败: {e}"
 
+@lru_cache(maxsize=FB2_PARSE_CACHE_SIZE)
+@disk_cached('fb2')
+def parse_fb2_cached(fb2_file_path, mtime, image_base_url=''):
+    """解析FB2文件（按路径和修改时间缓存，在解析进程池中执行）"""
+    with record_parse_duration('fb2'):
+        return run_document_job(parse_fb2, fb2_file_path, image_base_url)
+
+_FB2_BINARY_OPEN_RE = re.compile(rb'<(?:[\w-]+:)?binary\b([^>]*)>')
+_FB2_BINARY_CLOSE_RE = re.compile(rb'</(?:[\w-]+:)?binary\s*>')
+_FB2_ATTR_RE = re.compile(rb'([\w:-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+
+@lru_cache(maxsize=FB2_PARSE_CACHE_SIZE)
+@disk_cached('fb2_binaries')
+def get_fb2_binary_index(fb2_file_path, mtime):
+    """
+    Scans an FB2 file for <binary> elements and returns
+    {id: (content_type, start_offset, end_offset)} of their base64 payloads.
+    The file is memory-mapped, so the scan does not load it into Python memory.
+    """
+    index = {}
+    with open(fb2_file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return index
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = 0
+            while True:
+                open_match = _FB2_BINARY_OPEN_RE.search(mm, pos)
+                if not open_match:
+                    break
+                close_match = _FB2_BINARY_CLOSE_RE.search(mm, open_match.end())
+                if not close_match:
+                    break
+                attrs = {m.group(1).decode('ascii', 'ignore'): (m.group(2) or m.group(3) or b'').decode('utf-8', 'ignore')
+                         for m in _FB2_ATTR_RE.finditer(open_match.group(1))}
+                if attrs.get('id'):
+                    index[attrs['id']] = (attrs.get('content-type', 'image/jpeg'), open_match.end(), close_match.start())
+                pos = close_match.end()
+    return index
+
+@app.route('/fb2_image')
+def fb2_image():
+    """Serves a single embedded image from an FB2 file."""
+    file_path = request.args.get('path', '')
+    image_id = request.args.get('id', '')
+    if not file_path or not image_id:
+        abort(400)
+
+    full_path = resolve_read_path(file_path)
+    if not os.path.isfile(full_path):
+        abort(404)
+
+    stat_result = os.stat(full_path)
+    etag = get_resource_etag(stat_result, image_id)
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
+    try:
+        binary_index = get_fb2_binary_index(full_path, stat_result.st_mtime)
+        if image_id not in binary_index:
+            abort(404)
+        content_type, start, end = binary_index[image_id]
+        with open(full_path, 'rb') as f:
+            f.seek(start)
+            image_data = base64.b64decode(f.read(end - start))
+        response = send_file(io.BytesIO(image_data), mimetype=content_type)
+        return apply_cache_validators(response, etag, stat_result)
+    except ValueError as e: # binascii.Error is a ValueError
+        logger.error(f"Error decoding base64 image {image_id} in {full_path}: {e}")
+        abort(500)
+
+# 离线阅读清单：Service Worker 按清单把一本书需要的全部URL下载到本地缓存
+OFFLINE_MANIFEST_VERSION = 1  # 资源URL的格式变化时递增，使已下载的书重新下载
+OFFLINE_EMBEDDED_READERS = ('text', 'html', 'epub', 'fb2')  # 阅读页本身包含正文的格式
+OFFLINE_READER_SCRIPTS = {'cbz': ('js/comic_reader.js',)}  # 其他格式的阅读页都使用reader.js
+
+def build_offline_resources(full_path, file_path, reader_name, stat_result):
+    """返回离线阅读所需的[{url, size}]；size为字节数，无法预知时为None"""
+    version = get_file_version(stat_result)
+    page_size = stat_result.st_size if reader_name in OFFLINE_EMBEDDED_READERS else None
+    resources = [{'url': url_for('read_file', path=file_path), 'size': page_size}]
+    for script in OFFLINE_READER_SCRIPTS.get(reader_name, ('js/reader.js',)):
+        resources.append({'url': url_for('static', filename=script), 'size': None})
+
+    if reader_name == 'pdf':
+        resources.append({'url': url_for('view_file', path=file_path, v=version), 'size': stat_result.st_size})
+    elif reader_name == 'cbz':
+        # 与comic_reader.js拼出的URL一致（非墨水屏模式）
+        with open_cbz(full_path) as archive:
+            for name in archive.image_list:
+                url = f"/comic_page_data/{quote(file_path)}/{quote(name, safe=JS_URI_COMPONENT_SAFE)}?v={version}"
+                resources.append({'url': url, 'size': archive.name_index[name].file_size})
+    elif reader_name == 'fb2':
+        # 与parse_fb2生成的<img src>一致
+        image_base_url = url_for('fb2_image', path=file_path, v=version) + '&id='
+        for image_id, (_, start, end) in get_fb2_binary_index(full_path, stat_result.st_mtime).items():
+            resources.append({'url': image_base_url + quote(image_id), 'size': (end - start) * 3 // 4})
+    return resources
+
+@app.route('/api/offline_manifest')
+def offline_manifest():
+    """单本书的离线清单，ETag随文件变化，供Service Worker重新验证"""
+    file_path = request.args.get('path', '')
+    if not file_path:
+        return jsonify({'success': False, 'error': '缺少文件路径'}), 400
+
+    full_path = resolve_read_path(file_path)
+    if not os.path.isfile(full_path):
+        return jsonify({'success': False, 'error': '文件不存在'}), 404
+
+    handler = get_format_handler(full_path)
+    reader_name = get_reader_name(handler, full_path)
+    if reader_name is None:
+        return jsonify({'success': False, 'error': '该文件类型不支持离线阅读'}), 400
+
+    stat_result = os.stat(full_path)
+    etag = get_resource_etag(stat_result, 'offline', OFFLINE_MANIFEST_VERSION)
+    not_modified = make_not_modified_response(etag, stat_result)
+    if not_modified:
+        return not_modified
+
+    try:
+        resources = build_offline_resources(full_path, file_path, reader_name, stat_result)
+    except Exception as e:
+        logger.error(f"Error building offline manifest for {full_path}: {e}")
+        return jsonify({'success': False, 'error': '无法生成离线清单'}), 500
+
+    response = jsonify({
+        'success': True,
+        'path': file_path,
+        'name': os.path.basename(file_path),
+        'format': reader_name,
+        'etag': etag,
+        'total_bytes': sum(r['size'] or 0 for r in resources),
+        'resources': resources
+    })
+    return apply_cache_validators(response, etag, stat_result)
+
 
 @app.route('/favorites')
 def favorites_page():
     """收藏夹页面"""
     return render_template('favorites.html')
 
+# 批量查询文件现状：收藏、最近阅读和自定义书名在浏览器中只保存路径，
+# 渲染列表时一次请求取回所有条目是否还存在以及大小、类型等信息
+STAT_MAX_PATHS = 1000
+
+def stat_library_path(file_path):
+    """单个路径（相对书库，或__temp__/开头的上传文件）的现状；不存在时只返回exists=False"""
+    if not isinstance(file_path, str) or not file_path:
+        return {'exists': False}
+    full_path = resolve_read_path(file_path)
+    try:
+        stat_result = os.stat(full_path)
+    except (OSError, ValueError): # 不存在、无权限或路径含NUL
+        return {'exists': False}
+    if os.path.isdir(full_path):
+        return {'exists': True, 'is_dir': True, 'name': os.path.basename(full_path)}
+    info = dict(get_file_info(full_path))
+    info.update({
+        'exists': True,
+        'is_dir': False,
+        'size_bytes': stat_result.st_size,
+        'mtime': stat_result.st_mtime,
+        'version': get_file_version(stat_result)
+    })
+    return info
+
+@app.route('/api/stat', methods=['POST'])
+def stat_files():
+    """
+    批量文件信息。请求: {"paths": [路径, ...]}
+    响应: {"files": {路径: {"exists", "is_dir", "name", "size", "size_bytes", "type_label", "version", ...}}}
+    """
+    data = request.get_json(silent=True)
+    paths = data.get('paths') if isinstance(data, dict) else None
+    if not isinstance(paths, list):
+        return jsonify({'success': False, 'error': '请求格式无效'}), 400
+    if len(paths) > STAT_MAX_PATHS:
+        return jsonify({'success': False, 'error': '路径数量过多'}), 400
+    if not all(isinstance(path, str) for path in paths):
+        return jsonify({'success': False, 'error': '路径格式无效'}), 400
+
+    with timing_span('stat'):
+        files = {path: stat_library_path(path) for path in dict.fromkeys(paths)}
+    return jsonify({'success': True, 'files': files})
+
+# 阅读数据同步：阅读位置、书签、批注、收藏和最近阅读在浏览器localStorage中按键保存，
+# 这里保存每个键的最新值和修订号，各设备提交自己的改动并取回比自己的修订号更新的改动。
+# 数据按同步ID（请求头 X-Sync-Id，由读者在设置中自选）分开保存，同一ID的设备共享一份数据；
+# 未设置ID的浏览器不参与同步
+DATA_DIR = os.path.join(os.getcwd(), 'data')  # 用户数据，不受缓存配额清理
+SYNC_DB_PATH = os.environ.get('SYNC_DB', os.path.join(DATA_DIR, 'sync.db'))
+SYNC_KEY_PREFIXES = ('readingPosition_', 'bookmark_', 'pagedOffset_', 'xining_annotations_',
+                     'xining_favorites', 'xining_recent_reads', 'xining_user_metadata')
+SYNC_MAX_KEY_LENGTH = 1024
+SYNC_MAX_VALUE_BYTES = 512 * 1024
+SYNC_MAX_BATCH = 500  # 单次请求最多提交/返回的改动数
+SYNC_ID_RE = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+SYNC_MAX_CLOCK_SKEW_MS = 5 * 60 * 1000  # 允许客户端时钟比服务器快多少；更晚的修改时间会永远胜出，因此拒绝
+
+_sync_local = threading.local()
+
+def get_sync_db():
+    """每个线程一个SQLite连接；WAL模式下多个工作进程可以同时读，写入互相排队"""
+    conn = getattr(_sync_local, 'conn', None)
+    if conn is None:
+        os.makedirs(os.path.dirname(SYNC_DB_PATH) or '.', exist_ok=True)
+        conn = sqlite3.connect(SYNC_DB_PATH, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        # 修订号在每个同步ID内单独递增
+        conn.execute('CREATE TABLE IF NOT EXISTS sync_items ('
+                     'sync_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT, rev INTEGER NOT NULL, '
+                     'updated_at INTEGER NOT NULL, PRIMARY KEY (sync_id, key))')
+        conn.execute('CREATE INDEX IF NOT EXISTS sync_items_rev ON sync_items (sync_id, rev)')
+        _sync_local.conn = conn
+    return conn
+
+def validate_sync_change(change):
+    """返回(key, value, updated_at)；value为None表示删除。无效时抛出ValueError"""
+    if not isinstance(change, dict):
+        raise ValueError('改动格式无效')
+    key = change.get('key')
+    value = change.get('value')
+    updated_at = change.get('updated_at')
+    if not isinstance(key, str) or not key.startswith(SYNC_KEY_PREFIXES) or len(key) > SYNC_MAX_KEY_LENGTH:
+        raise ValueError('不支持同步的键')
+    if value is not None and (not isinstance(value, str) or len(value.encode('utf-8')) > SYNC_MAX_VALUE_BYTES):
+        raise ValueError('同步数据过大或格式无效')
+    if not isinstance(updated_at, (int, float)) or isinstance(updated_at, bool):
+        raise ValueError('缺少修改时间')
+    # 同时拒绝NaN/Infinity和超出SQLite整数范围的值
+    if not 0 <= updated_at <= time.time() * 1000 + SYNC_MAX_CLOCK_SKEW_MS:
+        raise ValueError('修改时间无效')
+    return key, value, int(updated_at)
+
+def apply_sync_changes(conn, sync_id, changes, since):
+    """
+    在一个写事务中应用同步ID下的改动并取回since之后的改动。
+    同一个键以客户端的修改时间为准（最后修改者胜出），旧的改动不会覆盖新的。
+    返回(最新修订号, 其他设备的改动列表, 是否还有更多)。
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        rev = conn.execute('SELECT COALESCE(MAX(rev), 0) FROM sync_items WHERE sync_id = ?',
+                           (sync_id,)).fetchone()[0]
+        if since > rev:
+            since = 0 # 服务器数据被重置过，让客户端重新取回全部数据
+        written = {}
+        for key, value, updated_at in changes:
+            row = conn.execute('SELECT updated_at FROM sync_items WHERE sync_id = ? AND key = ?',
+                               (sync_id, key)).fetchone()
+            if row and row[0] > updated_at:
+                continue
+            rev += 1
+            conn.execute('INSERT OR REPLACE INTO sync_items (sync_id, key, value, rev, updated_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (sync_id, key, value, rev, updated_at))
+            written[key] = rev
+        rows = conn.execute('SELECT key, value, rev, updated_at FROM sync_items WHERE sync_id = ? AND rev > ? '
+                            'ORDER BY rev LIMIT ?', (sync_id, since, SYNC_MAX_BATCH + len(written) + 1)).fetchall()
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+    # 客户端已经有自己刚提交的值，不再返回
+    updates = [row for row in rows if written.get(row[0]) != row[2]]
+    more = len(updates) > SYNC_MAX_BATCH
+    if more:
+        updates = updates[:SYNC_MAX_BATCH]
+        rev = updates[-1][2]
+    return rev, [{'key': key, 'value': value, 'rev': row_rev, 'updated_at': updated_at}
+                 for key, value, row_rev, updated_at in updates], more
+
+@app.route('/api/sync', methods=['POST'])
+def sync_changes():
+    """
+    增量同步。请求头 X-Sync-Id 为同步ID（8-64位字母、数字、-或_）。
+    请求: {"since": 修订号, "changes": [{"key", "value"(删除时为null), "updated_at"(毫秒)}]}
+    响应: {"rev": 新修订号, "changes": since之后其他设备的改动, "more": 是否需要继续拉取}
+    """
+    sync_id = request.headers.get('X-Sync-Id', '')
+    if not SYNC_ID_RE.match(sync_id):
+        return jsonify({'success': False, 'error': '同步ID无效'}), 400
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'error': '请求格式无效'}), 400
+    try:
+        since = int(data.get('since') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': '修订号无效'}), 400
+    try:
+        changes = data.get('changes') or []
+        if not isinstance(changes, list) or len(changes) > SYNC_MAX_BATCH:
+            raise ValueError('改动数量过多')
+        changes = [validate_sync_change(change) for change in changes]
+    except (TypeError, ValueError) as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    try:
+        rev, updates, more = apply_sync_changes(get_sync_db(), sync_id, changes, since)
+    except sqlite3.Error as e:
+        logger.error(f"Sync store error: {e}")
+        return jsonify({'success': False, 'error': '同步数据库错误'}), 500
+    inc_counter('xiningread_sync_changes_total', (('direction', 'push'),), len(changes))
+    inc_counter('xiningread_sync_changes_total', (('direction', 'pull'),), len(updates))
+    return jsonify({'success': True, 'rev': rev, 'changes': updates, 'more': more})
+
 
 @app.after_request
 def after_request(response):
@@ -1030,11 +3029,19 @@ def after_request(response):
     response.headers['X-XSS-Protection'] = '1; mode=block'
 
     # 缓存控制
-    if request.endpoint == 'static':
+    if request.endpoint == 'static' and request.view_args.get('filename') == 'sw.js':
+        # Service Worker 位于 /static/ 下但控制整个站点，且必须能及时更新
+        response.headers['Service-Worker-Allowed'] = '/'
+        response.headers['Cache-Control'] = 'no-cache'
+    elif request.endpoint == 'static':
         response.headers['Cache-Control'] = 'public, max-age=31536000'  # 1年
     elif request.endpoint in ['index', 'read_file']:
         response.headers['Cache-Control'] = 'no-cache, must-revalidate'
 
+    # 请求客户端在后续图片请求中附带宽度提示，用于选择墨水屏派生图
+    if request.endpoint == 'read_file' and PIL_SUPPORT:
+        response.headers['Accept-CH'] = ', '.join(CLIENT_HINT_WIDTH_HEADERS)
+
     return response
 
 @app.errorhandler(404)
@@ -1058,28 +3065,479 @@ def internal_error(error):
                          error_code=500,
                          error_message="服务器内部错误"), 500
 
+# /metrics：多进程部署时，各工作进程定期把自己的指标快照写入METRICS_DIR，
+# 抓取时合并所有存活进程的快照
+METRICS_DIR = os.path.join(CACHE_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 10  # 秒
+
+_requests_in_flight = 0
+_metrics_flusher_started = False
+
+@app.before_request
+def start_request_metrics():
+    global _requests_in_flight
+    g.request_start = time.perf_counter()
+    with _metrics_lock:
+        _requests_in_flight += 1
+
+def _count_response_bytes(iterable, sent):
+    """逐块转发响应体并累计实际发送的字节数"""
+    try:
+        for chunk in iterable:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            sent[0] += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    labels = (('endpoint', request.endpoint or 'unknown'),)
+    code = str(response.status_code)  # 回调不引用response本身，避免循环引用推迟流式生成器的关闭
+    sent = [response.content_length or 0]
+    if response.content_length is None and response.is_streamed and not response.direct_passthrough:
+        # 流式响应没有Content-Length，发送时再计数
+        response.response = _count_response_bytes(response.response, sent)
+
+    def record():
+        # 响应体发送完毕（或客户端断开）后调用，耗时包含流式输出的时间
+        observe_histogram('xiningread_request_duration_seconds', labels, time.perf_counter() - start)
+        inc_counter('xiningread_requests_total', labels + (('code', code),))
+        if sent[0]:
+            inc_counter('xiningread_response_bytes_total', labels, sent[0])
+    if response.direct_passthrough:
+        # 文件包装器原样交给服务器（可能用sendfile发送），Werkzeug不会为它调用close回调，只能在此记录
+        record()
+    else:
+        response.call_on_close(record)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    global _requests_in_flight
+    if g.get('request_start') is not None:
+        with _metrics_lock:
+            _requests_in_flight -= 1
+
+def _lru_cache_functions():
+    return {
+        'file_info': get_file_info_cached,
+        'epub': parse_epub_cached,
+        'fb2': parse_fb2_cached,
+        'fb2_binaries': get_fb2_binary_index,
+        'markdown': render_markdown_cached,
+        'text_pages': get_text_page_breaks,
+        'text_encoding': detect_text_encoding,
+    }
+
+def metrics_snapshot():
+    """当前进程的指标快照（可JSON序列化）"""
+    with _metrics_lock:
+        counters = [[name, labels, value] for (name, labels), value in _metric_counters.items()]
+        histograms = [[name, labels, list(values)] for (name, labels), values in _metric_histograms.items()]
+        gauges = [['xiningread_requests_in_flight', (), _requests_in_flight]]
+    # lru_cache自带统计，抓取时换算成计数器；淘汰数按 未命中数 - 当前条目数 估算
+    for cache_name, func in _lru_cache_functions().items():
+        info = func.cache_info()
+        for result, value in (('hit', info.hits), ('miss', info.misses)):
+            counters.append(['xiningread_cache_requests_total',
+                             (('cache', cache_name), ('tier', 'memory'), ('result', result)), value])
+        counters.append(['xiningread_cache_evictions_total', (('cache', cache_name),),
+                         max(info.misses - info.currsize, 0)])
+    gauges.append(['xiningread_comic_page_cache_bytes', (), _comic_page_cache_size])
+    return {'pid': os.getpid(), 'counters': counters, 'histograms': histograms,
+            'gauges': gauges, 'temp_usage': dict(_temp_usage)}
+
+def _flush_metrics_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = os.path.join(METRICS_DIR, f"{os.getpid()}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(metrics_snapshot(), f)
+    os.replace(tmp_path, path)
+
+def _metrics_flusher_loop():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            _flush_metrics_snapshot()
+        except Exception as e:
+            logger.warning(f"Could not write metrics snapshot: {e}")
+
+def start_metrics_flusher():
+    global _metrics_flusher_started
+    if _metrics_flusher_started:
+        return
+    _metrics_flusher_started = True
+    threading.Thread(target=_metrics_flusher_loop, name='metrics-flusher', daemon=True).start()
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass # 进程存在但无权限发信号
+    return True
+
+def _collect_metrics_snapshots():
+    """本进程的实时快照加上其他存活工作进程最近写入的快照；已退出进程的快照文件会被删除"""
+    snapshots = [metrics_snapshot()]
+    if not os.path.isdir(METRICS_DIR):
+        return snapshots
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json'):
+            continue
+        path = os.path.join(METRICS_DIR, filename)
+        try:
+            pid = int(filename[:-len('.json')])
+        except ValueError:
+            continue
+        if pid == os.getpid():
+            continue
+        if not _process_alive(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+def _format_labels(labels, extra=()):
+    pairs = [tuple(pair) for pair in labels] + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+def render_metrics(snapshots):
+    """合并多个进程的快照并输出Prometheus文本格式"""
+    counters, gauges, histograms = {}, {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot['gauges']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            gauges[key] = gauges.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+
+    temp_usage = merge_temp_usage(snapshots)
+    gauges[('xiningread_temp_used_bytes', ())] = temp_usage['used_bytes']
+    gauges[('xiningread_temp_entries', ())] = temp_usage['entries']
+    gauges[('xiningread_temp_quota_bytes', ())] = TEMP_QUOTA_BYTES
+    counters[('xiningread_cache_evictions_total', (('cache', 'temp_uploads'),))] = temp_usage['evicted']
+
+    lines = []
+    declared = set()
+    def declare(name, metric_type):
+        if name not in declared:
+            declared.add(name)
+            lines.append(f"# TYPE {name} {metric_type}")
+
+    for (name, labels), value in sorted(counters.items()):
+        declare(name, 'counter')
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in sorted(gauges.items()):
+        declare(name, 'gauge')
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), values in sorted(histograms.items()):
+        declare(name, 'histogram')
+        cumulative = 0
+        for bound, count in zip(METRICS_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {values[-1]}")
+        lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+# 每个请求的Server-Timing和可选的cProfile分析
+# 设置PROFILE_TOKEN后，带 ?profile=<token> 的请求会被分析，结果保存到PROFILE_DIR，
+# 可用 python -m pstats 或 snakeviz 打开
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_DIR = os.path.join(CACHE_DIR, 'profiles')
+
+def _record_render_start(sender, template, context, **extra):
+    g.template_render_start = time.perf_counter()
+
+def _record_render_end(sender, template, context, **extra):
+    start = g.pop('template_render_start', None)
+    if start is not None:
+        # 流式渲染的阅读页在响应头发出后才结束，耗时只能记录在指标中（含等待客户端接收的时间）
+        seconds = time.perf_counter() - start
+        add_server_timing('render', seconds, template.name)
+        observe_histogram('xiningread_template_render_seconds', (('template', template.name),), seconds)
+
+before_render_template.connect(_record_render_start, app)
+template_rendered.connect(_record_render_end, app)
+
+@app.before_request
+def start_request_profiler():
+    token = request.args.get('profile')
+    if PROFILE_TOKEN and token and secrets.compare_digest(token, PROFILE_TOKEN):
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+@app.after_request
+def add_server_timing_header(response):
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profile_name = f"{time.strftime('%Y%m%d-%H%M%S')}-{request.endpoint or 'unknown'}-{secrets.token_hex(4)}.prof"
+        profiler.dump_stats(os.path.join(PROFILE_DIR, profile_name))
+        response.headers['X-Profile-File'] = profile_name
+        logger.info(f"Saved request profile {profile_name}")
+
+    start = g.get('request_start')
+    if SERVER_TIMING_ENABLED and start is not None and request.endpoint != 'static':
+        spans = g.get('server_timings', [])
+        entries = []
+        for name, seconds, desc in spans + [('total', time.perf_counter() - start, None)]:
+            entry = f"{name};dur={seconds * 1000:.1f}"
+            if desc:
+                entry += f';desc="{desc}"'
+            entries.append(entry)
+        response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus指标"""
+    return Response(render_metrics(_collect_metrics_snapshots()),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# 临时目录治理：按配额和时间清理上传文件
+TEMP_QUOTA_BYTES = int(os.environ.get('TEMP_QUOTA_MB', '2048')) * 1024 * 1024
+TEMP_MAX_AGE = float(os.environ.get('TEMP_MAX_AGE_HOURS', '24')) * 3600
+TEMP_GOVERNOR_INTERVAL = int(os.environ.get('TEMP_GOVERNOR_INTERVAL', '300'))  # 秒
+TEMP_ACCESS_TOUCH_INTERVAL = 60  # 同一文件的访问时间最多每分钟刷新一次
+CACHE_QUOTA_BYTES = int(os.environ.get('CACHE_QUOTA_MB', '1024')) * 1024 * 1024
+
+_temp_access_times = {}  # TEMP_DIR下的条目名 -> 最近阅读时间
+_temp_usage = {'used_bytes': 0, 'entries': 0, 'evicted': 0, 'last_run': None}
+_temp_governor_lock = threading.Lock()
+_temp_governor_started = False
+
+def record_temp_access(full_path):
+    """记录临时文件的阅读时间（/read?path=__temp__/…时调用）"""
+    relative = os.path.relpath(full_path, TEMP_DIR)
+    entry = relative.split(os.sep, 1)[0]
+    if entry.startswith('..'):
+        return
+    now = time.time()
+    if now - _temp_access_times.get(entry, 0) < TEMP_ACCESS_TOUCH_INTERVAL:
+        return
+    _temp_access_times[entry] = now
+    entry_path = os.path.join(TEMP_DIR, entry)
+    if os.path.isdir(entry_path):
+        # 目录时间在多进程间共享且重启后仍有效；不修改文件本身，以免派生缓存失效
+        try:
+            os.utime(entry_path)
+        except OSError:
+            pass
+
+def _scan_temp_entries():
+    """列出TEMP_DIR下的条目：(名称, 路径, 字节数, 最近访问时间, 是否为进行中的上传)"""
+    entries = []
+    for name in os.listdir(TEMP_DIR):
+        if name == '.governor.lock':
+            continue
+        path = os.path.join(TEMP_DIR, name)
+        try:
+            stat_result = os.stat(path)
+            size = stat_result.st_size
+            if os.path.isdir(path):
+                size = 0
+                for dirpath, _, filenames in os.walk(path):
+                    for filename in filenames:
+                        size += os.path.getsize(os.path.join(dirpath, filename))
+        except OSError:
+            continue
+        last_access = max(stat_result.st_mtime, _temp_access_times.get(name, 0))
+        entries.append((name, path, size, last_access, name.startswith('.upload_')))
+    return entries
+
+def _remove_temp_entry(name, path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        os.remove(path)
+    _temp_access_times.pop(name, None)
+
+def enforce_temp_quota(extra_bytes=0):
+    """
+    删除超过保留时间的临时文件，并在总大小超过配额时按最近阅读时间
+    从旧到新淘汰，直到能容纳extra_bytes。进行中的分块上传只按时间清理。
+    返回清理后的占用字节数。
+    """
+    if extra_bytes > TEMP_QUOTA_BYTES:
+        extra_bytes = 0 # Can never fit; don't evict other uploads for it
+    with _temp_governor_lock:
+        now = time.time()
+        kept = []
+        evicted = 0
+        for name, path, size, last_access, is_upload in _scan_temp_entries():
+            if now - last_access > TEMP_MAX_AGE:
+                try:
+                    _remove_temp_entry(name, path)
+                    evicted += 1
+                    logger.info(f"Cleaned up old temp file: {name}")
+                except OSError as e:
+                    logger.error(f"Error removing temp file {name}: {e}")
+                    kept.append((name, path, size, last_access, is_upload))
+            else:
+                kept.append((name, path, size, last_access, is_upload))
+
+        used = sum(entry[2] for entry in kept)
+        remaining = len(kept)
+        for name, path, size, last_access, is_upload in sorted(kept, key=lambda entry: entry[3]):
+            if used + extra_bytes <= TEMP_QUOTA_BYTES:
+                break
+            if is_upload:
+                continue
+            try:
+                _remove_temp_entry(name, path)
+                used -= size
+                remaining -= 1
+                evicted += 1
+                logger.info(f"Evicted temp file over quota: {name} ({size} bytes)")
+            except OSError as e:
+                logger.error(f"Error evicting temp file {name}: {e}")
+
+        _temp_usage.update({
+            'used_bytes': used,
+            'entries': remaining,
+            'evicted': _temp_usage['evicted'] + evicted,
+            'last_run': now
+        })
+        return used
+
 def cleanup_old_temp_files():
-    """清理超过24小时的临时文件"""
+    """清理超过保留时间的临时文件，并执行配额检查"""
     try:
-        current_time = time.time()
-        for filename in os.listdir(TEMP_DIR):
-            file_path = os.path.join(TEMP_DIR, filename)
-            if os.path.isfile(file_path):
-                # 检查文件修改时间
-                file_mtime = os.path.getmtime(file_path)
-                if current_time - file_mtime > 24 * 3600:  # 24小时
-                    os.remove(file_path)
-                    logger.info(f"Cleaned up old temp file: {filename}")
+        enforce_temp_quota()
     except Exception as e:
         logger.error(f"Error cleaning up temp files: {e}")
 
-if __name__ == '__main__':
-    # 确保目录存在
+# 可按配额淘汰的派生数据目录；cache/下的指标快照(metrics)和性能分析结果(profiles)不参与淘汰
+CACHE_EVICTABLE_DIRS = (DISK_CACHE_DIR, RENDER_CACHE_DIR, EINK_CACHE_DIR, TEXT_PAGES_DIR)
+
+def _sweep_stale_lock_files(now):
+    """锁文件不占空间，只清理早已不可能被持有的"""
+    if not os.path.isdir(SINGLE_FLIGHT_LOCK_DIR):
+        return
+    for filename in os.listdir(SINGLE_FLIGHT_LOCK_DIR):
+        path = os.path.join(SINGLE_FLIGHT_LOCK_DIR, filename)
+        try:
+            if now - os.stat(path).st_mtime > SINGLE_FLIGHT_LOCK_MAX_AGE:
+                os.remove(path)
+        except OSError:
+            pass
+
+def enforce_cache_quota():
+    """派生数据缓存超过配额时，按最近使用时间删除最旧的缓存文件"""
+    entries = []
+    now = time.time()
+    _sweep_stale_lock_files(now)
+    for cache_dir in CACHE_EVICTABLE_DIRS:
+        for dirpath, _, filenames in os.walk(cache_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((max(stat_result.st_atime, stat_result.st_mtime), stat_result.st_size, path))
+    used = sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if used <= CACHE_QUOTA_BYTES:
+            break
+        try:
+            os.remove(path)
+            used -= size
+        except OSError:
+            pass
+    return used
+
+@contextmanager
+def _governor_process_lock():
+    """多个工作进程中只让一个执行周期清理；拿不到锁时返回False"""
+    if fcntl is None:
+        yield True
+        return
+    with open(os.path.join(TEMP_DIR, '.governor.lock'), 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def _temp_governor_loop():
+    while True:
+        with _governor_process_lock() as acquired:
+            if acquired:
+                cleanup_old_temp_files()
+                try:
+                    enforce_cache_quota()
+                except Exception as e:
+                    logger.error(f"Error enforcing cache quota: {e}")
+        time.sleep(TEMP_GOVERNOR_INTERVAL)
+
+def start_temp_governor():
+    """启动后台清理线程（每个进程只启动一次）"""
+    global _temp_governor_started
+    if _temp_governor_started:
+        return
+    _temp_governor_started = True
+    threading.Thread(target=_temp_governor_loop, name='temp-governor', daemon=True).start()
+
+def merge_temp_usage(snapshots):
+    """临时目录占用：大小和条目数直接扫描磁盘，淘汰数和最近清理时间合并各进程的快照"""
+    entries = _scan_temp_entries() if os.path.isdir(TEMP_DIR) else []
+    runs = [s['temp_usage']['last_run'] for s in snapshots if s['temp_usage'].get('last_run')]
+    return {
+        'used_bytes': sum(entry[2] for entry in entries),
+        'entries': len(entries),
+        'evicted': sum(s['temp_usage']['evicted'] for s in snapshots),
+        'last_run': max(runs) if runs else None
+    }
+
+@app.route('/api/temp_usage')
+def temp_usage():
+    """当前临时目录占用情况（所有工作进程）"""
+    usage = merge_temp_usage(_collect_metrics_snapshots())
+    return jsonify(dict(usage, quota_bytes=TEMP_QUOTA_BYTES, max_age_seconds=TEMP_MAX_AGE))
+
+def prepare_runtime():
+    """创建运行所需目录并启动后台任务（开发服务器和生产工作进程共用）"""
     os.makedirs(ROOT_DIR, exist_ok=True)
     os.makedirs(TEMP_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    start_temp_governor()
+    start_metrics_flusher()
 
-    # 清理旧的临时文件
-    cleanup_old_temp_files()
+if __name__ == '__main__':
+    # 开发模式；生产环境请使用 gunicorn -c gunicorn.conf.py app:app
+    prepare_runtime()
 
     logger.info(f"Starting server with ROOT_DIR: {ROOT_DIR}")
     logger.info(f"Temp directory: {TEMP_DIR}")
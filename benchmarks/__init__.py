@@ -0,0 +1 @@
+"""希宁阅读性能基准测试：合成书库生成器和基准测试套件"""
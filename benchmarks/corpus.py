@@ -0,0 +1,262 @@
+"""
+合成书库生成器
+
+按固定随机种子生成基准测试用的文件，相同的(seed, scale)总是得到相同的内容：
+    big_gbk.txt        100 MB 的GBK编码TXT
+    book_500ch.epub    500章的EPUB
+    images_200.fb2     内嵌200张图片的FB2
+    comic_1000.cbz     1000页的CBZ（奇数页存储、偶数页压缩）
+    library_20k/       20000个文件的目录
+    code_5mb.md        5 MB 含代码块的Markdown
+
+scale 只缩放文件体积（文本长度、图片尺寸），章节数、图片数、页数和文件数保持不变。
+用法: python -m benchmarks.corpus <目录> [--scale 0.1]
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import struct
+import zipfile
+import zlib
+
+CORPUS_VERSION = 1
+DEFAULT_SEED = 20240601
+MANIFEST_NAME = 'corpus.json'
+
+TXT_NAME = 'big_gbk.txt'
+EPUB_NAME = 'book_500ch.epub'
+FB2_NAME = 'images_200.fb2'
+CBZ_NAME = 'comic_1000.cbz'
+LIBRARY_DIR = 'library_20k'
+MARKDOWN_NAME = 'code_5mb.md'
+
+TXT_BYTES = 100 * 1024 * 1024
+EPUB_CHAPTERS = 500
+EPUB_CHAPTER_CHARS = 6000
+FB2_IMAGES = 200
+CBZ_PAGES = 1000
+LIBRARY_FILES = 20000
+MARKDOWN_BYTES = 5 * 1024 * 1024
+
+# ZIP成员使用固定时间戳，保证生成的文件逐字节一致
+ZIP_DATE_TIME = (2024, 1, 1, 0, 0, 0)
+
+# 常用汉字（均可用GBK编码）
+HANZI = ("的一是了我不人在他有这个上们来到时大地为子中你说生国年着就那和要她出也得里后自以会家可下而过天去能对小多然于心学么之都好看起发当没成只如事把还用第样道想作种开美总从无情己面最女但现前些所同日手又行意动方期它头经长儿回位分爱老因很给名法间斯知世什两次使身者被高已亲其进此话常与活正感"
+         "见明问力理尔点文几定本公特做外孩相西果走将月十实向声车全信重三机工物气每并别真打太新比才便夫再书部水像眼等体却加电主界门利海受听表德少克代员许稳先口由死安写性马光白或住难望教命花结乐色更拉东神记处让母父应直字场平报友关放至张认接告入笑内英军候民岁往何度山觉路带万男边风解叫任金快原吃妈变通师立象数四失满战远格士音轻目条呢病始达深完今提求清王化空业思切怎非找片罗钱南语元喜曾离飞科言干流欢约各即指合反题必该论交终林请医晚制球决传画保读运及则房早院量苦火布品近坐产答星精视五连司巴")
+PUNCTUATION = "，。，，、；！？"
+
+CODE_SNIPPET_LINES = [
+    "def read_chapter(path, index):",
+    "    with open(path, 'rb') as f:",
+    "        f.seek(index * CHUNK_SIZE)",
+    "        data = f.read(CHUNK_SIZE)",
+    "    return data.decode('utf-8', errors='replace')",
+    "",
+    "class Bookshelf:",
+    "    def __init__(self, books=None):",
+    "        self.books = list(books or [])",
+    "",
+    "    def find(self, title):",
+    "        return [b for b in self.books if title in b.title]",
+    "for i in range(10):",
+    "    print(f'chapter {i}: {i * i}')",
+]
+
+
+def _paragraph_pool(rng, count=512):
+    """预先生成一批段落，大文件按伪随机顺序拼接，避免逐字符生成"""
+    pool = []
+    for _ in range(count):
+        sentences = []
+        for _ in range(rng.randint(3, 8)):
+            length = rng.randint(8, 30)
+            sentences.append(''.join(rng.choice(HANZI) for _ in range(length)) + rng.choice(PUNCTUATION))
+        pool.append(''.join(sentences))
+    return pool
+
+
+def _png(width, height, rng, noise_ratio=0.25):
+    """生成灰度PNG：上部为随机噪点（难以压缩，接近真实扫描页），其余为渐变"""
+    noise_rows = int(height * noise_ratio)
+    raw = bytearray()
+    for y in range(height):
+        raw.append(0) # 过滤类型: None
+        if y < noise_rows:
+            raw += rng.randbytes(width)
+        else:
+            raw += bytes([(x + y) & 0xFF for x in range(width)])
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(bytes(raw), 6)) + chunk(b'IEND', b'')
+
+
+def _zip_write(zf, name, data, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+    info.compress_type = compress_type
+    zf.writestr(info, data)
+
+
+def generate_txt(path, rng, pool, scale):
+    target = max(int(TXT_BYTES * scale), 1024)
+    written = 0
+    with open(path, 'wb') as f:
+        while written < target:
+            block = '\n\n'.join('　　' + rng.choice(pool) for _ in range(64)) + '\n\n'
+            data = block.encode('gbk')
+            f.write(data)
+            written += len(data)
+
+
+def generate_epub(path, rng, pool, scale):
+    chapter_chars = max(int(EPUB_CHAPTER_CHARS * scale), 200)
+    with zipfile.ZipFile(path, 'w') as zf:
+        _zip_write(zf, 'mimetype', 'application/epub+zip', zipfile.ZIP_STORED) # 必须是第一个且不压缩
+        _zip_write(zf, 'META-INF/container.xml',
+                   '<?xml version="1.0"?>\n'
+                   '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                   '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                   '</rootfiles></container>')
+        manifest, spine, nav_points = [], [], []
+        for i in range(1, EPUB_CHAPTERS + 1):
+            chapter_id = f"ch{i:03d}"
+            paragraphs = []
+            length = 0
+            while length < chapter_chars:
+                paragraph = rng.choice(pool)
+                paragraphs.append(f"<p>{paragraph}</p>")
+                length += len(paragraph)
+            _zip_write(zf, f"OEBPS/{chapter_id}.xhtml",
+                       '<?xml version="1.0" encoding="utf-8"?>\n'
+                       '<!DOCTYPE html>\n'
+                       '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>'
+                       f'第{i}章</title><style>p {{ text-indent: 2em; }}</style></head><body>'
+                       f'<h2>第{i}章</h2>' + '\n'.join(paragraphs) + '</body></html>')
+            manifest.append(f'<item id="{chapter_id}" href="{chapter_id}.xhtml" media-type="application/xhtml+xml"/>')
+            spine.append(f'<itemref idref="{chapter_id}"/>')
+            nav_points.append(f'<navPoint id="np{i}" playOrder="{i}"><navLabel><text>第{i}章</text></navLabel>'
+                              f'<content src="{chapter_id}.xhtml"/></navPoint>')
+        _zip_write(zf, 'OEBPS/content.opf',
+                   '<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="bookid" version="2.0">'
+                   '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                   '<dc:title>基准测试长篇</dc:title><dc:creator>合成作者</dc:creator>'
+                   '<dc:language>zh</dc:language><dc:identifier id="bookid">bench-epub-500</dc:identifier>'
+                   '</metadata><manifest>'
+                   '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+                   + ''.join(manifest) + '</manifest><spine toc="ncx">' + ''.join(spine) + '</spine></package>')
+        _zip_write(zf, 'OEBPS/toc.ncx',
+                   '<?xml version="1.0" encoding="utf-8"?>\n'
+                   '<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+                   '<head><meta name="dtb:uid" content="bench-epub-500"/></head>'
+                   '<docTitle><text>基准测试长篇</text></docTitle><navMap>'
+                   + ''.join(nav_points) + '</navMap></ncx>')
+
+
+def generate_fb2(path, rng, pool, scale):
+    side = max(int(320 * scale ** 0.5), 16)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<FictionBook xmlns="http://www.gribuser.ru/xml/fictionbook/2.0" '
+                'xmlns:l="http://www.w3.org/1999/xlink">'
+                '<description><title-info><genre>sf</genre>'
+                '<author><first-name>合成</first-name><last-name>作者</last-name></author>'
+                '<book-title>基准测试插图本</book-title><lang>zh</lang></title-info></description><body>')
+        for i in range(1, FB2_IMAGES + 1):
+            f.write(f'<section><title><p>第{i}节</p></title>')
+            for _ in range(3):
+                f.write(f'<p>{rng.choice(pool)}</p>')
+            f.write(f'<image l:href="#img{i:03d}.png"/></section>')
+        f.write('</body>')
+        for i in range(1, FB2_IMAGES + 1):
+            encoded = base64.encodebytes(_png(side, side, rng)).decode('ascii')
+            f.write(f'<binary id="img{i:03d}.png" content-type="image/png">{encoded}</binary>')
+        f.write('</FictionBook>')
+
+
+def generate_cbz(path, rng, scale):
+    width = max(int(800 * scale ** 0.5), 16)
+    height = width * 3 // 2
+    with zipfile.ZipFile(path, 'w') as zf:
+        for i in range(1, CBZ_PAGES + 1):
+            # 奇数页存储（走sendfile直出），偶数页压缩（走解压流）
+            compress_type = zipfile.ZIP_STORED if i % 2 else zipfile.ZIP_DEFLATED
+            _zip_write(zf, f"pages/{i:04d}.png", _png(width, height, rng), compress_type)
+
+
+def generate_library(path, rng, pool):
+    extensions = ('.txt', '.md', '.html', '.py', '.json', '.csv')
+    os.makedirs(path, exist_ok=True)
+    for i in range(LIBRARY_FILES):
+        extension = extensions[i % len(extensions)]
+        with open(os.path.join(path, f"book_{i:05d}{extension}"), 'w', encoding='utf-8') as f:
+            f.write(rng.choice(pool)[:rng.randint(20, 200)])
+    for i in range(20):
+        os.makedirs(os.path.join(path, f"shelf_{i:02d}"), exist_ok=True)
+
+
+def generate_markdown(path, rng, pool, scale):
+    target = max(int(MARKDOWN_BYTES * scale), 4096)
+    written = 0
+    section = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < target:
+            section += 1
+            parts = [f"## 第{section}节\n", rng.choice(pool) + '\n', rng.choice(pool) + '\n']
+            start = rng.randrange(len(CODE_SNIPPET_LINES))
+            code = [CODE_SNIPPET_LINES[(start + j) % len(CODE_SNIPPET_LINES)] for j in range(rng.randint(4, 12))]
+            parts.append("```python\n" + '\n'.join(code) + "\n```\n")
+            parts.append('\n'.join(f"- {rng.choice(pool)[:40]}" for _ in range(3)) + '\n')
+            if section % 10 == 0:
+                parts.append("| 列1 | 列2 | 列3 |\n| --- | --- | --- |\n"
+                             + ''.join(f"| {i} | {i * 2} | {rng.choice(HANZI)} |\n" for i in range(5)))
+            block = '\n'.join(parts) + '\n'
+            f.write(block)
+            written += len(block.encode('utf-8'))
+
+
+def generate_corpus(root, scale=1.0, seed=DEFAULT_SEED, force=False):
+    """
+    在root下生成书库，返回清单(dict)。
+    已存在且参数相同的书库直接复用。
+    """
+    manifest_path = os.path.join(root, MANIFEST_NAME)
+    manifest = {'version': CORPUS_VERSION, 'seed': seed, 'scale': scale}
+    if not force and os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            if json.load(f) == manifest:
+                return manifest
+
+    os.makedirs(root, exist_ok=True)
+    # 每个文件使用独立的随机数发生器，单个生成函数的改动不会影响其他文件
+    pool = _paragraph_pool(random.Random(seed))
+    generate_txt(os.path.join(root, TXT_NAME), random.Random(seed + 1), pool, scale)
+    generate_epub(os.path.join(root, EPUB_NAME), random.Random(seed + 2), pool, scale)
+    generate_fb2(os.path.join(root, FB2_NAME), random.Random(seed + 3), pool, scale)
+    generate_cbz(os.path.join(root, CBZ_NAME), random.Random(seed + 4), scale)
+    generate_library(os.path.join(root, LIBRARY_DIR), random.Random(seed + 5), pool)
+    generate_markdown(os.path.join(root, MARKDOWN_NAME), random.Random(seed + 6), pool, scale)
+
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生成基准测试用的合成书库')
+    parser.add_argument('root', help='输出目录')
+    parser.add_argument('--scale', type=float, default=1.0, help='文件体积缩放比例')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED)
+    parser.add_argument('--force', action='store_true', help='即使已存在也重新生成')
+    args = parser.parse_args()
+    generate_corpus(args.root, args.scale, args.seed, args.force)
+    print(f"书库已生成: {args.root}")
+
+
+if __name__ == '__main__':
+    main()
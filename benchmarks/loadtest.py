@@ -0,0 +1,325 @@
+"""
+并发负载测试
+
+在本地启动服务（gunicorn多进程或Werkzeug单进程），用多个线程模拟读者按以下访问模式施压：
+    comics     大量读者同时逐页翻看同一本1000页漫画
+    class      一个班的学生在同一时刻打开同一本EPUB（冷缓存）
+    browse     以文件列表和搜索为主的浏览
+    mixed      以上三种按 6:2:2 混合
+    replay     重放访问日志（Common/Combined Log Format中的GET请求）
+
+按路由输出吞吐量、错误率和延迟分位数。不依赖任何外部服务。
+用法:
+    python -m benchmarks.loadtest --scenario mixed --concurrency 32 --duration 30
+    python -m benchmarks.loadtest --scenario replay --log access.log --server werkzeug
+    python -m benchmarks.loadtest --url http://127.0.0.1:9588 --scenario browse   # 压测已运行的服务
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import zipfile
+from urllib.parse import quote, urlsplit
+
+from benchmarks import corpus
+from benchmarks.run import DEFAULT_WORKDIR, REPO_ROOT, percentile
+
+SERVER_START_TIMEOUT = 60  # 秒
+LOG_REQUEST_RE = re.compile(r'"GET (\S+) HTTP/[\d.]+"')
+
+
+def endpoint_label(path):
+    """把请求路径归类为路由名，用于分组统计"""
+    route = urlsplit(path).path
+    if route == '/':
+        return 'index'
+    if route.startswith('/comic_page_data/'):
+        return 'serve_comic_page'
+    if route.startswith('/static/'):
+        return 'static'
+    return {
+        '/read': 'read_file',
+        '/view': 'view_file',
+        '/download': 'download_file',
+        '/fb2_image': 'fb2_image',
+    }.get(route, route)
+
+
+# 访问模式：每个函数为一个虚拟用户生成无限的请求路径序列
+
+def comic_reader(rng, library):
+    yield f"/read?path={quote(corpus.CBZ_NAME)}"
+    pages = library['comic_pages']
+    page = rng.randrange(len(pages))
+    while True:
+        yield f"/comic_page_data/{quote(corpus.CBZ_NAME)}/{quote(pages[page])}"
+        page = (page + 1) % len(pages)
+
+
+def epub_student(rng, library):
+    while True:
+        yield f"/read?path={quote(corpus.EPUB_NAME)}"
+        if rng.random() < 0.3:
+            yield '/'
+
+
+def library_browser(rng, library):
+    while True:
+        choice = rng.random()
+        if choice < 0.3:
+            yield '/'
+        elif choice < 0.6:
+            yield f"/?path={corpus.LIBRARY_DIR}"
+        elif choice < 0.8:
+            yield f"/?path={corpus.LIBRARY_DIR}/shelf_{rng.randrange(20):02d}"
+        else:
+            yield f"/?path={corpus.LIBRARY_DIR}&q=book_{rng.randrange(100):02d}"
+
+
+SCENARIOS = {
+    'comics': [(comic_reader, 1)],
+    'class': [(epub_student, 1)],
+    'browse': [(library_browser, 1)],
+    'mixed': [(comic_reader, 6), (epub_student, 2), (library_browser, 2)],
+}
+
+
+def replay_user(paths, user_index, concurrency):
+    """第user_index个用户依次发送日志中第 user_index, user_index+N, ... 条请求，循环往复"""
+    own = paths[user_index::concurrency] or paths
+    while True:
+        for path in own:
+            yield path
+
+
+def load_access_log(log_path):
+    paths = []
+    with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            match = LOG_REQUEST_RE.search(line)
+            if match:
+                paths.append(match.group(1))
+    if not paths:
+        raise SystemExit(f"访问日志中没有GET请求: {log_path}")
+    return paths
+
+
+def build_users(args, library):
+    rng = random.Random(args.seed)
+    if args.scenario == 'replay':
+        paths = load_access_log(args.log)
+        return [replay_user(paths, i, args.concurrency) for i in range(args.concurrency)]
+    mix = SCENARIOS[args.scenario]
+    weighted = [factory for factory, weight in mix for _ in range(weight)]
+    return [weighted[i % len(weighted)](random.Random(rng.random()), library) for i in range(args.concurrency)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(args, workdir):
+    """在workdir下启动服务子进程，返回(进程, 地址)"""
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    if args.server == 'gunicorn':
+        env.update(WEB_WORKERS=str(args.workers), WEB_THREADS=str(args.threads))
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_ROOT, 'gunicorn.conf.py'),
+                   '-b', f'127.0.0.1:{port}', '--access-logfile', '/dev/null', 'app:app']
+    else:
+        command = [sys.executable, '-c',
+                   'import app; app.prepare_runtime(); '
+                   f'app.app.run(host="127.0.0.1", port={port}, threaded=True)']
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + SERVER_START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"服务启动失败（退出码 {process.returncode}）: {' '.join(command)}")
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            connection.request('GET', '/api/temp_usage')
+            connection.getresponse().read()
+            connection.close()
+            return process, ('127.0.0.1', port)
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit('服务启动超时')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def _send(connection, path):
+    connection.request('GET', path)
+    response = connection.getresponse()
+    response.read()
+    return response.status
+
+
+def run_user(address, paths, start_barrier, timing, max_requests, records, timeout):
+    """
+    单个虚拟用户：复用一个keep-alive连接，按序发送请求并记录(路由, 耗时, 错误, 是否重试)。
+    服务端关闭空闲连接（如工作进程平滑重启）时，与浏览器一样在新连接上重试一次。
+    """
+    connection = http.client.HTTPConnection(*address, timeout=timeout)
+    start_barrier.wait()
+    deadline = timing['deadline']
+    sent = 0
+    for path in paths:
+        if time.perf_counter() >= deadline or (max_requests and sent >= max_requests):
+            break
+        sent += 1
+        start = time.perf_counter()
+        error = None
+        retried = False
+        try:
+            try:
+                status = _send(connection, path)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                connection = http.client.HTTPConnection(*address, timeout=timeout)
+                retried = True
+                status = _send(connection, path)
+            if status >= 400:
+                error = f"HTTP {status}"
+        except (OSError, http.client.HTTPException) as e:
+            error = type(e).__name__
+            connection.close()
+            connection = http.client.HTTPConnection(*address, timeout=timeout)
+        records.append((endpoint_label(path), time.perf_counter() - start, error, retried))
+    connection.close()
+
+
+def summarize(records, elapsed):
+    groups = {}
+    for label, seconds, error, retried in records:
+        groups.setdefault(label, []).append((seconds, error, retried))
+    groups['TOTAL'] = [record[1:] for record in records]
+    summary = {}
+    for label, samples in groups.items():
+        latencies = [s * 1000 for s, _, _ in samples]
+        error_kinds = {}
+        for _, error, _ in samples:
+            if error:
+                error_kinds[error] = error_kinds.get(error, 0) + 1
+        errors = sum(error_kinds.values())
+        summary[label] = {
+            'requests': len(samples),
+            'errors': errors,
+            'error_kinds': error_kinds,
+            'retries': sum(1 for _, _, retried in samples if retried),
+            'error_rate': round(errors / len(samples), 4),
+            'rps': round(len(samples) / elapsed, 1),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+            'max_ms': round(max(latencies), 1),
+        }
+    return summary
+
+
+def print_summary(summary, elapsed):
+    header = f"{'路由':<20}{'请求数':>8}{'错误率':>9}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    print(header)
+    print('-' * len(header))
+    for label in sorted(summary, key=lambda name: (name == 'TOTAL', name)):
+        r = summary[label]
+        print(f"{label:<20}{r['requests']:>8}{r['error_rate']:>9.2%}{r['rps']:>9.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    for label, r in sorted(summary.items()):
+        if r['error_kinds'] and label != 'TOTAL':
+            kinds = ', '.join(f"{kind} x{count}" for kind, count in sorted(r['error_kinds'].items()))
+            print(f"{label} 错误: {kinds}")
+    if summary['TOTAL']['retries']:
+        print(f"服务端关闭keep-alive连接后重试的请求: {summary['TOTAL']['retries']}")
+    print(f"\n持续 {elapsed:.1f} 秒")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='希宁阅读并发负载测试')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS) + ['replay'], default='mixed')
+    parser.add_argument('--log', help='replay模式使用的访问日志')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发虚拟用户数')
+    parser.add_argument('--duration', type=float, default=20, help='持续时间（秒）')
+    parser.add_argument('--requests', type=int, default=0, help='每个用户最多请求数（0为不限）')
+    parser.add_argument('--timeout', type=float, default=60, help='单个请求超时（秒）')
+    parser.add_argument('--url', help='压测已运行的服务，而不是自行启动')
+    parser.add_argument('--server', choices=['gunicorn', 'werkzeug'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn工作进程数')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn每进程线程数')
+    parser.add_argument('--scale', type=float, default=0.1, help='书库体积缩放比例')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR)
+    parser.add_argument('--keep-cache', action='store_true', help='保留上次运行的磁盘缓存（默认从冷缓存开始）')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='把结果写入JSON文件')
+    args = parser.parse_args()
+    if args.scenario == 'replay' and not args.log:
+        parser.error('replay模式需要 --log')
+
+    workdir = os.path.abspath(os.path.join(args.workdir, f"scale-{args.scale:g}"))
+    corpus.generate_corpus(os.path.join(workdir, 'filesystem'), scale=args.scale)
+    with zipfile.ZipFile(os.path.join(workdir, 'filesystem', corpus.CBZ_NAME)) as zf:
+        library = {'comic_pages': sorted(n for n in zf.namelist() if n.endswith('.png'))}
+
+    process = None
+    if args.url:
+        parts = urlsplit(args.url)
+        address = (parts.hostname, parts.port or 80)
+    else:
+        if not args.keep_cache:
+            shutil.rmtree(os.path.join(workdir, 'cache'), ignore_errors=True)
+        process, address = start_server(args, workdir)
+        print(f"服务已启动 ({args.server}) http://{address[0]}:{address[1]}")
+
+    try:
+        users = build_users(args, library)
+        records = []  # list.append在多线程下是原子的
+        start_barrier = threading.Barrier(len(users) + 1)
+        timing = {}
+        threads = [threading.Thread(target=run_user, args=(address, paths, start_barrier, timing,
+                                                           args.requests, records, args.timeout), daemon=True)
+                   for paths in users]
+        for thread in threads:
+            thread.start()
+        # 所有用户在同一时刻开始，模拟同时打开同一本书
+        timing['deadline'] = time.perf_counter() + args.duration
+        start_barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    if not records:
+        raise SystemExit('没有完成任何请求')
+    summary = summarize(records, elapsed)
+    print(f"\n场景 {args.scenario}，并发 {args.concurrency}")
+    print_summary(summary, elapsed)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'scenario': args.scenario, 'concurrency': args.concurrency,
+                       'elapsed_s': round(elapsed, 2), 'results': summary}, f, ensure_ascii=False, indent=2)
+    return 1 if summary['TOTAL']['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+"""
+基准测试套件
+
+通过Flask测试客户端驱动 index / read_file / serve_comic_page，并直接调用
+parse_epub / parse_fb2 / clean_epub_html。每个用例记录：
+    cold_ms              清空所有缓存（内存、磁盘、CBZ句柄池）后的首次耗时，取多次冷启动的中位数
+    p50/p90/p99/max_ms   缓存预热后重复执行的耗时分位数
+    peak_kib             冷启动一次执行期间的Python内存峰值（tracemalloc）
+
+结果与提交在仓库中的 benchmarks/baseline.json 比较，超出容差的用例会被标记并以非零状态退出。
+用法:
+    python -m benchmarks.run                      # 使用基线的scale运行并比较
+    python -m benchmarks.run --scale 1            # 完整体积的书库
+    python -m benchmarks.run --update-baseline    # 重写基线
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+from urllib.parse import quote
+
+from benchmarks import corpus
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(REPO_ROOT, 'benchmarks', 'baseline.json')
+DEFAULT_WORKDIR = os.path.join(tempfile.gettempdir(), 'xiningread-bench')
+DEFAULT_TOLERANCE = 0.5  # 相对基线变慢/变大50%以上视为退化
+MIN_REGRESSION_MS = 5  # 小于该绝对差值的波动不计为退化
+DEFAULT_COLD_RUNS = 5  # 冷启动受磁盘和分配器状态影响，单次波动可达一倍，取多次的中位数
+
+
+def load_app(workdir):
+    """在workdir下导入应用，使书库、临时目录和缓存目录都位于其中"""
+    os.chdir(workdir)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import app as reader_app
+    return reader_app
+
+
+def clear_app_caches(reader_app):
+    """清空进程内缓存、磁盘缓存和CBZ句柄池，模拟冷启动"""
+    for func in reader_app._lru_cache_functions().values():
+        func.cache_clear()
+    shutil.rmtree(reader_app.DISK_CACHE_DIR, ignore_errors=True)
+    shutil.rmtree(reader_app.EINK_CACHE_DIR, ignore_errors=True)
+    shutil.rmtree(reader_app.TEXT_PAGES_DIR, ignore_errors=True)
+    shutil.rmtree(reader_app.RENDER_CACHE_DIR, ignore_errors=True)
+    with reader_app._cbz_pool_lock:
+        for archive in list(reader_app._cbz_pool.values()):
+            reader_app._discard_cbz_archive(archive)
+    with reader_app._comic_page_cache_lock:
+        reader_app._comic_page_cache.clear()
+        reader_app._comic_page_cache_size = 0
+
+
+class BenchmarkContext:
+    """用例共享的数据：应用、测试客户端和书库中的路径"""
+
+    def __init__(self, reader_app):
+        self.app = reader_app
+        self.client = reader_app.app.test_client()
+        self.root = reader_app.ROOT_DIR
+        with zipfile.ZipFile(self.path(corpus.CBZ_NAME)) as zf:
+            self.comic_pages = sorted(n for n in zf.namelist() if n.endswith('.png'))
+        with zipfile.ZipFile(self.path(corpus.EPUB_NAME)) as zf:
+            self.chapter_html = zf.read('OEBPS/ch001.xhtml').decode('utf-8')
+        self.iteration = 0
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def get(self, url):
+        response = self.client.get(url, buffered=True)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {url} -> {response.status_code}")
+        return response
+
+
+def case_index_root(ctx):
+    ctx.get('/')
+
+def case_index_20k(ctx):
+    ctx.get(f'/?path={corpus.LIBRARY_DIR}')
+
+def case_read_txt_gbk(ctx):
+    ctx.get(f'/read?path={corpus.TXT_NAME}')
+
+def case_text_page(ctx):
+    # 服务器端分页：首次计算整本书的分页位置，之后每次只读取一页
+    ctx.iteration += 1
+    ctx.get(f'/api/text_page?path={corpus.TXT_NAME}&width=760&height=900&font_size=18'
+            f'&line_height=2&profile=serif&page={ctx.iteration * 7}')
+
+def case_read_epub(ctx):
+    ctx.get(f'/read?path={corpus.EPUB_NAME}')
+
+def case_read_fb2(ctx):
+    ctx.get(f'/read?path={corpus.FB2_NAME}')
+
+def case_read_markdown(ctx):
+    ctx.get(f'/read?path={corpus.MARKDOWN_NAME}')
+
+def case_read_cbz(ctx):
+    ctx.get(f'/read?path={corpus.CBZ_NAME}')
+
+def case_comic_page(ctx):
+    # 每次请求不同的页，交替覆盖存储页和压缩页
+    ctx.iteration += 1
+    name = ctx.comic_pages[(ctx.iteration * 37) % len(ctx.comic_pages)]
+    ctx.get(f'/comic_page_data/{quote(corpus.CBZ_NAME)}/{quote(name)}')
+
+def case_parse_epub(ctx):
+    data, error = ctx.app.parse_epub(ctx.path(corpus.EPUB_NAME))
+    if error:
+        raise RuntimeError(error)
+
+def case_parse_fb2(ctx):
+    data, error = ctx.app.parse_fb2(ctx.path(corpus.FB2_NAME))
+    if error:
+        raise RuntimeError(error)
+
+def case_clean_epub_html(ctx):
+    ctx.app.clean_epub_html(ctx.chapter_html)
+
+
+CASES = [
+    ('index_root', case_index_root),
+    ('index_20k', case_index_20k),
+    ('read_txt_gbk', case_read_txt_gbk),
+    ('text_page', case_text_page),
+    ('read_epub', case_read_epub),
+    ('read_fb2', case_read_fb2),
+    ('read_markdown', case_read_markdown),
+    ('read_cbz', case_read_cbz),
+    ('comic_page', case_comic_page),
+    ('parse_epub', case_parse_epub),
+    ('parse_fb2', case_parse_fb2),
+    ('clean_epub_html', case_clean_epub_html),
+]
+
+
+def percentile(samples, pct):
+    """最近秩法计算分位数"""
+    ordered = sorted(samples)
+    rank = max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def run_case(ctx, func, repeat, cold_runs=DEFAULT_COLD_RUNS):
+    cold_samples = []
+    for _ in range(cold_runs):
+        clear_app_caches(ctx.app)
+        start = time.perf_counter()
+        func(ctx)
+        cold_samples.append((time.perf_counter() - start) * 1000)
+
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(ctx)
+        samples.append((time.perf_counter() - start) * 1000)
+
+    # 内存单独测一次，tracemalloc会明显拖慢执行，不能与计时混在一起
+    clear_app_caches(ctx.app)
+    tracemalloc.start()
+    try:
+        func(ctx)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'cold_ms': round(statistics.median(cold_samples), 2),
+        'p50_ms': round(percentile(samples, 50), 2),
+        'p90_ms': round(percentile(samples, 90), 2),
+        'p99_ms': round(percentile(samples, 99), 2),
+        'max_ms': round(max(samples), 2),
+        'peak_kib': round(peak / 1024),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """返回退化列表[(用例, 指标, 基线值, 当前值)]"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous:
+            continue
+        for metric in ('cold_ms', 'p50_ms', 'peak_kib'):
+            old, new = previous.get(metric), current.get(metric)
+            if old is None or new is None:
+                continue
+            if metric.endswith('_ms') and new - old < MIN_REGRESSION_MS:
+                continue
+            if new > old * (1 + tolerance):
+                regressions.append((name, metric, old, new))
+    return regressions
+
+
+def print_table(results, baseline):
+    previous = baseline.get('results', {}) if baseline else {}
+    header = f"{'用例':<16}{'冷启动ms':>12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'峰值KiB':>12}{'p50 对比基线':>16}"
+    print(header)
+    print('-' * len(header))
+    for name, r in results.items():
+        delta = ''
+        if name in previous and previous[name].get('p50_ms'):
+            delta = f"{(r['p50_ms'] / previous[name]['p50_ms'] - 1) * 100:+.0f}%"
+        print(f"{name:<16}{r['cold_ms']:>12.1f}{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}"
+              f"{r['p99_ms']:>10.1f}{r['peak_kib']:>12}{delta:>16}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='希宁阅读性能基准测试')
+    parser.add_argument('--scale', type=float, default=None,
+                        help='书库体积缩放比例（默认与基线相同，无基线时为1）')
+    parser.add_argument('--repeat', type=int, default=10, help='预热后每个用例的重复次数')
+    parser.add_argument('--cold-runs', type=int, default=DEFAULT_COLD_RUNS, help='每个用例的冷启动次数（取中位数）')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help='书库和缓存所在目录（可复用）')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--update-baseline', action='store_true', help='用本次结果覆盖基线')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--only', nargs='*', help='只运行指定用例')
+    parser.add_argument('--output', help='把本次结果写入JSON文件')
+    args = parser.parse_args()
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    scale = args.scale if args.scale is not None else (baseline['meta']['scale'] if baseline else 1.0)
+
+    workdir = os.path.abspath(os.path.join(args.workdir, f"scale-{scale:g}"))
+    print(f"生成/复用书库 (scale={scale:g}): {workdir}")
+    corpus.generate_corpus(os.path.join(workdir, 'filesystem'), scale=scale)
+
+    reader_app = load_app(workdir)
+    reader_app.PARSE_WORKERS = 0 # 在本进程内解析，测量的是解析本身而非进程间传输
+    ctx = BenchmarkContext(reader_app)
+
+    results = {}
+    for name, func in CASES:
+        if args.only and name not in args.only:
+            continue
+        print(f"运行 {name} ...", flush=True)
+        results[name] = run_case(ctx, func, args.repeat, max(args.cold_runs, 1))
+
+    meta = {
+        'scale': scale,
+        'repeat': args.repeat,
+        'cold_runs': args.cold_runs,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d'),
+    }
+    comparable = baseline is not None and baseline['meta']['scale'] == scale
+    print()
+    print_table(results, baseline if comparable else None)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, ensure_ascii=False, indent=2)
+
+    if args.update_baseline:
+        merged = dict(baseline['results']) if comparable else {}
+        merged.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': merged}, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"\n基线已更新: {args.baseline}")
+        return 0
+
+    if baseline is None:
+        print("\n没有基线，使用 --update-baseline 生成")
+        return 0
+    if not comparable:
+        print(f"\n基线的scale为{baseline['meta']['scale']:g}，与本次不同，跳过比较")
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\n发现性能退化（容差 {args.tolerance:.0%}）:")
+        for name, metric, old, new in regressions:
+            print(f"  {name}.{metric}: {old} -> {new}")
+        return 1
+    print("\n与基线相比没有退化")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
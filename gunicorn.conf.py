@@ -0,0 +1,31 @@
+# Gunicorn生产环境配置
+# 启动: gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:9588')
+
+# 预派生的工作进程数和每个进程的线程数
+workers = int(os.environ.get('WEB_WORKERS', str(min(os.cpu_count() or 1, 4) * 2)))
+threads = int(os.environ.get('WEB_THREADS', '4'))
+
+# 每个工作进程另有一个解析子进程池（PARSE_WORKERS），默认取 max(1, CPU数 // workers)，
+# 使所有工作进程的解析子进程总数不超过CPU数；工作进程继承此处设置的环境变量
+os.environ['WEB_CONCURRENCY'] = str(workers)
+worker_class = 'gthread'
+
+# 工作进程处理一定数量的请求后平滑重启，回收解析缓存占用的内存
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+graceful_timeout = 30
+timeout = 120  # 大文件上传和首次解析可能较慢
+keepalive = 5
+
+# 每个工作进程各自导入应用；进程间通过 cache/ 目录下的磁盘缓存共享解析结果
+preload_app = False
+
+accesslog = '-'
+errorlog = '-'
+
+def post_worker_init(worker):
+    from app import prepare_runtime
+    prepare_runtime()
@@ -38,7 +38,7 @@ class AnnotationsManager {
         if (!this.currentFilePath) return;
         const storageKey = this._getStorageKey(this.currentFilePath);
         try {
-            localStorage.setItem(storageKey, JSON.stringify(this.notes));
+            syncManager.setItem(storageKey, JSON.stringify(this.notes));
         } catch (e) {
             console.error(`Error saving notes for ${this.currentFilePath}:`, e);
         }
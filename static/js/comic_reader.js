@@ -15,8 +15,40 @@ document.addEventListener('DOMContentLoaded', function() {
     const totalPagesSpan = document.getElementById('total-comic-pages'); // Already set by template
     const comicImage = document.getElementById('comic-image');
 
+    const einkToggleButton = document.getElementById('eink-mode-toggle');
+
     let currentPageIndex = 0; // 0-indexed
     let recentReadAdded = false; // Flag to ensure addRecentRead is called only once
+    // E-ink mode asks the server for grayscale pages scaled to the screen width
+    let einkMode = localStorage.getItem('comicEinkMode') === '1';
+
+    function getPageUrl(pageIndex) {
+        const imageFilename = comicData.image_list[pageIndex];
+        // Filenames from zipfile should generally be UTF-8.
+        // Browsers handle UTF-8 in URLs, but spaces or special chars need encoding.
+        // comicData.comic_file_path_encoded is already URL-encoded by Python's quote()
+        const params = [];
+        if (einkMode) {
+            const containerWidth = comicImage.parentElement ? comicImage.parentElement.clientWidth : window.innerWidth;
+            const width = Math.round(containerWidth * (window.devicePixelRatio || 1));
+            params.push(`w=${width}`, 'gray=1');
+        }
+        if (comicData.comic_version) params.push(`v=${comicData.comic_version}`);
+        const query = params.length ? `?${params.join('&')}` : '';
+        return `/comic_page_data/${comicData.comic_file_path_encoded}/${encodeURIComponent(imageFilename)}${query}`;
+    }
+
+    function updateEinkToggle() {
+        if (einkToggleButton) einkToggleButton.textContent = `🖼️ 墨水屏优化: ${einkMode ? '开' : '关'}`;
+    }
+
+    // Warm the browser cache with the next page; the server is already decompressing it
+    let preloadImage = null;
+    function preloadPage(pageIndex) {
+        if (pageIndex < 0 || pageIndex >= comicData.total_pages) return;
+        preloadImage = new Image();
+        preloadImage.src = getPageUrl(pageIndex);
+    }
 
     function loadPage(pageIndex) {
         if (pageIndex < 0 || pageIndex >= comicData.total_pages) {
@@ -27,16 +59,8 @@ document.addEventListener('DOMContentLoaded', function() {
         // Update current page index
         currentPageIndex = pageIndex;
 
-        const imageFilename = comicData.image_list[pageIndex];
-        // Filenames from zipfile should generally be UTF-8.
-        // Browsers handle UTF-8 in URLs, but spaces or special chars need encoding.
-        const encodedImageFilename = encodeURIComponent(imageFilename);
-
-        // Construct the URL for the image
-        // comicData.comic_file_path_encoded is already URL-encoded by Python's quote()
-        const imageUrl = `/comic_page_data/${comicData.comic_file_path_encoded}/${encodedImageFilename}`;
-
-        comicImage.src = imageUrl;
+        comicImage.onload = function() { preloadPage(pageIndex + 1); };
+        comicImage.src = getPageUrl(pageIndex);
         comicImage.alt = `漫画第 ${pageIndex + 1} 页`;
         if (currentPageSpan) currentPageSpan.textContent = pageIndex + 1;
 
@@ -72,6 +96,16 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 
+    if (einkToggleButton) {
+        updateEinkToggle();
+        einkToggleButton.addEventListener('click', function() {
+            einkMode = !einkMode;
+            localStorage.setItem('comicEinkMode', einkMode ? '1' : '0');
+            updateEinkToggle();
+            if (comicData.total_pages > 0) loadPage(currentPageIndex);
+        });
+    }
+
     // Keyboard navigation (optional, but good for UX)
     document.addEventListener('keydown', function(e) {
         if (e.key === 'ArrowLeft') { // Previous page
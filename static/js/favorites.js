@@ -18,7 +18,7 @@ class FavoritesManager {
 
     saveFavorites(favoritesArray) {
         try {
-            localStorage.setItem(this.STORAGE_KEY, JSON.stringify(favoritesArray));
+            syncManager.setItem(this.STORAGE_KEY, JSON.stringify(favoritesArray));
             this.favorites = favoritesArray; // Update internal state
         } catch (e) {
             console.error("Error saving favorites to localStorage:", e);
@@ -51,6 +51,13 @@ class FavoritesManager {
 
 const favoritesManager = new FavoritesManager();
 
+// 其他设备的收藏同步到本地后刷新内存中的列表
+window.addEventListener('xining-sync', function(event) {
+    if (event.detail.keys.includes(favoritesManager.STORAGE_KEY)) {
+        favoritesManager.favorites = favoritesManager.getFavorites();
+    }
+});
+
 // Integration logic will be added here later in Phase 4
 document.addEventListener('DOMContentLoaded', function() {
     const favoriteButtons = document.querySelectorAll('.btn-favorite');
@@ -0,0 +1,21 @@
+// 批量查询文件现状：收藏和最近阅读在本地只保存路径，一次请求 /api/stat 取回所有条目是否存在及大小、类型
+const FILE_STATS_BATCH = 1000; // 与服务器单次请求的路径数上限一致
+
+function fetchFileStats(paths) {
+    const unique = Array.from(new Set(paths));
+    const batches = [];
+    for (let i = 0; i < unique.length; i += FILE_STATS_BATCH) {
+        batches.push(unique.slice(i, i + FILE_STATS_BATCH));
+    }
+    return Promise.all(batches.map(batch => fetch('/api/stat', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ paths: batch })
+    })
+        .then(response => response.json())
+        .then(data => {
+            if (!data.success) throw new Error(data.error);
+            return data.files;
+        })))
+        .then(results => Object.assign({}, ...results));
+}
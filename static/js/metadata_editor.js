@@ -16,7 +16,7 @@ class MetadataEditorManager {
 
     _saveAllUserMetadata() {
         try {
-            localStorage.setItem(this.STORAGE_KEY, JSON.stringify(this.metadataCache));
+            syncManager.setItem(this.STORAGE_KEY, JSON.stringify(this.metadataCache));
         } catch (e) {
             console.error("Error saving all user metadata:", e);
         }
@@ -0,0 +1,61 @@
+// 离线保存：请求 Service Worker 在后台下载整本书（清单来自 /api/offline_manifest）
+document.addEventListener('DOMContentLoaded', function() {
+    const button = document.querySelector('.offline-save-btn');
+    if (!button || !('serviceWorker' in navigator)) {
+        return;
+    }
+    const path = button.dataset.path;
+
+    function formatBytes(bytes) {
+        if (bytes < 1024 * 1024) return `${Math.round(bytes / 1024)} KB`;
+        return `${(bytes / (1024 * 1024)).toFixed(1)} MB`;
+    }
+
+    function render(status) {
+        button.disabled = status.downloading;
+        if (status.downloading) {
+            button.textContent = '📥 下载中...';
+        } else if (status.saved) {
+            button.textContent = `✅ 已离线 (${formatBytes(status.bytes)})`;
+            button.title = `离线书籍共占用 ${formatBytes(status.used_bytes)} / ${formatBytes(status.budget_bytes)}，点击移除本书`;
+        } else {
+            button.textContent = '📥 离线保存';
+            button.title = '下载整本书，无网络时也能阅读';
+        }
+        button.dataset.saved = status.saved ? '1' : '0';
+    }
+
+    // 通过 MessageChannel 发送消息并等待 Service Worker 回复
+    function send(message) {
+        return navigator.serviceWorker.ready.then(registration => new Promise(resolve => {
+            const channel = new MessageChannel();
+            channel.port1.onmessage = event => resolve(event.data);
+            registration.active.postMessage(message, [channel.port2]);
+        }));
+    }
+
+    navigator.serviceWorker.addEventListener('message', function(event) {
+        const data = event.data || {};
+        if (data.path !== path) return;
+        if (data.type === 'offline-progress') {
+            button.textContent = `📥 下载中 ${data.done}/${data.total}`;
+        } else if (data.type === 'offline-error') {
+            alert(`离线保存失败: ${data.error}`);
+        }
+    });
+
+    button.addEventListener('click', function() {
+        if (button.dataset.saved === '1') {
+            if (!confirm('从离线存储中移除本书？')) return;
+            send({ type: 'offline-remove', path: path }).then(render);
+        } else {
+            render({ downloading: true });
+            send({ type: 'offline-save', path: path }).then(render);
+        }
+    });
+
+    send({ type: 'offline-status', path: path }).then(status => {
+        render(status);
+        button.hidden = false;
+    });
+});
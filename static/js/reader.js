@@ -161,7 +161,114 @@ document.addEventListener('DOMContentLoaded', function() {
     // 节流的滚动处理器
     const throttledScrollHandler = throttle(handleScroll, 100);
 
-    if (contentType === 'txt' || contentType === 'markdown' || contentType === 'plain') {
+    // --- Server-side Pagination (TXT/plain) ---
+    // 分页模式下由服务器按字宽表计算分页位置，浏览器只显示第N页的文本，不再测量排版
+    const pagedModeBtn = document.getElementById('paged-mode');
+    let pagedMode = !!pagedModeBtn && !!contentContainer && localStorage.getItem('txtPagedMode') === '1';
+    const PAGE_BOTTOM_MARGIN = 24;
+    const PAGE_MIN_HEIGHT = 200; // 与服务器接受的最小视口一致
+    const PAGE_PREFETCH_LIMIT = 8;
+    // 小写字母a-z在各字体度量方案下的总宽度（em），与服务器端的字宽表一致
+    const PAGE_PROFILE_ALPHABET_WIDTHS = { serif: 11.943, halfwidth: 13, mono: 15.6 };
+    let pageLayoutQuery = '';
+    let pageState = { page: 0, pageCount: 0, offset: 0 };
+    let pageRequests = new Map(); // url -> Promise, 当前排版下已请求的页（含预取）
+    let pageResizeTimer = null;
+
+    function detectMetricsProfile() {
+        // 测量一次实际字体的西文宽度，选择最接近的度量方案
+        const probe = document.createElement('span');
+        probe.textContent = 'abcdefghijklmnopqrstuvwxyz';
+        probe.style.cssText = 'position: absolute; visibility: hidden; white-space: nowrap; font-size: 100px;';
+        contentContainer.appendChild(probe);
+        const alphabetWidth = probe.getBoundingClientRect().width / 100;
+        probe.remove();
+        let best = 'serif';
+        for (const profile in PAGE_PROFILE_ALPHABET_WIDTHS) {
+            if (Math.abs(PAGE_PROFILE_ALPHABET_WIDTHS[profile] - alphabetWidth) < Math.abs(PAGE_PROFILE_ALPHABET_WIDTHS[best] - alphabetWidth)) {
+                best = profile;
+            }
+        }
+        return best;
+    }
+
+    function computePageLayout() {
+        contentContainer.textContent = '';
+        contentContainer.style.height = '';
+        window.scrollTo(0, 0);
+        const style = getComputedStyle(contentContainer);
+        const fontSize = parseFloat(style.fontSize) || currentFontSize;
+        const lineHeight = (parseFloat(style.lineHeight) / fontSize) || 1.8;
+        const width = contentContainer.clientWidth - parseFloat(style.paddingLeft) - parseFloat(style.paddingRight);
+        const height = Math.max(Math.floor(window.innerHeight - contentContainer.getBoundingClientRect().top - PAGE_BOTTOM_MARGIN), PAGE_MIN_HEIGHT);
+        contentContainer.style.height = `${height}px`;
+        pageLayoutQuery = `width=${Math.floor(width)}&height=${height}&font_size=${Math.round(fontSize)}` +
+            `&line_height=${lineHeight.toFixed(2)}&profile=${detectMetricsProfile()}`;
+        pageRequests = new Map();
+    }
+
+    function fetchPage(query) {
+        const url = `/api/text_page?path=${encodeURIComponent(currentDocumentFilePath)}&${pageLayoutQuery}&${query}`;
+        if (!pageRequests.has(url)) {
+            if (pageRequests.size >= PAGE_PREFETCH_LIMIT) pageRequests = new Map();
+            const request = fetch(url)
+                .then(response => response.json())
+                .then(data => {
+                    if (!data.success) throw new Error(data.error);
+                    return data;
+                });
+            request.catch(() => pageRequests.delete(url));
+            pageRequests.set(url, request);
+        }
+        return pageRequests.get(url);
+    }
+
+    function showPage(query) {
+        return fetchPage(query).then(data => {
+            pageState = { page: data.page, pageCount: data.page_count, offset: data.offset };
+            contentContainer.textContent = data.text;
+            contentContainer.scrollTop = 0;
+            syncManager.setItem(getDocumentStorageKey('pagedOffset_'), String(data.offset));
+            updateProgress();
+            if (data.page + 1 < data.page_count) fetchPage(`page=${data.page + 1}`).catch(() => {});
+        }).catch(error => {
+            console.error('Failed to load page:', error);
+            alert(`分页加载失败: ${error.message}，已切换回滚动阅读`);
+            localStorage.setItem('txtPagedMode', '0');
+            window.location.reload();
+        });
+    }
+
+    function turnPage(delta) {
+        const target = pageState.page + delta;
+        if (target < 0 || target >= pageState.pageCount) return;
+        showPage(`page=${target}`);
+    }
+
+    // 字号或窗口变化后重新分页，停留在当前页开头的文字
+    function relayoutPages() {
+        computePageLayout();
+        showPage(`offset=${pageState.offset}`);
+    }
+
+    if (pagedModeBtn) {
+        pagedModeBtn.textContent = `📄 分页: ${pagedMode ? '开' : '关'}`;
+        pagedModeBtn.addEventListener('click', function() {
+            localStorage.setItem('txtPagedMode', pagedMode ? '0' : '1');
+            window.location.reload();
+        });
+    }
+    if (pagedMode) {
+        contentContainer.classList.add('paged-content');
+        window.addEventListener('resize', function() {
+            clearTimeout(pageResizeTimer);
+            pageResizeTimer = setTimeout(relayoutPages, 300);
+        });
+    }
+
+    if (pagedMode) {
+        // 首页在读取字号设置后加载，见下方初始化流程
+    } else if (contentType === 'txt' || contentType === 'markdown' || contentType === 'plain') {
         chunkContent();
         if (contentContainer) contentContainer.innerHTML = '';
         let loadedInitial = 0;
@@ -224,6 +331,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     if (readingArea) {
         readingArea.addEventListener('mouseup', function(e) {
+            if (pagedMode) return; // 批注按全文位置保存，分页模式下只显示一页，不支持添加
             setTimeout(() => { // Allow selection to finalize
                 const selection = window.getSelection();
                 if (selection && !selection.isCollapsed && selection.rangeCount > 0) {
@@ -633,6 +741,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (currentFontSize > 12) {
                 currentFontSize -= 2;
                 applyCurrentSettingsToElement(activeContentElement);
+                if (pagedMode) relayoutPages();
                 console.log(`Font size changed to ${currentFontSize}px. Target element:`, activeContentElement);
                 if (activeContentElement && activeContentElement.style) {
                      console.log(`Target element inline font-size after change: ${activeContentElement.style.fontSize}`);
@@ -649,6 +758,7 @@ document.addEventListener('DOMContentLoaded', function() {
             if (currentFontSize < 32) {
                 currentFontSize += 2;
                 applyCurrentSettingsToElement(activeContentElement);
+                if (pagedMode) relayoutPages();
                 console.log(`Font size changed to ${currentFontSize}px. Target element:`, activeContentElement);
                 if (activeContentElement && activeContentElement.style) {
                      console.log(`Target element inline font-size after change: ${activeContentElement.style.fontSize}`);
@@ -715,12 +825,14 @@ document.addEventListener('DOMContentLoaded', function() {
     function pageUpHandler(e) {
         e.preventDefault();
         console.log('Page up clicked'); // 调试日志
+        if (pagedMode) { turnPage(-1); return; }
         window.scrollBy({ top: -(window.innerHeight * 0.8), behavior: 'smooth' });
     }
 
     function pageDownHandler(e) {
         e.preventDefault();
         console.log('Page down clicked'); // 调试日志
+        if (pagedMode) { turnPage(1); return; }
         window.scrollBy({ top: (window.innerHeight * 0.8), behavior: 'smooth' });
     }
 
@@ -776,8 +888,19 @@ document.addEventListener('DOMContentLoaded', function() {
     setupDragNavigation();
     
     // 书签功能实现
+    // 书签和阅读位置按文件路径保存并同步到服务器，不同设备（不同访问地址）共用；
+    // 旧版本按完整URL保存的数据仍然可以读取
+    function getDocumentStorageKey(prefix) {
+        return prefix + encodeURIComponent(currentDocumentFilePath || window.location.pathname);
+    }
+
+    function getStoredDocumentItem(prefix) {
+        const saved = localStorage.getItem(getDocumentStorageKey(prefix));
+        return saved !== null ? saved : localStorage.getItem(prefix + btoa(window.location.href));
+    }
+
     function getBookmarkKey() {
-        return 'bookmark_' + btoa(window.location.href);
+        return getDocumentStorageKey('bookmark_');
     }
 
     function getCurrentScrollProgress() {
@@ -793,11 +916,12 @@ document.addEventListener('DOMContentLoaded', function() {
             progress: getCurrentScrollProgress(),
             timestamp: new Date().toISOString(),
             url: window.location.href,
-            fontSize: currentFontSize
+            fontSize: currentFontSize,
+            pageOffset: pagedMode ? pageState.offset : undefined
         };
         console.log(`[saveBookmark] Preparing to save bookmark for key "${key}":`, bookmarkData);
         try {
-            localStorage.setItem(key, JSON.stringify(bookmarkData));
+            syncManager.setItem(key, JSON.stringify(bookmarkData));
             console.log(`[saveBookmark] Bookmark saved successfully for key "${key}".`);
 
             // 更新书签按钮状态
@@ -816,13 +940,17 @@ document.addEventListener('DOMContentLoaded', function() {
 
     function loadBookmark() {
         const key = getBookmarkKey();
-        const saved = localStorage.getItem(key);
+        const saved = getStoredDocumentItem('bookmark_');
         console.log(`[loadBookmark] Attempting to load bookmark for key "${key}". Saved data:`, saved ? "Found" : "Not found");
 
         if (saved) {
             try {
                 const bookmarkData = JSON.parse(saved);
                 console.log('[loadBookmark] Parsed bookmark data:', bookmarkData);
+                if (pagedMode && bookmarkData.pageOffset !== undefined) {
+                    showPage(`offset=${bookmarkData.pageOffset}`);
+                    return true;
+                }
                 console.log(`[loadBookmark] Current activeContentElement before timeout:`, activeContentElement);
                 console.log(`[loadBookmark] Document scrollHeight before timeout: ${document.documentElement.scrollHeight}`);
 
@@ -860,7 +988,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
     function hasBookmark() {
         const key = getBookmarkKey();
-        const has = localStorage.getItem(key) !== null;
+        const has = getStoredDocumentItem('bookmark_') !== null;
         console.log(`[hasBookmark] Checking for key "${key}". Found: ${has}`);
         return has;
     }
@@ -881,7 +1009,14 @@ document.addEventListener('DOMContentLoaded', function() {
     
     function updateProgress() { /* ... (existing updateProgress, adapted for chunking) ... */
         let progress = 0;
-        if (chunks.length > 0 && (contentType === 'txt' || contentType === 'markdown' || contentType === 'plain')) {
+        if (pagedMode) {
+            progress = pageState.pageCount > 0 ? ((pageState.page + 1) / pageState.pageCount) * 100 : 0;
+            if (progressText && pageState.pageCount > 0) {
+                if (progressFill) progressFill.style.width = `${progress}%`;
+                progressText.textContent = `${pageState.page + 1}/${pageState.pageCount}`;
+                return;
+            }
+        } else if (chunks.length > 0 && (contentType === 'txt' || contentType === 'markdown' || contentType === 'plain')) {
              progress = (currentChunkToRender / chunks.length) * 100;
              if (currentChunkToRender === chunks.length && chunks.length > 0) progress = 100; // Ensure 100% when all loaded
         } else {
@@ -908,19 +1043,23 @@ document.addEventListener('DOMContentLoaded', function() {
         else if (e.key === 'ArrowLeft' || e.key === 'PageUp') {
             e.preventDefault();
             console.log('Keyboard page up triggered'); // 调试日志
+            if (pagedMode) { turnPage(-1); return; }
             window.scrollBy({ top: -(window.innerHeight * 0.8), behavior: 'smooth' });
         }
         else if (e.key === 'ArrowRight' || e.key === 'PageDown') {
             e.preventDefault();
             console.log('Keyboard page down triggered'); // 调试日志
+            if (pagedMode) { turnPage(1); return; }
             window.scrollBy({ top: (window.innerHeight * 0.8), behavior: 'smooth' });
         }
         else if (e.key === 'Home') {
-            window.scrollTo(0, 0);
+            if (pagedMode) showPage('page=0');
+            else window.scrollTo(0, 0);
             e.preventDefault();
         }
         else if (e.key === 'End') {
-            window.scrollTo(0, document.body.scrollHeight);
+            if (pagedMode) showPage(`page=${pageState.pageCount - 1}`);
+            else window.scrollTo(0, document.body.scrollHeight);
             e.preventDefault();
         }
         else if (e.ctrlKey && e.key === 'f') {
@@ -967,10 +1106,13 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
     function saveReadingPosition() { /* ... existing saveReadingPosition ... */
-         localStorage.setItem('readingPosition_' + btoa(window.location.href), window.pageYOffset);
+        const position = String(window.pageYOffset);
+        if (getStoredDocumentItem('readingPosition_') !== position) {
+            syncManager.setItem(getDocumentStorageKey('readingPosition_'), position);
+        }
     }
     function restoreReadingPosition() { /* ... existing restoreReadingPosition ... */
-        const saved = localStorage.getItem('readingPosition_' + btoa(window.location.href));
+        const saved = getStoredDocumentItem('readingPosition_');
         if (saved) setTimeout(() => window.scrollTo(0, parseInt(saved)), 150); // increased delay for chunked content
     }
     window.addEventListener('beforeunload', saveReadingPosition);
@@ -978,7 +1120,11 @@ document.addEventListener('DOMContentLoaded', function() {
     loadSettings();
 
     // 根据内容类型决定初始化流程
-    if (contentType === 'epub') {
+    if (pagedMode) {
+        computePageLayout();
+        const savedOffset = localStorage.getItem(getDocumentStorageKey('pagedOffset_'));
+        showPage(savedOffset !== null ? `offset=${parseInt(savedOffset)}` : 'page=0');
+    } else if (contentType === 'epub') {
         // EPUB内容的特殊处理
         setTimeout(() => {
             if (hasBookmark()) {
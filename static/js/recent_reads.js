@@ -19,7 +19,7 @@ class RecentReadsManager {
 
     saveRecentReads(recentReadsArray) {
         try {
-            localStorage.setItem(this.STORAGE_KEY, JSON.stringify(recentReadsArray));
+            syncManager.setItem(this.STORAGE_KEY, JSON.stringify(recentReadsArray));
         } catch (e) {
             console.error("Error saving recent reads to localStorage:", e);
         }
@@ -80,6 +80,7 @@ function displayRecentReads() {
 
         recentReads.forEach(item => {
             const listItem = document.createElement('li');
+            listItem.dataset.filepath = item.path;
             const link = document.createElement('a');
             // Note: url_for is Python/Jinja. In JS, we construct the URL manually.
             // Assuming read_file_url_template is available globally or passed appropriately if complex routing is needed.
@@ -103,6 +104,19 @@ function displayRecentReads() {
             listItem.appendChild(timeAgo);
             recentReadsListContainer.appendChild(listItem);
         });
+
+        // 一次请求检查所有条目，已被删除或移动的文件标记为失效
+        fetchFileStats(recentReads.map(item => item.path))
+            .then(files => {
+                recentReadsListContainer.querySelectorAll('li').forEach(listItem => {
+                    const info = files[listItem.dataset.filepath];
+                    if (info && !info.exists) {
+                        listItem.classList.add('missing');
+                        listItem.title = '文件已不存在';
+                    }
+                });
+            })
+            .catch(error => console.warn('Could not check recent reads:', error));
     }
 }
 
@@ -0,0 +1,170 @@
+// 阅读数据同步：需要同步的localStorage键通过 syncManager 写入，
+// 改动先记在本地待提交列表中，停止操作几秒后批量提交到 /api/sync，并取回其他设备的改动。
+// 只有设置了同步ID后才会同步；在其他设备上设置同一ID即可共享阅读数据
+class SyncManager {
+    constructor() {
+        this.ID_KEY = 'xining_sync_id';
+        this.ID_PATTERN = /^[A-Za-z0-9_-]{8,64}$/;
+        // 与服务器的 SYNC_KEY_PREFIXES 一致
+        this.KEY_PREFIXES = ['readingPosition_', 'bookmark_', 'pagedOffset_', 'xining_annotations_',
+                             'xining_favorites', 'xining_recent_reads', 'xining_user_metadata'];
+        this.REV_KEY = 'xining_sync_rev';
+        this.PENDING_KEY = 'xining_sync_pending'; // {key: updated_at}，关闭页面后下次打开继续提交
+        this.DEBOUNCE_MS = 5000; // 翻页等连续写入合并为一次请求
+        this.RETRY_MS = 60000;
+        this.flushTimer = null;
+        this.inFlight = null;
+    }
+
+    getSyncId() {
+        return localStorage.getItem(this.ID_KEY) || '';
+    }
+
+    // 设置或更换同步ID（传空字符串关闭同步）；返回false表示ID格式无效
+    setSyncId(syncId) {
+        if (syncId && !this.ID_PATTERN.test(syncId)) return false;
+        if (syncId === this.getSyncId()) return true;
+        localStorage.removeItem(this.REV_KEY);
+        if (!syncId) {
+            localStorage.removeItem(this.ID_KEY);
+            return true;
+        }
+        localStorage.setItem(this.ID_KEY, syncId);
+        // 本地已有的数据以修改时间0提交：服务器上没有的键会补上，已有的以服务器为准
+        const pending = this._loadPending();
+        for (let i = 0; i < localStorage.length; i++) {
+            const key = localStorage.key(i);
+            if (this.KEY_PREFIXES.some(prefix => key.startsWith(prefix)) && !(key in pending)) {
+                pending[key] = 0;
+            }
+        }
+        localStorage.setItem(this.PENDING_KEY, JSON.stringify(pending));
+        this.sync();
+        return true;
+    }
+
+    generateSyncId() {
+        const bytes = crypto.getRandomValues(new Uint8Array(12));
+        return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+    }
+
+    setItem(key, value) {
+        localStorage.setItem(key, value);
+        this._markPending(key);
+    }
+
+    removeItem(key) {
+        localStorage.removeItem(key);
+        this._markPending(key);
+    }
+
+    _loadPending() {
+        try {
+            return JSON.parse(localStorage.getItem(this.PENDING_KEY)) || {};
+        } catch (e) {
+            return {};
+        }
+    }
+
+    _markPending(key) {
+        const pending = this._loadPending();
+        pending[key] = Date.now();
+        localStorage.setItem(this.PENDING_KEY, JSON.stringify(pending));
+        this._schedule(this.DEBOUNCE_MS);
+    }
+
+    _schedule(delay) {
+        clearTimeout(this.flushTimer);
+        this.flushTimer = setTimeout(() => this.sync(), delay);
+    }
+
+    // 提交待提交的改动并取回其他设备的改动；keepalive 用于页面关闭时
+    sync(keepalive = false) {
+        clearTimeout(this.flushTimer);
+        const syncId = this.getSyncId();
+        if (!syncId) {
+            return Promise.resolve(); // 未开启同步，改动留在待提交列表中
+        }
+        if (this.inFlight) {
+            return this.inFlight.then(() => this.sync(keepalive));
+        }
+        const pending = this._loadPending();
+        const changes = Object.keys(pending).map(key => ({
+            key: key,
+            value: localStorage.getItem(key),
+            updated_at: pending[key]
+        }));
+        const body = JSON.stringify({
+            since: parseInt(localStorage.getItem(this.REV_KEY) || '0', 10),
+            changes: changes
+        });
+
+        this.inFlight = fetch('/api/sync', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'X-Sync-Id': syncId },
+            body: body,
+            keepalive: keepalive
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) throw new Error(data.error);
+                if (syncId !== this.getSyncId()) return; // 请求期间更换了同步ID，结果作废
+                // 只清除已提交的改动；请求期间的新改动保留到下一次
+                const current = this._loadPending();
+                changes.forEach(change => {
+                    if (current[change.key] === change.updated_at) delete current[change.key];
+                });
+                localStorage.setItem(this.PENDING_KEY, JSON.stringify(current));
+
+                const changedKeys = [];
+                data.changes.forEach(change => {
+                    if (current[change.key]) return; // 本地有更新的未提交改动
+                    if (change.value === null) localStorage.removeItem(change.key);
+                    else localStorage.setItem(change.key, change.value);
+                    changedKeys.push(change.key);
+                });
+                localStorage.setItem(this.REV_KEY, String(data.rev));
+                if (changedKeys.length) {
+                    window.dispatchEvent(new CustomEvent('xining-sync', { detail: { keys: changedKeys } }));
+                }
+                if (data.more) this._schedule(0); // 服务器一次最多返回一批改动，继续取回剩余部分
+                else if (Object.keys(current).length) this._schedule(this.DEBOUNCE_MS);
+            })
+            .catch(error => {
+                console.warn('Sync failed, will retry:', error);
+                this._schedule(this.RETRY_MS);
+            })
+            .finally(() => { this.inFlight = null; });
+        return this.inFlight;
+    }
+}
+
+const syncManager = new SyncManager();
+
+document.addEventListener('DOMContentLoaded', function() {
+    syncManager.sync();
+
+    const button = document.getElementById('sync-settings-btn');
+    if (!button) return;
+    function render() {
+        button.textContent = syncManager.getSyncId() ? '🔄 同步: 开' : '🔄 同步: 关';
+    }
+    button.addEventListener('click', function() {
+        const current = syncManager.getSyncId();
+        const input = prompt('同步ID（8-64位字母、数字、-或_）。在其他设备上输入同一ID即可共享阅读位置、书签、批注和收藏；清空则关闭同步。',
+                             current || syncManager.generateSyncId());
+        if (input === null) return;
+        if (!syncManager.setSyncId(input.trim())) {
+            alert('同步ID格式无效');
+        }
+        render();
+    });
+    render();
+});
+
+// 切到后台或关闭页面时立即提交，不等防抖
+document.addEventListener('visibilitychange', function() {
+    if (document.visibilityState === 'hidden' && syncManager.getSyncId() && Object.keys(syncManager._loadPending()).length) {
+        syncManager.sync(true);
+    }
+});
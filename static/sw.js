@@ -1,4 +1,4 @@
-const CACHE_NAME = 'xining-cache-v1';
+const CACHE_NAME = 'xining-cache-v3';
 const urlsToCache = [
     '/', // Home page
     '/local', // Local reader page
@@ -10,15 +10,323 @@ const urlsToCache = [
     '/static/js/favorites.js',
     '/static/js/recent_reads.js',
     '/static/js/annotations.js',
+    '/static/js/offline_books.js',
+    '/static/js/sync.js',
+    '/static/js/file_stats.js',
+    '/static/js/sha256.js',
     '/static/js/pwa_init.js', // The script that registers this SW
     // Placeholder for icons (actual paths needed)
     // '/static/images/icon-192x192.png',
     // '/static/images/icon-512x512.png',
     // Note: reader.js and comic_reader.js are not included here as they are specific to certain pages
-    // and might be large. Caching them aggressively might not be ideal unless they are very stable.
-    // Consider caching them on first use via the fetch event if needed.
+    // and might be large. Books saved for offline reading list them in their manifest instead.
 ];
 
+// Offline books: each book saved for offline reading gets its own cache, filled from
+// /api/offline_manifest. The index of saved books (etag, bytes, last access, URLs) lives
+// in a separate cache so it survives the worker being stopped and restarted.
+const BOOK_CACHE_PREFIX = 'xining-book-';
+const OFFLINE_INDEX_CACHE = 'xining-offline-index';
+const OFFLINE_INDEX_URL = '/__offline_index__';
+const DEFAULT_OFFLINE_BUDGET = 500 * 1024 * 1024; // Bytes; capped further by the browser's storage quota
+const OFFLINE_DOWNLOAD_CONCURRENCY = 4;
+const OFFLINE_REVALIDATE_INTERVAL = 10 * 60 * 1000; // Check a book's ETag at most every 10 minutes
+const OFFLINE_INDEX_SAVE_DELAY = 2000; // Batch last-access updates
+
+let offlineIndex = null; // {budget, books: {path: {name, etag, bytes, lastAccess, lastChecked, urls}}}
+let offlineIndexSaveTimer = null;
+const offlineDownloads = new Map(); // path -> Promise of a download in progress
+
+function bookCacheName(path) {
+    return BOOK_CACHE_PREFIX + encodeURIComponent(path);
+}
+
+function absoluteUrl(url) {
+    return new URL(url, self.location.origin).href;
+}
+
+function loadOfflineIndex() {
+    if (offlineIndex) return Promise.resolve(offlineIndex);
+    return caches.open(OFFLINE_INDEX_CACHE)
+        .then(cache => cache.match(OFFLINE_INDEX_URL))
+        .then(response => response ? response.json() : null)
+        .catch(() => null)
+        .then(data => {
+            if (!offlineIndex) { // Another caller may have loaded it meanwhile
+                offlineIndex = data && data.books ? data : { budget: null, books: {} };
+            }
+            return offlineIndex;
+        });
+}
+
+function saveOfflineIndex() {
+    clearTimeout(offlineIndexSaveTimer);
+    offlineIndexSaveTimer = null;
+    if (!offlineIndex) return Promise.resolve();
+    const body = JSON.stringify(offlineIndex);
+    return caches.open(OFFLINE_INDEX_CACHE).then(cache =>
+        cache.put(OFFLINE_INDEX_URL, new Response(body, { headers: { 'Content-Type': 'application/json' } })));
+}
+
+function scheduleOfflineIndexSave() {
+    if (!offlineIndexSaveTimer) {
+        offlineIndexSaveTimer = setTimeout(saveOfflineIndex, OFFLINE_INDEX_SAVE_DELAY);
+    }
+}
+
+function getOfflineBudget(index) {
+    const budget = index.budget || DEFAULT_OFFLINE_BUDGET;
+    if (!self.navigator.storage || !self.navigator.storage.estimate) return Promise.resolve(budget);
+    return self.navigator.storage.estimate()
+        .then(estimate => estimate.quota ? Math.min(budget, Math.floor(estimate.quota * 0.8)) : budget)
+        .catch(() => budget);
+}
+
+function offlineBytesUsed(index, exceptPath) {
+    return Object.keys(index.books)
+        .filter(path => path !== exceptPath)
+        .reduce((total, path) => total + (index.books[path].bytes || 0), 0);
+}
+
+function removeOfflineBook(index, path) {
+    delete index.books[path];
+    return caches.delete(bookCacheName(path));
+}
+
+// Evict least recently read books until `incoming` more bytes fit in the budget
+function evictOfflineBooks(index, budget, incoming, keepPath) {
+    const candidates = Object.keys(index.books)
+        .filter(path => path !== keepPath)
+        .sort((a, b) => (index.books[a].lastAccess || 0) - (index.books[b].lastAccess || 0));
+    const evictions = [];
+    let used = offlineBytesUsed(index, keepPath);
+    while (used + incoming > budget && candidates.length) {
+        const path = candidates.shift();
+        used -= index.books[path].bytes || 0;
+        console.log('[ServiceWorker] Evicting offline book:', path);
+        evictions.push(removeOfflineBook(index, path));
+    }
+    return Promise.all(evictions).then(() => used + incoming <= budget);
+}
+
+function broadcast(message) {
+    return self.clients.matchAll({ includeUncontrolled: true }).then(clients => {
+        clients.forEach(client => client.postMessage(message));
+    });
+}
+
+function fetchOfflineManifest(path, etag) {
+    const headers = etag ? { 'If-None-Match': `"${etag}"` } : {};
+    return fetch(`/api/offline_manifest?path=${encodeURIComponent(path)}`, { headers: headers, cache: 'no-store' });
+}
+
+// Download every URL of a manifest into a fresh cache, then swap it in for the book
+function downloadOfflineBook(path, manifest) {
+    const stagingName = bookCacheName(path) + '#staging';
+    const resources = manifest.resources;
+    let done = 0;
+    let bytes = 0;
+    let next = 0;
+
+    return caches.delete(stagingName)
+        .then(() => caches.open(stagingName))
+        .then(cache => {
+            function worker() {
+                if (next >= resources.length) return Promise.resolve();
+                const resource = resources[next++];
+                return fetch(resource.url, { cache: 'no-store' })
+                    .then(response => {
+                        if (!response.ok) throw new Error(`${resource.url} -> ${response.status}`);
+                        // Read the body once so the stored size is exact, not the manifest estimate
+                        return response.blob().then(body => {
+                            bytes += body.size;
+                            return cache.put(resource.url, new Response(body, {
+                                status: response.status,
+                                statusText: response.statusText,
+                                headers: response.headers
+                            }));
+                        });
+                    })
+                    .then(() => {
+                        done += 1;
+                        if (done % 10 === 0 || done === resources.length) {
+                            broadcast({ type: 'offline-progress', path: path, done: done, total: resources.length });
+                        }
+                        return worker();
+                    });
+            }
+            const workers = [];
+            for (let i = 0; i < Math.min(OFFLINE_DOWNLOAD_CONCURRENCY, resources.length); i++) {
+                workers.push(worker());
+            }
+            return Promise.all(workers).then(() => cache);
+        })
+        .then(staging => caches.delete(bookCacheName(path))
+            .then(() => caches.open(bookCacheName(path)))
+            .then(target => staging.keys().then(requests => Promise.all(requests.map(request =>
+                staging.match(request).then(response => target.put(request, response)))))))
+        .then(() => caches.delete(stagingName))
+        .then(() => bytes)
+        .catch(error => caches.delete(stagingName).then(() => { throw error; }));
+}
+
+function saveOfflineBook(path) {
+    if (offlineDownloads.has(path)) return offlineDownloads.get(path);
+
+    const task = Promise.all([loadOfflineIndex(), fetchOfflineManifest(path)])
+        .then(([index, response]) => {
+            if (!response.ok) {
+                return response.json().catch(() => ({})).then(data => {
+                    throw new Error(data.error || `HTTP ${response.status}`);
+                });
+            }
+            return response.json().then(manifest => getOfflineBudget(index).then(budget => {
+                if (manifest.total_bytes > budget) {
+                    throw new Error('超出离线存储空间上限');
+                }
+                return evictOfflineBooks(index, budget, manifest.total_bytes, path)
+                    .then(() => downloadOfflineBook(path, manifest))
+                    .then(bytes => {
+                        const now = Date.now();
+                        index.books[path] = {
+                            name: manifest.name,
+                            etag: manifest.etag,
+                            bytes: bytes,
+                            lastAccess: now,
+                            lastChecked: now,
+                            urls: manifest.resources.map(r => absoluteUrl(r.url))
+                        };
+                        // The real size can exceed the estimate; evict again with exact numbers
+                        return evictOfflineBooks(index, budget, 0, path);
+                    })
+                    .then(() => saveOfflineIndex())
+                    .then(() => index.books[path]);
+            }));
+        })
+        .then(book => {
+            console.log('[ServiceWorker] Saved book for offline reading:', path);
+            broadcast({ type: 'offline-saved', path: path, bytes: book.bytes });
+            return book;
+        })
+        .catch(error => {
+            console.error('[ServiceWorker] Failed to save offline book:', path, error);
+            broadcast({ type: 'offline-error', path: path, error: error.message });
+            throw error;
+        })
+        .finally(() => offlineDownloads.delete(path));
+
+    offlineDownloads.set(path, task);
+    return task;
+}
+
+// Ask the server whether the book changed since it was downloaded; re-download if so
+function revalidateOfflineBook(path) {
+    return loadOfflineIndex().then(index => {
+        const book = index.books[path];
+        if (!book || offlineDownloads.has(path) || Date.now() - (book.lastChecked || 0) < OFFLINE_REVALIDATE_INTERVAL) {
+            return;
+        }
+        book.lastChecked = Date.now();
+        scheduleOfflineIndexSave();
+        return fetchOfflineManifest(path, book.etag).then(response => {
+            if (response.status === 200) {
+                console.log('[ServiceWorker] Offline book changed on server, refreshing:', path);
+                return saveOfflineBook(path);
+            }
+            // 304: still current. Errors (offline, deleted on server) keep the local copy.
+        });
+    }).catch(() => {});
+}
+
+// Find the saved book a request belongs to
+function findOfflineBook(index, url) {
+    const href = url.href;
+    const path = url.searchParams.get('path');
+    if (path && index.books[path]) return path;
+    return Object.keys(index.books).find(bookPath => {
+        const urls = index.books[bookPath].urls || [];
+        if (urls.indexOf(href) !== -1) return true;
+        // Comic pages differ only in query (version, e-ink width)
+        return url.pathname.startsWith('/comic_page_data/') &&
+            urls.some(u => u.split('?')[0] === url.origin + url.pathname);
+    });
+}
+
+// /read and /view have one entry per book, and comic pages are unique by pathname, so their
+// query string (URL encoding, e-ink parameters) can be ignored when the network is unavailable
+function allowsLooseMatch(url) {
+    return url.pathname === '/read' || url.pathname === '/view' || url.pathname.startsWith('/comic_page_data/');
+}
+
+// Cache-first for books saved offline; resolves to undefined for anything else
+function respondFromOfflineBook(event, url) {
+    return loadOfflineIndex().then(index => {
+        const path = findOfflineBook(index, url);
+        if (!path) return undefined;
+        return caches.open(bookCacheName(path)).then(cache => cache.match(event.request).then(response => {
+            if (response) {
+                index.books[path].lastAccess = Date.now();
+                scheduleOfflineIndexSave();
+                if (url.pathname === '/read') {
+                    event.waitUntil(revalidateOfflineBook(path));
+                }
+                return response;
+            }
+            if (!allowsLooseMatch(url)) return undefined;
+            return fetch(event.request).catch(error =>
+                cache.match(event.request, { ignoreSearch: true })
+                    .then(loose => loose || caches.match(event.request))
+                    .then(fallback => {
+                        if (!fallback) throw error;
+                        return fallback;
+                    }));
+        }));
+    }).catch(() => undefined);
+}
+
+function getOfflineStatus(path) {
+    return loadOfflineIndex().then(index => getOfflineBudget(index).then(budget => {
+        const book = index.books[path];
+        return {
+            type: 'offline-status',
+            path: path,
+            saved: !!book,
+            downloading: offlineDownloads.has(path),
+            bytes: book ? book.bytes : 0,
+            used_bytes: offlineBytesUsed(index),
+            budget_bytes: budget
+        };
+    }));
+}
+
+// Messages from pages: {type: 'offline-save' | 'offline-remove' | 'offline-status' | 'offline-budget', ...}
+self.addEventListener('message', function(event) {
+    const data = event.data || {};
+    const reply = message => {
+        if (event.ports && event.ports[0]) event.ports[0].postMessage(message);
+        else if (event.source) event.source.postMessage(message);
+    };
+    let work;
+    if (data.type === 'offline-save' && data.path) {
+        work = saveOfflineBook(data.path).catch(() => {}).then(() => getOfflineStatus(data.path)).then(reply);
+    } else if (data.type === 'offline-remove' && data.path) {
+        work = loadOfflineIndex()
+            .then(index => removeOfflineBook(index, data.path))
+            .then(() => saveOfflineIndex())
+            .then(() => getOfflineStatus(data.path)).then(reply);
+    } else if (data.type === 'offline-status' && data.path) {
+        work = getOfflineStatus(data.path).then(reply);
+    } else if (data.type === 'offline-budget' && data.bytes > 0) {
+        work = loadOfflineIndex().then(index => {
+            index.budget = data.bytes;
+            return getOfflineBudget(index)
+                .then(budget => evictOfflineBooks(index, budget, 0, null))
+                .then(() => saveOfflineIndex());
+        });
+    }
+    if (work) event.waitUntil(work);
+});
+
 // Install event: open cache and add core assets
 self.addEventListener('install', function(event) {
     console.log('[ServiceWorker] Install');
@@ -45,6 +353,10 @@ self.addEventListener('activate', function(event) {
         caches.keys().then(function(cacheNames) {
             return Promise.all(
                 cacheNames.map(function(cacheName) {
+                    // Offline books and their index are managed by the LRU budget, not by version
+                    if (cacheName === OFFLINE_INDEX_CACHE || cacheName.startsWith(BOOK_CACHE_PREFIX)) {
+                        return undefined;
+                    }
                     if (cacheName !== CACHE_NAME) {
                         console.log('[ServiceWorker] Removing old cache:', cacheName);
                         return caches.delete(cacheName);
@@ -58,74 +370,81 @@ self.addEventListener('activate', function(event) {
     );
 });
 
-// Fetch event: Cache, falling back to network strategy
+// Fetch event: offline books first, then the app shell strategies below
 self.addEventListener('fetch', function(event) {
     // We only want to cache GET requests.
     if (event.request.method !== 'GET') {
         return;
     }
 
+    const url = new URL(event.request.url);
+    if (url.origin !== self.location.origin || url.pathname.startsWith('/api/')) {
+        return;
+    }
+
+    event.respondWith(
+        respondFromOfflineBook(event, url).then(offlineResponse => offlineResponse || defaultResponse(event))
+    );
+});
+
+function defaultResponse(event) {
     // For HTML pages, try network first to ensure freshness, then cache, then fallback to cache.
     // For other assets (CSS, JS, images), cache first is usually fine.
     if (event.request.mode === 'navigate' || (event.request.headers.get('accept') && event.request.headers.get('accept').includes('text/html'))) {
-        event.respondWith(
-            fetch(event.request)
-                .then(function(response) {
+        return fetch(event.request)
+            .then(function(response) {
+                // Check if we received a valid response
+                if (!response || response.status !== 200 || response.type !== 'basic') {
+                    // If network fails, try to get from cache
+                    return caches.match(event.request).then(cachedResponse => {
+                        return cachedResponse || response;
+                    });
+                }
+
+                // IMPORTANT: Clone the response. A response is a stream
+                // and because we want the browser to consume the response
+                // as well as the cache consuming the response, we need
+                // to clone it so we have two streams.
+                const responseToCache = response.clone();
+
+                caches.open(CACHE_NAME)
+                    .then(function(cache) {
+                        console.log('[ServiceWorker] Caching new page:', event.request.url);
+                        cache.put(event.request, responseToCache);
+                    });
+
+                return response;
+            })
+            .catch(function() {
+                // Network request failed, try to get it from the cache.
+                return caches.match(event.request);
+            });
+    }
+
+    // For non-HTML assets (CSS, JS, images): Cache first, then network
+    return caches.match(event.request)
+        .then(function(cachedResponse) {
+            // Cache hit - return response
+            if (cachedResponse) {
+                return cachedResponse;
+            }
+
+            // Not in cache - fetch from network
+            return fetch(event.request).then(
+                function(response) {
                     // Check if we received a valid response
                     if (!response || response.status !== 200 || response.type !== 'basic') {
-                        // If network fails, try to get from cache
-                        return caches.match(event.request).then(cachedResponse => {
-                            return cachedResponse || fetch(event.request); // Fallback to network again if not in cache (e.g. offline page)
-                        });
+                        return response; // Return original error response
                     }
 
-                    // IMPORTANT: Clone the response. A response is a stream
-                    // and because we want the browser to consume the response
-                    // as well as the cache consuming the response, we need
-                    // to clone it so we have two streams.
                     const responseToCache = response.clone();
-
                     caches.open(CACHE_NAME)
                         .then(function(cache) {
-                            console.log('[ServiceWorker] Caching new page:', event.request.url);
+                            console.log('[ServiceWorker] Caching new asset:', event.request.url);
                             cache.put(event.request, responseToCache);
                         });
-
                     return response;
-                })
-                .catch(function() {
-                    // Network request failed, try to get it from the cache.
-                    return caches.match(event.request);
-                })
-        );
-    } else {
-        // For non-HTML assets (CSS, JS, images): Cache first, then network
-        event.respondWith(
-            caches.match(event.request)
-                .then(function(cachedResponse) {
-                    // Cache hit - return response
-                    if (cachedResponse) {
-                        return cachedResponse;
-                    }
-
-                    // Not in cache - fetch from network
-                    return fetch(event.request).then(
-                        function(response) {
-                            // Check if we received a valid response
-                            if (!response || response.status !== 200 || response.type !== 'basic') {
-                                return response; // Return original error response
-                            }
-
-                            const responseToCache = response.clone();
-                            caches.open(CACHE_NAME)
-                                .then(function(cache) {
-                                    console.log('[ServiceWorker] Caching new asset:', event.request.url);
-                                    cache.put(event.request, responseToCache);
-                                });
-                            return response;
-                        }
-                    );
-                })
-        );
-    }
-});
+                }
+            );
+        });
+}